@@ -24,12 +24,15 @@
 # *
 # **************************************************************************
 import os
+import platform
+import re
+import shlex
+import tempfile
 
 import pwem
-from scipion.constants import PYTHON
-from pyworkflow.gui.project.utils import OS
 
-from scf.constants import DEFAULT_VERSION, SCF_HOME
+from scf.constants import DEFAULT_VERSION, SCF_HOME, SCF_CACHE_DIR, SCF_CACHE_MAX_SIZE, DEFAULT_CACHE_MAX_SIZE, \
+    SCF_USE_WORKER, SCF_WORKER_SOCKET
 
 _logo = ""
 _references = []
@@ -42,6 +45,10 @@ class Plugin(pwem.Plugin):
     @classmethod
     def _defineVariables(cls):
         cls._defineEmVar(SCF_HOME, cls._getSCFFolder(DEFAULT_VERSION))
+        cls._defineVar(SCF_CACHE_DIR, cls._getDefaultCacheDir())
+        cls._defineVar(SCF_CACHE_MAX_SIZE, DEFAULT_CACHE_MAX_SIZE)
+        cls._defineVar(SCF_USE_WORKER, 'False')
+        cls._defineVar(SCF_WORKER_SOCKET, os.path.join(tempfile.gettempdir(), 'scf-worker-%d.sock' % os.getuid()))
 
     @classmethod
     def getEnviron(cls):
@@ -49,23 +56,97 @@ class Plugin(pwem.Plugin):
 
     @classmethod
     def runSCF(cls, protocol, program, args, cwd=None):
-        """ Run SCF command from a given protocol. """
+        """ Run SCF command from a given protocol. If SCF_USE_WORKER is enabled the script is run by the persistent
+        worker, falling back to a new process if the worker is not available. """
+        from scipion.constants import PYTHON
 
-        #  Call python
-        cmd = PYTHON + " "
+        programPath = os.path.join(Plugin.getHome("CommandLineSCF"), program)
 
-        # Get the command
-        cmd += Plugin.getHome("CommandLineSCF")
-        cmd = os.path.join(cmd, program)
+        if cls.useWorker() and cls._runInWorker(programPath, args, cwd):
+            return
 
         # Run the protocol with that command
-        protocol.runJob(cmd, args, env=cls.getEnviron(), cwd=cwd)
+        protocol.runJob(PYTHON + " " + programPath, args, env=cls.getEnviron(), cwd=cwd)
+
+    @classmethod
+    def useWorker(cls):
+        return cls.getVar(SCF_USE_WORKER).lower() in ('true', '1', 'yes')
+
+    @classmethod
+    def getWorker(cls):
+        """ Returns a client of the persistent worker, starting it if needed, or None if it could not be started. """
+        from scipion.constants import PYTHON
+        from scf.worker import ensureWorker
+
+        return ensureWorker(PYTHON, cls.getVar(SCF_WORKER_SOCKET))
+
+    @classmethod
+    def getWorkerHealth(cls):
+        """ Returns the health report of the persistent worker, or None if it is not running. """
+        from scf.worker import WorkerClient
+
+        return WorkerClient(cls.getVar(SCF_WORKER_SOCKET)).ping()
+
+    @classmethod
+    def _runInWorker(cls, programPath, args, cwd):
+        """ Runs the script in the persistent worker. Only a trailing '2>&1 | tee <file>' redirection is supported in
+        the arguments. Returns False if the job could not be handed over to the worker. """
+        match = re.search(r'\s*2>&1\s*\|\s*tee\s+(\S+)\s*$', args)
+        teeFile = match.group(1) if match else None
+        args = args[:match.start()] if match else args
+
+        if re.search(r'[|<>;&`$]', args):
+            return False
+
+        worker = cls.getWorker()
+
+        if worker is None:
+            return False
+
+        cwd = os.path.abspath(cwd or os.getcwd())
+
+        if teeFile is not None:
+            outputFile = os.path.join(cwd, teeFile)
+        else:
+            outputFile = os.path.join(cwd, 'scfWorker_%d.log' % os.getpid())
+
+        print("%s %s (persistent worker)" % (programPath, args))
+
+        try:
+            returncode = worker.run(programPath, shlex.split(args), cwd, outputFile)
+        except (OSError, ValueError, KeyError) as e:
+            print("The SCF worker failed (%s), running the script in a new process" % e)
+            return False
+
+        with open(outputFile) as f:
+            print(f.read(), end='', flush=True)
+
+        if teeFile is None:
+            os.remove(outputFile)
+
+        if returncode != 0:
+            raise Exception("Process returned with code %d, command: %s %s" % (returncode, programPath, args))
+
+        return True
+
+    @classmethod
+    def _getDefaultCacheDir(cls):
+        """ The EM folder is often a shared installation that users can not write to, so the cache defaults to the
+        user cache directory """
+        return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'scipion-em-scf')
+
+    @classmethod
+    def getCache(cls):
+        """ Returns the cache of SCF results, located at SCF_CACHE_DIR and bounded to SCF_CACHE_MAX_SIZE MB. """
+        from scf.cache import ScfCache
+
+        return ScfCache(cls.getVar(SCF_CACHE_DIR), int(cls.getVar(SCF_CACHE_MAX_SIZE)) * 1024 ** 2)
 
     @classmethod
     def defineBinaries(cls, env):
         SCF_INSTALLED = 'scf_%s_installed' % DEFAULT_VERSION
 
-        if 'linux' in OS.getPlatform().lower():
+        if 'linux' in platform.system().lower():
 
             # Clone repo https://github.com/LyumkisLab/CommandLineSCF.git
             # installationCmd = ' git clone git@github.com:LyumkisLab/CommandLineSCF.git \n'
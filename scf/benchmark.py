@@ -0,0 +1,446 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Benchmark of the SCF analysis stages over synthetic sets of particles, to detect performance regressions.
+
+Synthetic sets are written as sqlite files with the layout of a Scipion SetOfParticles, and they are read and
+converted with the same functions used by the protocol: the transforms are read by scf.convert.iterTransforms (by
+several processes with --workers) and the angles written chunk by chunk to the memory-mapped file the analysis uses.
+Every stage reports its wall time and peak resident memory, and the results can be saved as a baseline and compared
+against it in later runs:
+
+    python -m scf.benchmark --sizes 10000 100000 1000000 --save-baseline baseline.json
+    python -m scf.benchmark --sizes 10000 100000 1000000 --baseline baseline.json
+
+The exit status is 1 if any stage is slower (or uses more memory) than the baseline beyond the given threshold.
+
+The cost of importing the plugin is checked against a budget in milliseconds instead with:
+
+    python -m scf.benchmark --import-budget 500
+
+which fails if importing the plugin modules takes longer, or loads any of the modules deferred until a protocol runs
+or a viewer opens (matplotlib, PIL, mrcfile and the Scipion GUI).
+"""
+
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from scf import engine
+from scf.constants import TRANSFORM_CHUNK_SIZE, TRANSFORM_MATRIX_LABEL
+from scf.convert import getAnglesFromMatrices, iterTransforms, loadAngles, readTransforms, writeAngles
+from scf.healpix import OrientationHistogram
+from scf.profiling import getPeakMemory, resetPeakMemory
+
+DISTRIBUTIONS = ['uniform', 'topView', 'clusters']
+STAGES = ['loadTransforms', 'eulerConversion', 'angleFile', 'angleTsv', 'scf', 'scfBinned', 'plots']
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+DEFAULT_FOURIER_RADIUS = 40.0
+DEFAULT_NUMBER_TO_USE = 10000
+DEFAULT_HEALPIX_ORDER = 6
+DEFAULT_THRESHOLD = 1.25
+
+# Stages faster than this (seconds) or using less memory than this (MB) are never reported as regressions, as their
+# measures are dominated by noise
+MIN_REGRESSION_TIME = 0.05
+MIN_REGRESSION_MEMORY = 20
+
+DEFAULT_IMPORT_MODULES = ['scf', 'scf.protocols', 'scf.viewers']
+DEFERRED_MODULES = ['matplotlib', 'PIL', 'mrcfile', 'pyworkflow.gui.project']
+# Scipion modules the plugin builds on, imported before the measure as Scipion has always loaded them when it loads the
+# plugin. They already load some of the deferred modules (e.g. pyworkflow loads matplotlib and PIL), which the plugin
+# is only accountable for if they are not loaded by its baseline
+BASELINE_IMPORT_MODULES = ['pyworkflow.protocol.params', 'pwem.protocols', 'pwem.viewers']
+IMPORT_REPEATS = 3
+
+# Code run by python -X importtime, printing the wall time and the modules loaded by the import after the baseline
+_IMPORT_CODE = """
+import json, sys, time
+for name in %(baseline)r:
+    __import__(name)
+before = set(sys.modules)
+start = time.perf_counter()
+import %(module)s
+print(json.dumps({'time': time.perf_counter() - start, 'modules': sorted(set(sys.modules) - before)}))
+"""
+
+
+# --------------------------- Synthetic data functions ----------------------------
+def _randomDirections(rng, n):
+    """ Uniformly distributed unit vectors. """
+    z = rng.uniform(-1, 1, n)
+    phi = rng.uniform(0, 2 * np.pi, n)
+    r = np.sqrt(1 - z ** 2)
+
+    return np.stack((r * np.cos(phi), r * np.sin(phi), z), axis=1)
+
+
+def _perturbDirections(rng, centres, spread):
+    """ Directions scattered around the given ones with a gaussian spread (degrees). """
+    directions = centres + rng.normal(0, np.radians(spread), centres.shape)
+
+    return directions / np.linalg.norm(directions, axis=1)[:, None]
+
+
+def generateDirections(distribution, n, seed=0):
+    """ Returns n projection directions following one of the DISTRIBUTIONS: uniform, dominated by top views (80% of
+    the particles within ~10 degrees of the z axis) or concentrated in a few clusters of preferred orientations. """
+    rng = np.random.default_rng(seed)
+
+    if distribution == 'uniform':
+        return _randomDirections(rng, n)
+
+    if distribution == 'topView':
+        top = int(0.8 * n)
+        directions = _perturbDirections(rng, np.tile([0.0, 0.0, 1.0], (top, 1)), 10)
+        return np.concatenate((directions, _randomDirections(rng, n - top)))
+
+    if distribution == 'clusters':
+        centres = _randomDirections(rng, 5)
+        return _perturbDirections(rng, centres[rng.integers(0, len(centres), n)], 8)
+
+    raise ValueError("Unknown distribution %s, it must be one of %s" % (distribution, ', '.join(DISTRIBUTIONS)))
+
+
+def matricesFromDirections(directions, seed=0):
+    """ Returns the (N,4,4) transformation matrices with the given projection directions (third row) and random
+    in-plane rotations. """
+    rng = np.random.default_rng(seed)
+
+    reference = np.zeros_like(directions)
+    alignedWithX = np.abs(directions[:, 0]) > 0.9
+    reference[~alignedWithX, 0] = 1
+    reference[alignedWithX, 1] = 1
+
+    u = np.cross(directions, reference)
+    u /= np.linalg.norm(u, axis=1)[:, None]
+    v = np.cross(directions, u)
+
+    psi = rng.uniform(0, 2 * np.pi, len(directions))[:, None]
+    first = np.cos(psi) * u + np.sin(psi) * v
+
+    matrices = np.zeros((len(directions), 4, 4))
+    matrices[:, 0, :3] = first
+    matrices[:, 1, :3] = np.cross(directions, first)
+    matrices[:, 2, :3] = directions
+    matrices[:, 3, 3] = 1
+
+    return matrices
+
+
+def writeSyntheticSet(dbFile, matrices, chunkSize=100000, attributes=None):
+    """ Writes the matrices to a sqlite file with the layout of a SetOfParticles: a Classes table mapping attribute
+    labels to columns and an Objects table with the values, matrices being stored as JSON. Other numeric particle
+    attributes, e.g. scores or class ids, are given as a dictionary from their labels to their (N,) values. """
+    attributes = attributes or {}
+    columns = ['c%02d' % (i + 3) for i in range(len(attributes))]
+
+    with sqlite3.connect(dbFile) as conn:
+        conn.execute("CREATE TABLE Classes (id INTEGER PRIMARY KEY, label_property TEXT, column_name TEXT, "
+                     "class_name TEXT)")
+        conn.executemany("INSERT INTO Classes (label_property, column_name, class_name) VALUES (?, ?, ?)",
+                         [('self', 'self', 'Particle'),
+                          ('_samplingRate', 'c01', 'Float'),
+                          (TRANSFORM_MATRIX_LABEL, 'c02', 'Matrix')] +
+                         [(label, column, 'Float') for label, column in zip(attributes, columns)])
+        conn.execute("CREATE TABLE Objects (id INTEGER PRIMARY KEY, enabled INTEGER, label TEXT, comment TEXT, "
+                     "creation DATE, c01 FLOAT, c02 TEXT%s)" % ''.join(', %s FLOAT' % column for column in columns))
+        insert = "INSERT INTO Objects (id, enabled, c01, c02%s) VALUES (?, 1, 1.0, ?%s)" \
+                 % (''.join(', ' + column for column in columns), ', ?' * len(columns))
+        values = [np.asarray(attributeValues, dtype=np.float64) for attributeValues in attributes.values()]
+
+        for start in range(0, len(matrices), chunkSize):
+            chunk = matrices[start:start + chunkSize]
+            conn.executemany(insert, ((start + i + 1, json.dumps(matrix.tolist()))
+                                      + tuple(float(v[start + i]) for v in values) for i, matrix in enumerate(chunk)))
+
+
+class SyntheticSet:
+    """ Stand-in for the SetOfParticles stored in a synthetic sqlite file. It is enough for the transform readers of
+    scf.convert, which read the set sqlite file directly. """
+
+    def __init__(self, dbFile):
+        self._mapperPath = [dbFile, '']
+
+    def getFileName(self):
+        return self._mapperPath[0]
+
+
+# --------------------------- Measure functions ----------------------------
+def measure(function, *args, **kwargs):
+    """ Runs the function, returning its result, its wall time in seconds and the peak resident memory in MB while
+    it ran. """
+    resetPeakMemory()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+
+    return result, elapsed, getPeakMemory()
+
+
+def _writeTsv(fileName, angles):
+    """ Text file read by the external SCF script, written from the memory-mapped angles as the protocol does """
+    with open(fileName, 'w') as f:
+        for start in range(0, len(angles), TRANSFORM_CHUNK_SIZE):
+            np.savetxt(f, angles[start:start + TRANSFORM_CHUNK_SIZE], fmt='%.10g', delimiter='\t')
+
+
+def _binnedScf(particles, fourierRadius, order, numberOfWorkers):
+    """ Binned analysis building the histograms in a single pass over the particles, as the protocol does """
+    nside = 2 ** order
+    histograms = (OrientationHistogram(nside), OrientationHistogram(max(1, nside // 2)))
+
+    for chunk in iterTransforms(particles, numberOfWorkers=numberOfWorkers):
+        directions = engine.directionsFromMatrices(chunk[1])
+
+        for histogram in histograms:
+            histogram.add(directions)
+
+    return engine.runBinnedScf(*histograms, fourierRadius)
+
+
+def _plots(directions, result, workDir):
+    engine.plotAngles(directions, os.path.join(workDir, 'angles.jpg'))
+    engine.plotSampling(result, os.path.join(workDir, 'sampling.jpg'))
+
+
+def runCase(distribution, size, workDir, fourierRadius=DEFAULT_FOURIER_RADIUS, numberToUse=DEFAULT_NUMBER_TO_USE,
+            healpixOrder=DEFAULT_HEALPIX_ORDER, stages=STAGES, numberOfWorkers=1):
+    """ Benchmarks the stages of the analysis of a synthetic set, reading it with numberOfWorkers processes. Returns
+    a dictionary with the wall time and the peak memory of every stage. """
+    dbFile = os.path.join(workDir, '%s_%d.sqlite' % (distribution, size))
+
+    if not os.path.exists(dbFile):
+        writeSyntheticSet(dbFile, matricesFromDirections(generateDirections(distribution, size)))
+
+    particles = SyntheticSet(dbFile)
+    anglesFile = os.path.join(workDir, 'angles.npy')
+    measures = {}
+
+    def record(stage, function, *args, **kwargs):
+        if stage not in stages:
+            return None
+
+        result, elapsed, memory = measure(function, *args, **kwargs)
+        measures[stage] = {'time': elapsed, 'memory': memory}
+
+        return result
+
+    # Reading and conversion of all the transforms at once, as needed by the viewer and the batch analysis
+    _, matrices = record('loadTransforms', readTransforms, particles, numberOfWorkers=numberOfWorkers) or \
+        readTransforms(particles, numberOfWorkers=numberOfWorkers)
+    record('eulerConversion', getAnglesFromMatrices, matrices)
+
+    # Angles of the analysis, read, converted and written chunk by chunk, then memory-mapped
+    if record('angleFile', writeAngles, anglesFile, particles, numberOfWorkers=numberOfWorkers) is None:
+        writeAngles(anglesFile, particles, numberOfWorkers=numberOfWorkers)
+
+    angles = loadAngles(anglesFile)
+    record('angleTsv', _writeTsv, os.path.join(workDir, 'angles.txt'), angles)
+
+    result = record('scf', engine.runScf, angles, fourierRadius, numberToUse)
+    record('scfBinned', _binnedScf, particles, fourierRadius, healpixOrder, numberOfWorkers)
+
+    if 'plots' in stages:
+        if result is None:
+            result = engine.runScf(angles, fourierRadius, numberToUse)
+
+        record('plots', _plots, engine.directionsFromMatrices(matrices), result, workDir)
+
+    return measures
+
+
+# --------------------------- Baseline functions ----------------------------
+def compareWithBaseline(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """ Returns the list of messages describing the stages whose time or memory exceed the baseline times the
+    threshold. """
+    regressions = []
+
+    for case, measures in results.items():
+        for stage, values in measures.items():
+            reference = baseline.get(case, {}).get(stage)
+
+            if reference is None:
+                continue
+
+            if values['time'] > max(reference['time'] * threshold, MIN_REGRESSION_TIME):
+                regressions.append("%s %s: %0.3f s (baseline %0.3f s)" % (case, stage, values['time'],
+                                                                          reference['time']))
+
+            if values['memory'] is not None and reference.get('memory') is not None and \
+                    values['memory'] > max(reference['memory'] * threshold, MIN_REGRESSION_MEMORY):
+                regressions.append("%s %s: %0.1f MB (baseline %0.1f MB)" % (case, stage, values['memory'],
+                                                                            reference['memory']))
+
+    return regressions
+
+
+def measureImportTime(module, baseline=BASELINE_IMPORT_MODULES, python=sys.executable):
+    """ Imports the module in a new interpreter run with -X importtime, once the baseline modules are imported.
+    Returns the import wall time (ms), the number of modules loaded, the deferred modules among them and the five
+    ones with the highest self import time (ms), not counting the baseline modules and the ones they load. """
+    process = subprocess.run([python, '-X', 'importtime', '-c',
+                              _IMPORT_CODE % {'baseline': list(baseline), 'module': module}],
+                             capture_output=True, text=True, check=True)
+    report = json.loads(process.stdout.strip().splitlines()[-1])
+    loaded = set(report['modules'])
+    selfTimes = {}
+
+    # Lines are "import time: <self us> | <cumulative us> | <nested module>"
+    for line in process.stderr.splitlines():
+        fields = line.split('|')
+
+        if line.startswith('import time:') and len(fields) == 3 and fields[0].split(':')[1].strip().isdigit():
+            name = fields[2].strip()
+
+            if name in loaded:
+                selfTimes[name] = int(fields[0].split(':')[1]) / 1000
+
+    heaviest = sorted(selfTimes.items(), key=lambda item: item[1], reverse=True)[:5]
+    deferred = [name for name in DEFERRED_MODULES if name in loaded]
+
+    return {'time': report['time'] * 1000, 'modules': len(loaded), 'deferred': deferred, 'heaviest': heaviest}
+
+
+def checkImportTime(modules, budget, baseline=BASELINE_IMPORT_MODULES, repeats=IMPORT_REPEATS):
+    """ Measures the import of every module after the baseline modules, keeping the fastest of several runs to filter
+    out noise. Returns the list of failures: imports over the budget (ms) or loading deferred modules. """
+    failures = []
+
+    for module in modules:
+        result = min((measureImportTime(module, baseline) for _ in range(repeats)), key=lambda r: r['time'])
+        print("%-20s %8.1f ms %5d modules  heaviest: %s"
+              % (module, result['time'], result['modules'],
+                 ', '.join('%s %0.1f ms' % item for item in result['heaviest'])))
+
+        if result['time'] > budget:
+            failures.append("import %s: %0.1f ms over the budget of %0.1f ms" % (module, result['time'], budget))
+
+        if result['deferred']:
+            failures.append("import %s: loads %s" % (module, ', '.join(result['deferred'])))
+
+    return failures
+
+
+def _printResults(results):
+    print("%-24s %-16s %10s %12s" % ('Case', 'Stage', 'Time (s)', 'Memory (MB)'))
+
+    for case, measures in results.items():
+        for stage, values in measures.items():
+            memory = '-' if values['memory'] is None else '%0.1f' % values['memory']
+            print("%-24s %-16s %10.3f %12s" % (case, stage, values['time'], memory))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m scf.benchmark',
+                                     description='Benchmark of the SCF analysis over synthetic sets of particles.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Number of particles of the synthetic sets.')
+    parser.add_argument('--distributions', nargs='+', choices=DISTRIBUTIONS, default=DISTRIBUTIONS,
+                        help='Orientation distributions of the synthetic sets.')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='Stages to measure.')
+    parser.add_argument('--fourier-radius', type=float, default=DEFAULT_FOURIER_RADIUS)
+    parser.add_argument('--number-to-use', type=int, default=DEFAULT_NUMBER_TO_USE,
+                        help='Number of projections used by the scf stage, -1 to use all of them.')
+    parser.add_argument('--healpix-order', type=int, default=DEFAULT_HEALPIX_ORDER,
+                        help='Grid order of the scfBinned stage, which always uses all the projections.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes reading the transforms, as the protocol threads.')
+    parser.add_argument('--work-dir', help='Directory for the synthetic sets and output files, which are kept to '
+                                           'reuse them in later runs. A temporary directory is used by default.')
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', help='Compare the results with the ones in this JSON file.')
+    parser.add_argument('--save-baseline', help='Write the results to this JSON file to use them as baseline.')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Ratio to the baseline time or memory above which a stage is reported as a regression.')
+    parser.add_argument('--import-budget', type=float,
+                        help='Only check that importing the plugin modules takes less than these milliseconds and '
+                             'does not load the modules deferred until a protocol runs or a viewer opens.')
+    parser.add_argument('--import-modules', nargs='+', default=DEFAULT_IMPORT_MODULES,
+                        help='Modules imported by the import check.')
+    parser.add_argument('--import-baseline', nargs='*', default=BASELINE_IMPORT_MODULES,
+                        help='Modules imported before the ones of the import check, which are not measured.')
+    args = parser.parse_args(argv)
+
+    if args.import_budget is not None:
+        failures = checkImportTime(args.import_modules, args.import_budget, args.import_baseline)
+
+        for failure in failures:
+            print("REGRESSION %s" % failure)
+
+        return 1 if failures else 0
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        workDir = args.work_dir or tmpDir
+        os.makedirs(workDir, exist_ok=True)
+        results = {}
+
+        for distribution in args.distributions:
+            for size in args.sizes:
+                case = '%s_%d' % (distribution, size)
+                print("Running %s..." % case, file=sys.stderr)
+                results[case] = runCase(distribution, size, workDir, args.fourier_radius, args.number_to_use,
+                                        args.healpix_order, args.stages, args.workers)
+
+    _printResults(results)
+
+    report = {'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                          'numpy': np.__version__, 'cpus': os.cpu_count(), 'workers': args.workers},
+              'results': results}
+
+    for fileName in filter(None, [args.output, args.save_baseline]):
+        with open(fileName, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+        regressions = compareWithBaseline(results, baseline, args.threshold)
+
+        for regression in regressions:
+            print("REGRESSION %s" % regression)
+
+        if regressions:
+            return 1
+
+        print("No regressions over %s (threshold %0.2f)" % (args.baseline, args.threshold))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
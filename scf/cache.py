@@ -0,0 +1,169 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Content-addressed cache of SCF results. Every entry is a directory named after the hash of the particle orientations
+and the analysis parameters, holding the files produced by the analysis. The cache is bounded in size, evicting the
+least recently used entries. The cache is only an optimization: callers are expected to go on without it when its
+operations raise OSError, e.g. when the cache directory is not writable.
+"""
+
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from scf.constants import SCF_CACHE_VERSION
+
+
+class ScfCache:
+    """ Size-bounded LRU cache of SCF results stored under cacheDir. """
+
+    def __init__(self, cacheDir, maxSize):
+        """ maxSize is given in bytes. """
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+
+    @staticmethod
+    def computeKey(*arrays, **params):
+        """ Returns the key of the analysis of the given arrays (orientations and any other per-particle data) with
+        the given parameters. """
+        digest = hashlib.sha256()
+
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            digest.update(str((array.shape, array.dtype.str)).encode())
+            # Hashed through a flat byte view, so memory-mapped arrays are read without being copied
+            digest.update(array.reshape(-1).view(np.uint8) if array.dtype != object else
+                          str(array.tolist()).encode())
+        digest.update(json.dumps(dict(params, version=SCF_CACHE_VERSION), sort_keys=True, default=str).encode())
+
+        return digest.hexdigest()
+
+    def _getEntryPath(self, key):
+        return os.path.join(self.cacheDir, key)
+
+    def contains(self, key):
+        return os.path.isdir(self._getEntryPath(key))
+
+    def restore(self, key, destination, exclude=()):
+        """ Copies the files of the entry into destination, except those matching the exclude patterns. Returns False
+        if the entry does not exist. If the copy fails, e.g. because the entry is being evicted, the files already
+        copied are removed and the error raised. """
+        entryPath = self._getEntryPath(key)
+
+        if not os.path.isdir(entryPath):
+            return False
+
+        copied = []
+
+        try:
+            for fileName in os.listdir(entryPath):
+                if _isExcluded(fileName, exclude):
+                    continue
+
+                copied.append(shutil.copy2(os.path.join(entryPath, fileName), destination))
+        except OSError:
+            for filePath in copied:
+                os.remove(filePath)
+            raise
+
+        # Mark the entry as recently used
+        now = time.time()
+        os.utime(entryPath, (now, now))
+
+        return True
+
+    def store(self, key, source, exclude=()):
+        """ Stores the files in source directory, except those matching the exclude patterns (fnmatch style), as
+        the entry of key. If the copy fails, e.g. because the disk is full, the files already copied are removed and
+        the error raised. """
+        if self.contains(key):
+            return
+
+        os.makedirs(self.cacheDir, exist_ok=True)
+
+        # Fill a temporary directory and rename it, so that incomplete entries are never visible
+        tmpPath = tempfile.mkdtemp(prefix='.tmp', dir=self.cacheDir)
+
+        try:
+            for fileName in os.listdir(source):
+                filePath = os.path.join(source, fileName)
+
+                if not _isExcluded(fileName, exclude) and os.path.isfile(filePath):
+                    shutil.copy2(filePath, tmpPath)
+
+        except OSError:
+            # Temporary directories are never listed as entries, so they would never be evicted
+            shutil.rmtree(tmpPath, ignore_errors=True)
+            raise
+
+        try:
+            os.rename(tmpPath, self._getEntryPath(key))
+        except OSError:
+            # Another run stored the same entry meanwhile
+            shutil.rmtree(tmpPath, ignore_errors=True)
+
+        self.evict()
+
+    def getEntries(self):
+        """ Returns the list of (last use time, size, path) of the entries, least recently used first. """
+        entries = []
+
+        if not os.path.isdir(self.cacheDir):
+            return entries
+
+        for key in os.listdir(self.cacheDir):
+            entryPath = self._getEntryPath(key)
+
+            if key.startswith('.') or not os.path.isdir(entryPath):
+                continue
+
+            size = sum(entry.stat().st_size for entry in os.scandir(entryPath) if entry.is_file())
+            entries.append((os.stat(entryPath).st_mtime, size, entryPath))
+
+        return sorted(entries)
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache fits in its maximum size. """
+        entries = self.getEntries()
+        totalSize = sum(size for _, size, _ in entries)
+
+        for _, size, entryPath in entries:
+            if totalSize <= self.maxSize:
+                break
+
+            shutil.rmtree(entryPath, ignore_errors=True)
+            totalSize -= size
+
+
+def _isExcluded(fileName, patterns):
+    return any(fnmatch.fnmatchcase(fileName, pattern) for pattern in patterns)
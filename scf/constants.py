@@ -32,3 +32,116 @@ VERSION_0_0_1 = '0.0.1'
 
 DEFAULT_VERSION = VERSION_0_0_1
 
+
+# ----------------- Particle transform reading ----------------------------
+
+TRANSFORM_MATRIX_LABEL = '_transform._matrix'
+TRANSFORM_CHUNK_SIZE = 100000
+
+# ----------------- Native SCF engine --------------------------------------
+
+# Bounds for the number of Fourier space directions in which the sampling is evaluated
+SCF_MIN_QUERY_DIRECTIONS = 500
+SCF_MAX_QUERY_DIRECTIONS = 20000
+
+# Maximum number of elements of the (directions x projections) matrices evaluated at once
+SCF_CHUNK_ELEMENTS = 4000000
+
+# Number of directions used to model the cone traced by each projection when tilting the sample
+SCF_TILT_CONE_STEPS = 12
+
+# Seed used to pick the subset of projections when not all of them are used
+SCF_RANDOM_SEED = 0
+
+# ----------------- Result cache -------------------------------------------
+
+SCF_CACHE_DIR = 'SCF_CACHE_DIR'
+SCF_CACHE_MAX_SIZE = 'SCF_CACHE_MAX_SIZE'
+
+# Default maximum size of the cache in MB
+DEFAULT_CACHE_MAX_SIZE = 2048
+
+# Increase whenever the results of the analysis change, to invalidate previous cache entries
+SCF_CACHE_VERSION = 3
+
+# ----------------- Adaptive subsampling -----------------------------------
+
+SCF_ADAPTIVE_TOLERANCE = 0.01
+SCF_ADAPTIVE_INITIAL_SIZE = 1000
+SCF_ADAPTIVE_REPLICATES = 20
+
+# ----------------- Orientation density ------------------------------------
+
+# The polar angle bins of density maps grow with the number of projections, keeping about this many per bin
+SCF_DENSITY_PROJECTIONS_PER_BIN = 20
+SCF_DENSITY_MIN_BINS = 18
+SCF_DENSITY_MAX_BINS = 180
+
+# Default maximum number of projections shown by the viewer, larger sets are downsampled
+SCF_DENSITY_MAX_PROJECTIONS = 1000000
+
+# Default number of projections used by the viewer to preview the sampling at other tilts or resolutions
+SCF_PREVIEW_PROJECTIONS = 10000
+
+# ----------------- 3D FSC map ---------------------------------------------
+
+# HEALPix grid in which the directional FSC is averaged (768 pixels of about 7 degrees)
+SCF_FSC_MAP_NSIDE = 8
+
+# FSC value defining the directional resolution
+SCF_FSC_THRESHOLD = 0.143
+
+# ----------------- Optimal tilt search ------------------------------------
+
+# Width (degrees) of the bracket at which the search of the best tilt stops
+SCF_TILT_SEARCH_TOLERANCE = 0.5
+
+# Number of tilts of the coarse grid bracketing the best tilt
+SCF_TILT_SEARCH_GRID = 7
+
+# ----------------- Persistent worker --------------------------------------
+
+SCF_USE_WORKER = 'SCF_USE_WORKER'
+SCF_WORKER_SOCKET = 'SCF_WORKER_SOCKET'
+
+# Seconds without requests after which the worker exits
+SCF_WORKER_IDLE_TIMEOUT = 1800
+
+# Seconds to wait for a new worker to answer
+SCF_WORKER_START_TIMEOUT = 30
+
+# ----------------- Out-of-core analysis --------------------------------------
+
+# Default memory ceiling (MB) of the out-of-core analysis
+SCF_OUT_OF_CORE_MEMORY_LIMIT = 2048
+
+# Estimated bytes needed to read one particle transform and convert it to a projection direction
+SCF_PARTICLE_READ_BYTES = 2048
+
+# Bytes of the temporaries created for every direction sampling Fourier space (tilt cone, symmetry copies)
+SCF_DIRECTION_BYTES = 128
+
+# Smallest number of particles per chunk
+SCF_MIN_CHUNK_SIZE = 1000
+
+# ----------------- Analysis modes --------------------------------------
+
+MODE_SINGLE = 0
+MODE_ADAPTIVE = 1
+MODE_BINNED = 2
+MODE_OUT_OF_CORE = 3
+MODE_GROUPED = 4
+MODE_RESOLUTION_SWEEP = 5
+MODE_TILT_SWEEP = 6
+MODE_TILT_SEARCH = 7
+MODE_EXTERNAL_SCRIPT = 8
+
+ANALYSIS_MODES = ['Single SCF', 'Adaptive number of projections', 'Binned orientations', 'Out-of-core',
+                  'Grouped by attribute', 'Resolution sweep', 'Tilt sweep', 'Tilt search', 'External SCF script']
+
+# Modes where every particle may be weighted by one of its attributes
+WEIGHTED_MODES = (MODE_SINGLE, MODE_BINNED, MODE_OUT_OF_CORE)
+
+# Modes analysing a random subset of the particles of a given size
+SUBSET_MODES = (MODE_SINGLE, MODE_GROUPED, MODE_RESOLUTION_SWEEP, MODE_TILT_SWEEP, MODE_TILT_SEARCH,
+                MODE_EXTERNAL_SCRIPT)
@@ -0,0 +1,432 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import json
+import os
+import re
+import sqlite3
+
+import numpy as np
+
+from scf.constants import TRANSFORM_CHUNK_SIZE, TRANSFORM_MATRIX_LABEL
+
+# Same tolerance used by pwem.convert.transformations to detect gimbal lock
+_EPS = np.finfo(float).eps * 4.0
+
+
+def eulerFromMatrices(matrices):
+    """ Vectorized equivalent of pwem.convert.transformations.euler_from_matrix(matrix, axes='szyz') for a stack of
+    matrices. Accepts an (N,4,4) or (N,3,3) array and returns an (N,3) array of angles in radians. """
+    M = np.asarray(matrices, dtype=np.float64)[:, :3, :3]
+
+    sy = np.hypot(M[:, 2, 1], M[:, 2, 0])
+    regular = sy > _EPS
+
+    ax = np.where(regular,
+                  np.arctan2(M[:, 2, 1], M[:, 2, 0]),
+                  np.arctan2(-M[:, 1, 0], M[:, 1, 1]))
+    ay = np.arctan2(sy, M[:, 2, 2])
+    az = np.where(regular,
+                  np.arctan2(M[:, 1, 2], -M[:, 0, 2]),
+                  0.0)
+
+    # szyz has odd parity, so every angle changes sign
+    return -np.stack((ax, ay, az), axis=1)
+
+
+def getAnglesFromMatrices(matrices):
+    """ Returns the (N,3) array of szyz Euler angles in degrees for a stack of transformation matrices. """
+    return np.degrees(eulerFromMatrices(matrices))
+
+
+# --------------------------- Transform reading functions ----------------------------
+def getSetStorage(inputSet):
+    """ Returns the (sqlite file, table prefix) where the items of a set are stored, or None if the set is not backed
+    by a readable sqlite file. """
+    mapperPath = getattr(inputSet, '_mapperPath', None)
+
+    if mapperPath is None or len(mapperPath) == 0:
+        return None
+
+    dbFile = mapperPath[0]
+    prefix = mapperPath[1] if len(mapperPath) > 1 and mapperPath[1] else ''
+
+    if not dbFile or not os.path.exists(dbFile):
+        return None
+
+    return dbFile, prefix
+
+
+def _getColumnMapping(dbFile, prefix=''):
+    """ Dictionary from attribute labels to the column names used in the Objects table of a set sqlite file. """
+    with sqlite3.connect(dbFile) as conn:
+        return dict(conn.execute("SELECT label_property, column_name FROM %sClasses" % prefix).fetchall())
+
+
+def getSqliteColumns(dbFile, labels, prefix=''):
+    """ Maps attribute labels (e.g. '_transform._matrix') to the column names used in the Objects table of a set
+    sqlite file. Returns None if any of the labels is not stored in the file. """
+    columns = _getColumnMapping(dbFile, prefix)
+
+    if not all(label in columns for label in labels):
+        return None
+
+    return [columns[label] for label in labels]
+
+
+# Attribute labels (e.g. _classId or _ctfModel._defocusU) of an SQL condition, outside of quoted strings
+_LABEL_PATTERN = re.compile(r"'(?:[^']|'')*'|(?<![\w.])(_[A-Za-z]\w*(?:\._[A-Za-z]\w*)*)")
+
+
+def translateWhere(dbFile, where, prefix=''):
+    """ Translates an SQL condition over particle attribute labels, as accepted by Set.iterItems, e.g.
+    '_rlnMaxValueProbDistribution > 0.5 AND _classId = 3', to a condition over the columns of the Objects table of a
+    set sqlite file. Raises ValueError if an attribute is not stored in the file. """
+    if not where:
+        return where
+
+    columns = _getColumnMapping(dbFile, prefix)
+
+    def replace(match):
+        label = match.group(1)
+
+        if label is None:
+            return match.group(0)
+
+        if label not in columns:
+            raise ValueError("The attribute %s is not stored in %s" % (label, dbFile))
+
+        return columns[label]
+
+    return _LABEL_PATTERN.sub(replace, where)
+
+
+def iterSqliteTransforms(dbFile, prefix='', chunkSize=TRANSFORM_CHUNK_SIZE, where=None, attributes=()):
+    """ Generator reading only the transformation matrix column from a set sqlite file. It yields chunks of
+    (ids, matrices) with at most chunkSize rows, matrices being an (n,4,4) array. An optional SQL condition
+    over the Objects table restricts the rows read. If attribute labels are given, their columns are read in the
+    same query and every chunk also includes the list with the (n,) array of values of each attribute. """
+    columns = getSqliteColumns(dbFile, [TRANSFORM_MATRIX_LABEL] + list(attributes), prefix)
+    query = "SELECT id, %s FROM %sObjects WHERE %s ORDER BY id" % (', '.join(columns), prefix, where or '1')
+
+    with sqlite3.connect(dbFile) as conn:
+        cursor = conn.execute(query)
+
+        while True:
+            rows = cursor.fetchmany(chunkSize)
+
+            if not rows:
+                break
+
+            ids, values, *attributeValues = zip(*rows)
+
+            # Matrices are stored as JSON strings, parse the whole chunk at once
+            matrices = np.array(json.loads('[%s]' % ','.join(values)), dtype=np.float64)
+
+            if attributes:
+                yield np.array(ids, dtype=np.int64), matrices, [np.array(v) for v in attributeValues]
+            else:
+                yield np.array(ids, dtype=np.int64), matrices
+
+
+def _concatenateChunks(chunks, attributes):
+    """ Joins the chunks yielded by the transform generators. """
+    if not chunks:
+        empty = (np.empty(0, dtype=np.int64), np.empty((0, 4, 4)))
+        return empty + ([np.empty(0) for _ in attributes],) if attributes else empty
+
+    columns = list(zip(*chunks))
+    result = (np.concatenate(columns[0]), np.concatenate(columns[1]))
+
+    if attributes:
+        result += ([np.concatenate(values) for values in zip(*columns[2])],)
+
+    return result
+
+
+def readSqliteTransforms(dbFile, prefix='', chunkSize=TRANSFORM_CHUNK_SIZE, where=None, attributes=()):
+    """ Reads all the transformation matrices of a set sqlite file. Returns the (N,) ids and (N,4,4) matrices, plus
+    the list of attribute values if attributes are requested. """
+    return _concatenateChunks(list(iterSqliteTransforms(dbFile, prefix, chunkSize, where, attributes)), attributes)
+
+
+def getIdRanges(dbFile, prefix='', rangeSize=TRANSFORM_CHUNK_SIZE, where=None):
+    """ Splits the rows of the Objects table of a set sqlite file (optionally restricted by an SQL condition) into
+    ranges of rangeSize consecutive ids. Returns the list of SQL conditions selecting every range, in id order. """
+    where = where or '1'
+    firstIds = []
+
+    with sqlite3.connect(dbFile) as conn:
+        cursor = conn.execute("SELECT id FROM %sObjects WHERE %s ORDER BY id" % (prefix, where))
+
+        while True:
+            rows = cursor.fetchmany(rangeSize)
+
+            if not rows:
+                break
+
+            firstIds.append(rows[0][0])
+
+    limits = ['id >= %d' % firstId for firstId in firstIds]
+    limits = [limit if nextId is None else '%s AND id < %d' % (limit, nextId)
+              for limit, nextId in zip(limits, firstIds[1:] + [None])]
+
+    return ['(%s) AND %s' % (where, limit) for limit in limits]
+
+
+def _readSqliteRange(args):
+    return readSqliteTransforms(*args)
+
+
+def iterSqliteTransformsParallel(dbFile, prefix='', chunkSize=TRANSFORM_CHUNK_SIZE, where=None, attributes=(),
+                                 numberOfWorkers=1):
+    """ Same as iterSqliteTransforms, splitting the rows into chunks of consecutive ids that are read and decoded by
+    numberOfWorkers processes. Chunks are yielded in id order. """
+    ranges = getIdRanges(dbFile, prefix, chunkSize, where)
+
+    if numberOfWorkers <= 1 or len(ranges) <= 1:
+        yield from iterSqliteTransforms(dbFile, prefix, chunkSize, where, attributes)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=min(numberOfWorkers, len(ranges))) as executor:
+        for chunk in executor.map(_readSqliteRange, [(dbFile, prefix, chunkSize, rangeWhere, attributes)
+                                                     for rangeWhere in ranges]):
+            if len(chunk[0]):
+                yield chunk
+
+
+def _iterSqliteTransformsSafe(dbFile, prefix='', chunkSize=TRANSFORM_CHUNK_SIZE, where=None, attributes=(),
+                              numberOfWorkers=1):
+    """ Same as iterSqliteTransformsParallel, going on with the sequential iterSqliteTransforms after the last chunk
+    yielded if the worker processes fail at any point (the pool can not be started, a worker dies or raises). """
+    chunks = iterSqliteTransformsParallel(dbFile, prefix, chunkSize, where, attributes, numberOfWorkers)
+    lastId = None
+
+    while True:
+        try:
+            chunk = next(chunks, None)
+        except Exception as e:
+            # Any error of the sequential reader is raised by itself, errors of the file included
+            if numberOfWorkers <= 1:
+                raise
+
+            print("Could not read transforms from %s with %d processes, reading them sequentially: %r"
+                  % (dbFile, numberOfWorkers, e))
+            chunks.close()
+
+            if lastId is not None:
+                where = '(%s) AND id > %d' % (where or '1', lastId)
+
+            yield from iterSqliteTransforms(dbFile, prefix, chunkSize, where, attributes)
+            return
+
+        if chunk is None:
+            return
+
+        yield chunk
+        lastId = int(chunk[0][-1])
+
+
+def getNestedValue(obj, label):
+    """ Returns the value of a (possibly nested, e.g. '_ctfModel._defocusU') attribute of an object. """
+    for name in label.split('.'):
+        obj = getattr(obj, name)
+
+    return obj.get()
+
+
+def iterTransforms(particles, where=None, chunkSize=TRANSFORM_CHUNK_SIZE, attributes=(), numberOfWorkers=1):
+    """ Generator yielding chunks of (ids, matrices) of a set of particles, ordered by particle id and optionally
+    restricted by an SQL condition on the particle ids. If attribute labels are given, chunks also include the list
+    of their values, as with iterSqliteTransforms. The condition is given over attribute labels, as for
+    Set.iterItems, and is evaluated by sqlite while reading, so filtered out particles are never loaded. Only the
+    needed columns are queried from the set sqlite file, by numberOfWorkers processes if more than one, going on
+    sequentially if the processes fail. Sets that can not be mapped to their sqlite storage are read iterating over
+    their items. """
+    storage = getSetStorage(particles)
+    chunks = None
+
+    if storage is not None:
+        dbFile, prefix = storage
+
+        try:
+            if getSqliteColumns(dbFile, [TRANSFORM_MATRIX_LABEL] + list(attributes), prefix) is not None:
+                # Read the first chunk here, so that unreadable columns fall back before yielding anything
+                chunks = _iterSqliteTransformsSafe(dbFile, prefix, chunkSize, translateWhere(dbFile, where, prefix),
+                                                   attributes, numberOfWorkers)
+                first = next(chunks, None)
+
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            print("Could not read transforms from %s, iterating over the particles instead: %s" % (dbFile, e))
+            chunks = None
+
+    if chunks is not None:
+        if first is not None:
+            yield first
+            yield from chunks
+
+        return
+
+    def makeChunk(ids, matrices, values):
+        chunk = (np.array(ids, dtype=np.int64), np.array(matrices, dtype=np.float64))
+        return chunk + ([np.array(v) for v in values],) if attributes else chunk
+
+    ids, matrices, values = [], [], [[] for _ in attributes]
+
+    for particle in particles.iterItems(orderBy='id', where=where or '1'):
+        ids.append(particle.getObjId())
+        matrices.append(particle.getTransform().getMatrix())
+
+        for attributeValues, label in zip(values, attributes):
+            attributeValues.append(getNestedValue(particle, label))
+
+        if len(ids) == chunkSize:
+            yield makeChunk(ids, matrices, values)
+            ids, matrices, values = [], [], [[] for _ in attributes]
+
+    if ids:
+        yield makeChunk(ids, matrices, values)
+
+
+def readTransforms(particles, where=None, chunkSize=TRANSFORM_CHUNK_SIZE, attributes=(), numberOfWorkers=1):
+    """ Returns the (N,) ids and (N,4,4) transformation matrices of a set of particles, plus the list of attribute
+    values if attributes are requested, read with iterTransforms. """
+    return _concatenateChunks(list(iterTransforms(particles, where, chunkSize, attributes, numberOfWorkers)),
+                              attributes)
+
+
+def readTransformMatrices(particles, chunkSize=TRANSFORM_CHUNK_SIZE, numberOfWorkers=1):
+    """ Returns the (N,4,4) array with the transformation matrices of a set of particles, ordered by particle id. """
+    return readTransforms(particles, chunkSize=chunkSize, numberOfWorkers=numberOfWorkers)[1]
+
+
+def countTransforms(particles, where=None):
+    """ Returns the number of particles of a set, optionally restricted by an SQL condition over attribute labels. """
+    storage = getSetStorage(particles)
+
+    if storage is not None:
+        dbFile, prefix = storage
+
+        try:
+            with sqlite3.connect(dbFile) as conn:
+                return conn.execute("SELECT COUNT(*) FROM %sObjects WHERE %s"
+                                    % (prefix, translateWhere(dbFile, where, prefix) or '1')).fetchone()[0]
+
+        except (sqlite3.Error, ValueError):
+            pass
+
+    if where is None:
+        return particles.getSize()
+
+    return sum(1 for _ in particles.iterItems(where=where))
+
+
+def checkWhere(particles, where):
+    """ Evaluates an SQL condition over particle attribute labels on the first particle of a set that meets it, to
+    report mistakes in the condition (e.g. unknown attributes or syntax errors) before the particles are read. Raises
+    ValueError with the error of the set database. """
+    if not where:
+        return
+
+    storage = getSetStorage(particles)
+
+    try:
+        if storage is not None:
+            dbFile, prefix = storage
+
+            with sqlite3.connect(dbFile) as conn:
+                conn.execute("SELECT id FROM %sObjects WHERE %s LIMIT 1"
+                             % (prefix, translateWhere(dbFile, where, prefix))).fetchall()
+        else:
+            list(particles.iterItems(where=where, limit=1))
+
+    except sqlite3.Error as e:
+        raise ValueError(str(e))
+
+
+def getLastId(particles, where=None):
+    """ Returns the id of the last particle of a set, optionally restricted by an SQL condition over attribute labels,
+    or 0 if no particle meets it. """
+    storage = getSetStorage(particles)
+
+    if storage is not None:
+        dbFile, prefix = storage
+
+        try:
+            with sqlite3.connect(dbFile) as conn:
+                return conn.execute("SELECT MAX(id) FROM %sObjects WHERE %s"
+                                    % (prefix, translateWhere(dbFile, where, prefix) or '1')).fetchone()[0] or 0
+
+        except (sqlite3.Error, ValueError):
+            pass
+
+    return max((particle.getObjId() for particle in particles.iterItems(where=where or '1')), default=0)
+
+
+def writeAngles(fileName, particles, where=None, attributes=(), dtype=np.float64, chunkSize=TRANSFORM_CHUNK_SIZE,
+                numberOfWorkers=1):
+    """ Writes the (N,3) array of [psi, theta, rot] angles of a set of particles to a .npy file, converting the
+    transforms chunk by chunk, so that neither the matrices nor the angles of the whole set are ever in memory. The
+    file is meant to be read memory-mapped, with loadAngles. Returns the (N,) ids, plus the list of attribute values
+    if attributes are requested. """
+    from numpy.lib.format import open_memmap
+
+    angles = open_memmap(fileName, mode='w+', dtype=dtype, shape=(countTransforms(particles, where), 3))
+    ids, values = [], []
+    start = 0
+
+    for chunk in iterTransforms(particles, where, chunkSize, attributes, numberOfWorkers):
+        end = start + len(chunk[0])
+
+        if end > len(angles):
+            raise ValueError("The set %s has changed while its angles were written" % particles.getFileName())
+
+        angles[start:end] = getAnglesFromMatrices(chunk[1])
+        ids.append(chunk[0])
+        values.append(chunk[2] if attributes else [])
+        start = end
+
+    angles.flush()
+    del angles
+
+    if start != countTransforms(particles, where):
+        raise ValueError("The set %s has changed while its angles were written" % particles.getFileName())
+
+    if not ids:
+        ids = np.empty(0, dtype=np.int64)
+        return (ids, [np.empty(0) for _ in attributes]) if attributes else ids
+
+    if attributes:
+        return np.concatenate(ids), [np.concatenate(attributeValues) for attributeValues in zip(*values)]
+
+    return np.concatenate(ids)
+
+
+def loadAngles(fileName):
+    """ Memory-maps the angles written by writeAngles. """
+    return np.load(fileName, mmap_mode='r')
@@ -0,0 +1,943 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+In-process implementation of the SCF analysis (Baldwin and Lyumkis) working on in-memory arrays of particle angles.
+
+The projection of every particle samples the central section perpendicular to its projection direction. At a given
+Fourier radius R, a Fourier space direction k is sampled by a projection with direction n if the voxel R*k lies within
+half a voxel of that section, that is |k.n| <= 1 / (2R). The sampling S(k) counts those projections and the SCF is
+1 / (<S> <1/S>), which is 1 for a perfectly even sampling and decreases as the sampling becomes anisotropic.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from scf.constants import SCF_MIN_QUERY_DIRECTIONS, SCF_MAX_QUERY_DIRECTIONS, SCF_CHUNK_ELEMENTS, \
+    SCF_TILT_CONE_STEPS, SCF_RANDOM_SEED, SCF_ADAPTIVE_TOLERANCE, SCF_ADAPTIVE_INITIAL_SIZE, SCF_ADAPTIVE_REPLICATES, \
+    TRANSFORM_CHUNK_SIZE, SCF_DENSITY_PROJECTIONS_PER_BIN, SCF_DENSITY_MIN_BINS, SCF_DENSITY_MAX_BINS, \
+    SCF_TILT_SEARCH_TOLERANCE, SCF_TILT_SEARCH_GRID, SCF_PARTICLE_READ_BYTES, SCF_DIRECTION_BYTES, SCF_MIN_CHUNK_SIZE
+from scf import healpix
+from scf.symmetry import expandSymmetry, getGroupOrder
+
+GOLDEN_ANGLE = np.pi * (3 - np.sqrt(5))
+
+
+class ScfResult:
+    """ Values obtained from an SCF analysis. """
+
+    def __init__(self, scf, scfStar, fractionUnsampled, numberOfProjections, fourierRadius, tiltAngle=0.0,
+                 sym='', queryDirections=None, sampling=None, confidenceInterval=None, binSize=None,
+                 binningError=None):
+        self.scf = scf
+        self.scfStar = scfStar
+        self.fractionUnsampled = fractionUnsampled
+        self.numberOfProjections = numberOfProjections
+        self.fourierRadius = fourierRadius
+        self.tiltAngle = tiltAngle
+        self.sym = sym
+        self.queryDirections = queryDirections
+        self.sampling = sampling
+        self.confidenceInterval = confidenceInterval
+        self.binSize = binSize
+        self.binningError = binningError
+
+    def toLines(self):
+        """ Returns the result as the lines of text shown in the protocol summary. """
+        lines = ["Number of projections: %d" % round(self.numberOfProjections),
+                 "Symmetry: %s" % (self.sym or 'C1'),
+                 "Fourier radius: %0.2f" % self.fourierRadius,
+                 "Tilt angle: %0.2f" % self.tiltAngle,
+                 "Fraction of unsampled Fourier space: %0.4f" % self.fractionUnsampled,
+                 "SCF: %0.4f" % self.scf,
+                 "SCF*: %0.4f" % self.scfStar]
+
+        if self.confidenceInterval is not None:
+            lines.append("SCF* 95%% confidence interval: [%0.4f, %0.4f]" % self.confidenceInterval)
+
+        if self.binningError is not None:
+            lines.append("Orientation bin size: %0.2f degrees" % self.binSize)
+            lines.append("SCF binning error estimate: %0.4f" % self.binningError)
+
+        return lines
+
+    def toMetadata(self):
+        """ Returns the result values (but not the sampling arrays) as a JSON serializable dictionary. """
+        return {'scf': float(self.scf),
+                'scfStar': float(self.scfStar),
+                'fractionUnsampled': float(self.fractionUnsampled),
+                'numberOfProjections': float(self.numberOfProjections),
+                'fourierRadius': float(self.fourierRadius),
+                'tiltAngle': float(self.tiltAngle),
+                'sym': self.sym or '',
+                'confidenceInterval': None if self.confidenceInterval is None else list(self.confidenceInterval),
+                'binSize': self.binSize,
+                'binningError': self.binningError}
+
+    @classmethod
+    def fromMetadata(cls, metadata, queryDirections=None, sampling=None):
+        """ Creates a result from the values returned by toMetadata. """
+        confidenceInterval = metadata.get('confidenceInterval')
+
+        return cls(metadata['scf'], metadata['scfStar'], metadata['fractionUnsampled'],
+                   metadata['numberOfProjections'], metadata['fourierRadius'],
+                   tiltAngle=metadata.get('tiltAngle', 0.0),
+                   sym=metadata.get('sym', ''),
+                   queryDirections=queryDirections,
+                   sampling=sampling,
+                   confidenceInterval=None if confidenceInterval is None else tuple(confidenceInterval),
+                   binSize=metadata.get('binSize'),
+                   binningError=metadata.get('binningError'))
+
+
+# --------------------------- Direction functions ----------------------------
+def directionsFromAngles(angles, chunkSize=TRANSFORM_CHUNK_SIZE):
+    """ Converts an (N,3) array of [psi, theta, rot] angles in degrees, as obtained with
+    scf.convert.getAnglesFromMatrices, into the (N,3) array of projection directions (unit vectors). The angles,
+    which may be memory-mapped, are converted in chunks so that no other full copy of them is made. """
+    directions = np.empty((len(angles), 3))
+
+    for start in range(0, len(angles), chunkSize):
+        chunk = np.radians(np.asarray(angles[start:start + chunkSize], dtype=np.float64))
+        sinTheta = np.sin(chunk[:, 1])
+
+        # Third row of the szyz rotation matrix
+        directions[start:start + chunkSize, 0] = -sinTheta * np.cos(chunk[:, 0])
+        directions[start:start + chunkSize, 1] = sinTheta * np.sin(chunk[:, 0])
+        directions[start:start + chunkSize, 2] = np.cos(chunk[:, 1])
+
+    return directions
+
+
+def directionsFromMatrices(matrices):
+    """ Returns the (N,3) projection directions of an (N,4,4) or (N,3,3) stack of transformation matrices, which are
+    the same obtained with directionsFromAngles from their Euler angles. """
+    return np.asarray(matrices, dtype=np.float64)[:, 2, :3]
+
+
+def anglesFromDirections(directions):
+    """ Returns the (N,2) array of azimuth and polar angles in degrees of the given directions. """
+    azimuth = np.degrees(np.arctan2(directions[:, 1], directions[:, 0]))
+    polar = np.degrees(np.arccos(np.clip(directions[:, 2], -1, 1)))
+
+    return np.stack((azimuth, polar), axis=1)
+
+
+def eulerFromDirections(directions):
+    """ Returns the (N,3) array of [psi, theta, rot] angles in degrees whose projection direction, as given by
+    directionsFromAngles, is each of the given directions. The in-plane rotation is set to 0. """
+    psi = np.degrees(np.arctan2(directions[:, 1], -directions[:, 0]))
+    theta = np.degrees(np.arccos(np.clip(directions[:, 2], -1, 1)))
+
+    return np.stack((psi, theta, np.zeros_like(psi)), axis=1)
+
+
+def fibonacciHemisphere(n):
+    """ Returns n quasi-uniform unit vectors covering the upper hemisphere. As the sampling of a direction k equals
+    that of -k, the hemisphere is enough to evaluate it all over Fourier space. """
+    i = np.arange(n) + 0.5
+    z = i / n
+    r = np.sqrt(1 - z ** 2)
+    phi = i * GOLDEN_ANGLE
+
+    return np.stack((r * np.cos(phi), r * np.sin(phi), z), axis=1)
+
+
+def getNumberOfQueryDirections(fourierRadius, groupOrder=1):
+    """ Number of directions needed to visit every voxel of a Fourier half-shell, within the engine bounds. With
+    symmetry the sampling is the same over the whole orbit of every query direction, so groupOrder times fewer
+    directions give the same coverage. """
+    n = int(np.ceil(2 * np.pi * fourierRadius ** 2 / groupOrder))
+
+    return min(max(n, SCF_MIN_QUERY_DIRECTIONS), SCF_MAX_QUERY_DIRECTIONS)
+
+
+def getQueryDirections(fourierRadius, sym=''):
+    """ Returns the directions in which the sampling is evaluated at the given Fourier radius. """
+    return fibonacciHemisphere(getNumberOfQueryDirections(fourierRadius, getGroupOrder(sym)))
+
+
+def tiltDirections(directions, tiltAngle, steps=SCF_TILT_CONE_STEPS):
+    """ Models the tilting of the sample: as the tilt axis is random with respect to each particle, every projection
+    direction becomes a cone of half-angle tiltAngle (degrees) around it. Returns the (N*steps,3) directions, each of
+    them weighting 1/steps. """
+    tilt = np.radians(tiltAngle)
+
+    # Orthonormal basis perpendicular to every direction
+    reference = np.zeros_like(directions)
+    alignedWithX = np.abs(directions[:, 0]) > 0.9
+    reference[~alignedWithX, 0] = 1
+    reference[alignedWithX, 1] = 1
+
+    u = np.cross(directions, reference)
+    u /= np.linalg.norm(u, axis=1)[:, None]
+    v = np.cross(directions, u)
+
+    phi = np.linspace(0, 2 * np.pi, steps, endpoint=False)
+    cone = np.cos(tilt) * directions[:, None, :] + \
+        np.sin(tilt) * (np.cos(phi)[None, :, None] * u[:, None, :] + np.sin(phi)[None, :, None] * v[:, None, :])
+
+    return cone.reshape(-1, 3)
+
+
+# --------------------------- Sampling functions ----------------------------
+def computeSampling(directions, queryDirections, fourierRadius, weights=None):
+    """ Returns, for every query direction, the (weighted) number of projections whose central section samples it
+    at the given Fourier radius. Projections are processed in chunks to bound the memory used. """
+    threshold = 1.0 / (2 * fourierRadius)
+    sampling = np.zeros(len(queryDirections))
+    chunkSize = max(1, SCF_CHUNK_ELEMENTS // len(queryDirections))
+
+    for start in range(0, len(directions), chunkSize):
+        end = start + chunkSize
+        inSection = np.abs(queryDirections @ directions[start:end].T) <= threshold
+
+        if weights is None:
+            sampling += inSection.sum(axis=1)
+        else:
+            sampling += inSection @ weights[start:end]
+
+    return sampling
+
+
+def computeSamplings(directions, queryDirections, fourierRadii, weights=None):
+    """ Returns the (R,M) sampling of the query directions for several Fourier radii at once. The products between
+    query and projection directions are computed once and binned against all the radii thresholds. """
+    thresholds = 1.0 / (2 * np.asarray(fourierRadii, dtype=np.float64))
+    order = np.argsort(thresholds)
+    sortedThresholds = thresholds[order]
+
+    nRadii = len(thresholds)
+    nQuery = len(queryDirections)
+    counts = np.zeros((nQuery, nRadii + 1))
+    rowOffsets = (np.arange(nQuery) * (nRadii + 1))[:, None]
+    chunkSize = max(1, SCF_CHUNK_ELEMENTS // nQuery)
+
+    for start in range(0, len(directions), chunkSize):
+        end = start + chunkSize
+        absDots = np.abs(queryDirections @ directions[start:end].T)
+
+        # Index of the smallest threshold each product is below of, histogrammed per query direction
+        bins = np.searchsorted(sortedThresholds, absDots) + rowOffsets
+        chunkWeights = None if weights is None else np.broadcast_to(weights[start:end], absDots.shape).ravel()
+        counts += np.bincount(bins.ravel(), weights=chunkWeights, minlength=counts.size).reshape(counts.shape)
+
+    # A product below a threshold is also below all the larger ones
+    samplings = np.cumsum(counts, axis=1)[:, :nRadii].T
+
+    return samplings[np.argsort(order)]
+
+
+def computeGroupSamplings(directions, groupIndices, numberOfGroups, queryDirections, fourierRadius, weights=None):
+    """ Returns the (G,M) sampling of the query directions by each group of projections, given the group index of
+    every direction. Directions are sorted by group, so that the contribution of every group to a chunk is a single
+    reduction over contiguous columns. """
+    threshold = 1.0 / (2 * fourierRadius)
+    order = np.argsort(groupIndices, kind='stable')
+    directions = directions[order]
+    groupIndices = groupIndices[order]
+    weights = None if weights is None else weights[order]
+
+    samplings = np.zeros((len(queryDirections), numberOfGroups))
+    chunkSize = max(1, SCF_CHUNK_ELEMENTS // len(queryDirections))
+
+    for start in range(0, len(directions), chunkSize):
+        end = start + chunkSize
+        chunkGroups = groupIndices[start:end]
+        inSection = (np.abs(queryDirections @ directions[start:end].T) <= threshold).astype(np.float64)
+
+        if weights is not None:
+            inSection *= weights[start:end]
+
+        boundaries = np.flatnonzero(np.r_[True, chunkGroups[1:] != chunkGroups[:-1]])
+        samplings[:, chunkGroups[boundaries]] += np.add.reduceat(inSection, boundaries, axis=1)
+
+    return samplings.T
+
+
+def scfFromSampling(sampling):
+    """ Returns the SCF and the fraction of unsampled directions. The SCF is computed over the sampled directions and
+    scaled by the sampled fraction, so that holes in Fourier space are penalised. """
+    sampled = sampling > 0
+    fractionSampled = np.count_nonzero(sampled) / len(sampling)
+
+    if not sampled.any():
+        return 0.0, 1.0
+
+    values = sampling[sampled]
+
+    return float(fractionSampled / (values.mean() * (1 / values).mean())), float(1 - fractionSampled)
+
+
+def expectedUniformScf(numberOfProjections, fourierRadius):
+    """ SCF expected for the given number of uniformly distributed projections. The sampling of every direction then
+    follows a Poisson distribution of mean N / (2R). """
+    mean = numberOfProjections / (2.0 * fourierRadius)
+
+    if mean <= 0:
+        return 1.0
+
+    counts = np.arange(1, int(mean + 10 * np.sqrt(mean) + 20))
+    pmf = np.exp(-mean + counts * np.log(mean) - np.cumsum(np.log(counts)))
+    pSampled = pmf.sum()
+
+    return float(pSampled / ((pmf * counts).sum() / pSampled * (pmf / counts).sum() / pSampled))
+
+
+def subsampleGroups(groupIndices, numberToUse=-1):
+    """ Returns the sorted indices of a reproducible random subset of at most numberToUse members of every group,
+    or of all of them if numberToUse is -1. """
+    groupIndices = np.asarray(groupIndices)
+
+    if numberToUse <= 0:
+        return np.arange(len(groupIndices))
+
+    permutation = np.random.default_rng(SCF_RANDOM_SEED).permutation(len(groupIndices))
+    order = permutation[np.argsort(groupIndices[permutation], kind='stable')]
+    sortedGroups = groupIndices[order]
+
+    # Rank of every member within its group
+    starts = np.flatnonzero(np.r_[True, sortedGroups[1:] != sortedGroups[:-1]])
+    ranks = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+
+    return np.sort(order[ranks < numberToUse])
+
+
+def subsampleAngles(angles, numberToUse=-1, weights=None):
+    """ Returns a reproducible random subset of numberToUse angles, or all of them if numberToUse is -1. If the
+    weights of the angles are given, the weights of the subset are returned too. """
+    angles = np.asarray(angles)
+
+    if 0 < numberToUse < len(angles):
+        rng = np.random.default_rng(SCF_RANDOM_SEED)
+        subset = np.sort(rng.choice(len(angles), numberToUse, replace=False))
+        angles = angles[subset]
+        weights = None if weights is None else np.asarray(weights)[subset]
+
+    if weights is not None:
+        return angles, np.asarray(weights, dtype=np.float64)
+
+    return angles
+
+
+def checkWeights(weights, label='weight'):
+    """ Returns the projection weights as a float array, raising ValueError if any of them is negative or not a
+    number. """
+    weights = np.asarray(weights, dtype=np.float64)
+
+    if not np.isfinite(weights).all() or (weights < 0).any():
+        raise ValueError("The %s of every particle must be a non negative number" % label)
+
+    return weights
+
+
+def expandLikeDirections(values, sym='', tiltAngle=0.0):
+    """ Expands per-projection values (weights, labels...) to match the directions returned by prepareDirections. """
+    if tiltAngle:
+        return np.repeat(values, SCF_TILT_CONE_STEPS)
+
+    return np.tile(values, getGroupOrder(sym))
+
+
+def prepareDirections(projectionDirections, sym='', tiltAngle=0.0, weights=None):
+    """ Returns the directions sampling Fourier space, their weights (None if all of them weight 1) and the symmetry
+    actually applied, once the sample tilt or the symmetry have been taken into account. Projections may be given
+    weights, e.g. the counts of an orientation histogram. """
+    if tiltAngle:
+        # Tilted collections are analysed without symmetry
+        directions = tiltDirections(projectionDirections, tiltAngle)
+        coneWeights = np.ones(len(projectionDirections)) if weights is None else weights
+        return directions, expandLikeDirections(coneWeights / SCF_TILT_CONE_STEPS, tiltAngle=tiltAngle), ''
+
+    if getGroupOrder(sym) > 1:
+        directions = expandSymmetry(projectionDirections, sym)
+        return directions, None if weights is None else expandLikeDirections(weights, sym), sym
+
+    return projectionDirections, weights, sym
+
+
+def computeScf(projectionDirections, fourierRadius, sym='', tiltAngle=0.0, queryDirections=None, weights=None):
+    """ Computes the SCF of the given (optionally weighted) projection directions. Returns an ScfResult. """
+    directions, directionWeights, sym = prepareDirections(projectionDirections, sym, tiltAngle, weights)
+
+    if queryDirections is None:
+        queryDirections = getQueryDirections(fourierRadius, sym)
+
+    sampling = computeSampling(directions, queryDirections, fourierRadius, directionWeights)
+
+    scf, fractionUnsampled = scfFromSampling(sampling)
+    effectiveProjections = len(directions) if directionWeights is None else directionWeights.sum()
+    scfStar = scf / expectedUniformScf(effectiveProjections, fourierRadius)
+    numberOfProjections = len(projectionDirections) if weights is None else weights.sum()
+
+    return ScfResult(scf, scfStar, fractionUnsampled, numberOfProjections, fourierRadius,
+                     tiltAngle=tiltAngle, sym=sym, queryDirections=queryDirections, sampling=sampling)
+
+
+def runBinnedScf(histogram, coarseHistogram, fourierRadius, sym='', tiltAngle=0.0):
+    """ Computes the SCF from the weighted pixel centres of an OrientationHistogram instead of the individual
+    projections. The same analysis over a coarser histogram of the same directions gives the binning error estimate,
+    reported with the result. """
+    centres, counts = histogram.getWeightedCentres()
+    result = computeScf(centres, fourierRadius, sym=sym, tiltAngle=tiltAngle, weights=counts)
+
+    coarseCentres, coarseCounts = coarseHistogram.getWeightedCentres()
+    coarseResult = computeScf(coarseCentres, fourierRadius, sym=sym, tiltAngle=tiltAngle,
+                              queryDirections=result.queryDirections, weights=coarseCounts)
+
+    result.binningError = abs(result.scf - coarseResult.scf)
+    result.binSize = healpix.getPixelSize(histogram.nside)
+
+    return result
+
+
+def runScf(angles, fourierRadius, numberToUse=-1, sym='', tiltAngle=0.0, rootOutputName=None, weights=None):
+    """ Runs the SCF analysis over an (N,3) array of [psi, theta, rot] angles, optionally weighting every projection.
+    If rootOutputName is given, the orientation and sampling plots are saved with that prefix. Returns an
+    ScfResult. """
+    if weights is None:
+        angles = subsampleAngles(angles, numberToUse)
+    else:
+        angles, weights = subsampleAngles(angles, numberToUse, weights)
+
+    projectionDirections = directionsFromAngles(angles)
+    result = computeScf(projectionDirections, fourierRadius, sym=sym, tiltAngle=tiltAngle, weights=weights)
+
+    if rootOutputName is not None:
+        plotAngles(projectionDirections, "%sTilt%d.jpg" % (rootOutputName, tiltAngle), weights=weights)
+        plotSampling(result, "%sSamplingTilt%d.jpg" % (rootOutputName, tiltAngle))
+
+    return result
+
+
+class SamplingAccumulator:
+    """ Running sampling of Fourier space, updated as new projections are added. As the sampling is additive over
+    projections, every update only costs the new projections and the SCF is obtained from the accumulated sampling
+    in constant time. """
+
+    def __init__(self, fourierRadius, sym='', tiltAngle=0.0, queryDirections=None):
+        self.fourierRadius = fourierRadius
+        self.sym = sym
+        self.tiltAngle = tiltAngle
+
+        if queryDirections is None:
+            queryDirections = getQueryDirections(fourierRadius, '' if tiltAngle else sym)
+
+        self.queryDirections = queryDirections
+        self.sampling = np.zeros(len(queryDirections))
+        self.numberOfProjections = 0
+        self.effectiveProjections = 0.0
+
+    def add(self, projectionDirections, weights=None):
+        """ Adds the sampling of the given (optionally weighted) projection directions. """
+        directions, directionWeights, self.sym = prepareDirections(projectionDirections, self.sym, self.tiltAngle,
+                                                                   weights)
+
+        self.sampling += computeSampling(directions, self.queryDirections, self.fourierRadius, directionWeights)
+        self.numberOfProjections += len(projectionDirections) if weights is None else weights.sum()
+        self.effectiveProjections += len(directions) if directionWeights is None else directionWeights.sum()
+
+    def getResult(self):
+        """ Returns the ScfResult of the projections added so far. """
+        scf, fractionUnsampled = scfFromSampling(self.sampling)
+        scfStar = scf / expectedUniformScf(self.effectiveProjections, self.fourierRadius)
+
+        return ScfResult(scf, scfStar, fractionUnsampled, self.numberOfProjections, self.fourierRadius,
+                         tiltAngle=self.tiltAngle, sym=self.sym, queryDirections=self.queryDirections,
+                         sampling=self.sampling)
+
+    def saveCheckpoint(self, fileName, arrays=None, **metadata):
+        """ Writes the accumulated sampling, and any other given arrays and metadata, to a results file that is
+        replaced atomically, so that an interrupted analysis can be resumed from it with loadCheckpoint. """
+        arrays = dict(arrays or {}, sampling=self.sampling, queryDirections=self.queryDirections)
+
+        saveResults(fileName, arrays=arrays, fourierRadius=self.fourierRadius, sym=self.sym,
+                    tiltAngle=self.tiltAngle, numberOfProjections=float(self.numberOfProjections),
+                    effectiveProjections=float(self.effectiveProjections), **metadata)
+
+    @classmethod
+    def loadCheckpoint(cls, fileName):
+        """ Reads a checkpoint written by saveCheckpoint. Returns the accumulator, the metadata and the other arrays
+        saved with it. """
+        metadata, arrays = loadResults(fileName)
+
+        accumulator = cls(metadata['fourierRadius'], metadata['sym'], metadata['tiltAngle'],
+                          queryDirections=arrays.pop('queryDirections'))
+        accumulator.sampling = arrays.pop('sampling')
+        accumulator.numberOfProjections = metadata['numberOfProjections']
+        accumulator.effectiveProjections = metadata['effectiveProjections']
+
+        return accumulator, metadata, arrays
+
+
+def getChunkSize(memoryLimit, fourierRadius, sym='', tiltAngle=0.0):
+    """ Number of particles per chunk keeping an analysis that reads them chunk by chunk under memoryLimit bytes.
+    The sampling products take a fixed amount of memory, bounded by SCF_CHUNK_ELEMENTS, and every particle of a chunk
+    costs its reading plus the directions it expands to with the tilt cone or the symmetry. Raises ValueError if the
+    limit does not leave room for SCF_MIN_CHUNK_SIZE particles. """
+    numberOfQueryDirections = getNumberOfQueryDirections(fourierRadius, 1 if tiltAngle else getGroupOrder(sym))
+    # Products, absolute values and comparison of a chunk of directions, plus the query directions and sampling
+    fixedBytes = SCF_CHUNK_ELEMENTS * (8 + 8 + 1) + numberOfQueryDirections * 4 * 8
+    expansion = SCF_TILT_CONE_STEPS if tiltAngle else getGroupOrder(sym)
+    particleBytes = SCF_PARTICLE_READ_BYTES + expansion * SCF_DIRECTION_BYTES
+    chunkSize = int((memoryLimit - fixedBytes) // particleBytes)
+
+    if chunkSize < SCF_MIN_CHUNK_SIZE:
+        raise ValueError("A memory limit of %d MB is too low, at least %d MB are needed"
+                         % (memoryLimit // 1024 ** 2,
+                            (fixedBytes + SCF_MIN_CHUNK_SIZE * particleBytes) // 1024 ** 2 + 1))
+
+    return chunkSize
+
+
+# --------------------------- Sweep functions ----------------------------
+# Data shared by the sweep worker processes, set once per process by _initSweepWorker
+_sweepData = {}
+
+
+def _initSweepWorker(shared):
+    _sweepData.clear()
+    _sweepData.update(shared)
+
+
+def _computeSweepTilt(tiltAngle):
+    result = computeScf(_sweepData['projectionDirections'], _sweepData['fourierRadius'], tiltAngle=tiltAngle,
+                        queryDirections=_sweepData['queryDirections'])
+
+    return tiltAngle, result.scf, result.scfStar, result.fractionUnsampled
+
+
+def _mapSweep(function, values, shared, numberOfWorkers):
+    """ Evaluates function over values in a pool of numberOfWorkers processes, all of them initialized with the
+    shared dictionary. """
+    if numberOfWorkers > 1 and len(values) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=min(numberOfWorkers, len(values)),
+                                 initializer=_initSweepWorker, initargs=(shared,)) as executor:
+            return list(executor.map(function, values))
+
+    _initSweepWorker(shared)
+
+    return [function(value) for value in values]
+
+
+def runTiltSweep(angles, fourierRadius, tiltAngles, numberToUse=-1, numberOfWorkers=1):
+    """ Computes the SCF for every tilt angle. The projection and query directions are computed once and shared by
+    all the tilts, which are evaluated in parallel by numberOfWorkers processes. Symmetry is not considered, as for
+    any tilted collection. Returns an (T,4) array of [tilt, SCF, SCF*, fraction unsampled] rows. """
+    projectionDirections = directionsFromAngles(subsampleAngles(angles, numberToUse))
+    queryDirections = getQueryDirections(fourierRadius)
+
+    shared = dict(projectionDirections=projectionDirections,
+                  queryDirections=queryDirections,
+                  fourierRadius=fourierRadius)
+    rows = _mapSweep(_computeSweepTilt, list(tiltAngles), shared, numberOfWorkers)
+
+    return np.array(rows, dtype=np.float64).reshape(-1, 4)
+
+
+class TiltSearch:
+    """ Search of the tilt angle maximizing the SCF of a set of projections. The projection and query directions are
+    computed once and reused by every evaluation, and the SCF of every tilt evaluated is memoized. As for any tilted
+    collection, symmetry is not considered. """
+
+    def __init__(self, angles, fourierRadius, numberToUse=-1, numberOfWorkers=1):
+        self.fourierRadius = fourierRadius
+        self.numberOfWorkers = numberOfWorkers
+        self.projectionDirections = directionsFromAngles(subsampleAngles(angles, numberToUse))
+        self.queryDirections = getQueryDirections(fourierRadius)
+        self.memo = {}
+
+    def _getShared(self):
+        return dict(projectionDirections=self.projectionDirections,
+                    queryDirections=self.queryDirections,
+                    fourierRadius=self.fourierRadius)
+
+    def evaluate(self, tiltAngles):
+        """ Returns the SCF of every tilt angle, evaluating in parallel those not in the memo. """
+        tiltAngles = [round(float(tiltAngle), 6) for tiltAngle in tiltAngles]
+        pending = sorted(set(tiltAngles) - set(self.memo))
+
+        for row in _mapSweep(_computeSweepTilt, pending, self._getShared(), self.numberOfWorkers):
+            self.memo[row[0]] = row
+
+        return [self.memo[tiltAngle][1] for tiltAngle in tiltAngles]
+
+    def search(self, tiltStart, tiltStop, tolerance=SCF_TILT_SEARCH_TOLERANCE, gridSize=SCF_TILT_SEARCH_GRID):
+        """ Brackets the best tilt in [tiltStart, tiltStop] evaluating a coarse grid of gridSize tilts, and refines it
+        with a golden-section search until the bracket is narrower than tolerance (degrees). Returns the best tilt. """
+        grid = np.linspace(tiltStart, tiltStop, gridSize)
+        scf = self.evaluate(grid)
+        best = int(np.argmax(scf))
+        low, high = grid[max(best - 1, 0)], grid[min(best + 1, len(grid) - 1)]
+
+        ratio = (np.sqrt(5) - 1) / 2
+        left, right = high - ratio * (high - low), low + ratio * (high - low)
+
+        while high - low > tolerance:
+            scfLeft, scfRight = self.evaluate([left, right])
+
+            if scfLeft >= scfRight:
+                high, right = right, left
+                left = high - ratio * (high - low)
+            else:
+                low, left = left, right
+                right = low + ratio * (high - low)
+
+        # The best tilt evaluated, which includes the grid points around the bracket
+        return max(self.memo, key=lambda tiltAngle: (self.memo[tiltAngle][1], -tiltAngle))
+
+    def getResult(self, tiltAngle):
+        """ Returns the ScfResult, including the sampling, of the given tilt. """
+        return computeScf(self.projectionDirections, self.fourierRadius, tiltAngle=tiltAngle,
+                          queryDirections=self.queryDirections)
+
+    def getEvaluations(self):
+        """ Returns the (T,4) array of [tilt, SCF, SCF*, fraction unsampled] rows of every tilt evaluated, sorted by
+        tilt. """
+        return np.array([self.memo[tiltAngle] for tiltAngle in sorted(self.memo)], dtype=np.float64).reshape(-1, 4)
+
+
+def runTiltSearch(angles, fourierRadius, tiltStart=0.0, tiltStop=60.0, numberToUse=-1,
+                  tolerance=SCF_TILT_SEARCH_TOLERANCE, numberOfWorkers=1):
+    """ Searches the tilt angle maximizing the SCF. Returns the ScfResult of the best tilt, the ScfResult of the
+    untilted collection (without symmetry, so that both are comparable) and the (T,4) rows of every evaluation, as
+    returned by runTiltSweep. """
+    search = TiltSearch(angles, fourierRadius, numberToUse, numberOfWorkers)
+    bestTilt = search.search(tiltStart, tiltStop, tolerance)
+
+    return search.getResult(bestTilt), search.getResult(0.0), search.getEvaluations()
+
+
+def runResolutionSweep(angles, fourierRadii, numberToUse=-1, sym='', tiltAngle=0.0):
+    """ Computes the SCF at every Fourier radius in a single pass over the projection directions, which are
+    evaluated over a query grid fine enough for the largest radius. Returns an (R,4) array of
+    [Fourier radius, SCF, SCF*, fraction unsampled] rows. """
+    projectionDirections = directionsFromAngles(subsampleAngles(angles, numberToUse))
+    directions, weights, sym = prepareDirections(projectionDirections, sym, tiltAngle)
+    effectiveProjections = len(directions) if weights is None else weights.sum()
+
+    queryDirections = getQueryDirections(max(fourierRadii), sym)
+    samplings = computeSamplings(directions, queryDirections, fourierRadii, weights)
+
+    rows = []
+
+    for fourierRadius, sampling in zip(fourierRadii, samplings):
+        scf, fractionUnsampled = scfFromSampling(sampling)
+        scfStar = scf / expectedUniformScf(effectiveProjections, fourierRadius)
+        rows.append((fourierRadius, scf, scfStar, fractionUnsampled))
+
+    return np.array(rows, dtype=np.float64).reshape(-1, 4)
+
+
+def runGroupedScf(angles, groups, fourierRadius, numberToUse=-1, sym='', tiltAngle=0.0):
+    """ Computes the SCF of every group of projections, e.g. 3D classes or micrographs, in a single pass over the
+    projection directions. At most numberToUse projections of every group are used. Returns the sorted unique group
+    values and the (G,4) array of [number of projections, SCF, SCF*, fraction unsampled] rows. """
+    groupValues, groupIndices = np.unique(np.asarray(groups), return_inverse=True)
+    groupIndices = groupIndices.ravel()
+
+    selection = subsampleGroups(groupIndices, numberToUse)
+    projectionDirections = directionsFromAngles(np.asarray(angles)[selection])
+    groupIndices = groupIndices[selection]
+
+    directions, weights, sym = prepareDirections(projectionDirections, sym, tiltAngle)
+    directionGroups = expandLikeDirections(groupIndices, sym, tiltAngle)
+
+    queryDirections = getQueryDirections(fourierRadius, sym)
+    samplings = computeGroupSamplings(directions, directionGroups, len(groupValues), queryDirections,
+                                      fourierRadius, weights)
+
+    counts = np.bincount(groupIndices, minlength=len(groupValues))
+    effectiveFactor = len(directions) / max(len(projectionDirections), 1) if weights is None else 1.0
+    rows = []
+
+    for count, sampling in zip(counts, samplings):
+        scf, fractionUnsampled = scfFromSampling(sampling)
+        scfStar = scf / expectedUniformScf(count * effectiveFactor, fourierRadius)
+        rows.append((count, scf, scfStar, fractionUnsampled))
+
+    return groupValues, np.array(rows, dtype=np.float64).reshape(-1, 4)
+
+
+def _computeReplicate(seed):
+    directions = _sweepData['projectionDirections']
+    subset = directions[np.random.default_rng(seed).choice(len(directions), _sweepData['size'], replace=False)]
+
+    return computeScf(subset, _sweepData['fourierRadius'], sym=_sweepData['sym'],
+                      tiltAngle=_sweepData['tiltAngle'], queryDirections=_sweepData['queryDirections']).scfStar
+
+
+def runAdaptiveScf(angles, fourierRadius, sym='', tiltAngle=0.0, tolerance=SCF_ADAPTIVE_TOLERANCE,
+                   initialSize=SCF_ADAPTIVE_INITIAL_SIZE, replicates=SCF_ADAPTIVE_REPLICATES, numberOfWorkers=1):
+    """ Computes the SCF on growing random subsets of the projections, doubling their size until two consecutive
+    SCF* estimates differ less than tolerance or all the projections are used. SCF* is used as it does not drift with
+    the subset size. As subsets are nested, every step only adds the sampling of the new projections.
+
+    The 95% confidence interval of SCF* is estimated from the spread of replicates of the final subset, computed in
+    parallel by numberOfWorkers processes. Replicates are drawn without replacement, as repeated projections would
+    bias the sampling: from the whole set if the subset is smaller, or as half-size subsets otherwise, whose spread is
+    then scaled by 1/sqrt(2). Returns the ScfResult and the (S,4) array of
+    [number of projections, SCF, SCF*, fraction unsampled] rows of every step. """
+    allDirections = directionsFromAngles(angles)
+    order = np.random.default_rng(SCF_RANDOM_SEED).permutation(len(allDirections))
+
+    accumulator = SamplingAccumulator(fourierRadius, sym=sym, tiltAngle=tiltAngle)
+    history = []
+    size = 0
+
+    while size < len(order):
+        newSize = min(max(2 * size, initialSize), len(order))
+        accumulator.add(allDirections[order[size:newSize]])
+        size = newSize
+
+        result = accumulator.getResult()
+        history.append((size, result.scf, result.scfStar, result.fractionUnsampled))
+
+        if len(history) > 1 and abs(history[-1][2] - history[-2][2]) <= tolerance:
+            break
+
+    if replicates > 0:
+        halfSize = size == len(allDirections)
+        shared = dict(projectionDirections=allDirections,
+                      size=max(1, size // 2) if halfSize else size,
+                      queryDirections=accumulator.queryDirections,
+                      fourierRadius=fourierRadius, sym=sym, tiltAngle=tiltAngle)
+        estimates = _mapSweep(_computeReplicate, list(range(1, replicates + 1)), shared, numberOfWorkers)
+
+        margin = 1.96 * np.std(estimates, ddof=1 if replicates > 1 else 0) / (np.sqrt(2) if halfSize else 1)
+        result.confidenceInterval = (result.scfStar - margin, result.scfStar + margin)
+
+    return result, np.array(history, dtype=np.float64)
+
+
+def _computeBatchItem(item):
+    projectionDirections, fourierRadius = item
+    result = computeScf(projectionDirections, fourierRadius, sym=_sweepData['sym'], tiltAngle=_sweepData['tiltAngle'],
+                        queryDirections=_sweepData['queryDirections'].get(fourierRadius))
+
+    return len(projectionDirections), result.scf, result.scfStar, result.fractionUnsampled
+
+
+def runBatchScf(anglesList, fourierRadii, numberToUse=-1, sym='', tiltAngle=0.0, numberOfWorkers=1):
+    """ Computes the SCF of several sets of angles, each one at its Fourier radius, in parallel by numberOfWorkers
+    processes. Symmetry operators and query directions are built once and shared by all the sets. Returns an (S,4)
+    array of [number of projections, SCF, SCF*, fraction unsampled] rows. """
+    querySym = '' if tiltAngle else sym
+
+    # Build the cached operators before the pool is created, so that the workers inherit them
+    getGroupOrder(querySym)
+
+    shared = dict(sym=sym, tiltAngle=tiltAngle,
+                  queryDirections={radius: getQueryDirections(radius, querySym) for radius in set(fourierRadii)})
+    items = [(directionsFromAngles(subsampleAngles(angles, numberToUse)), radius)
+             for angles, radius in zip(anglesList, fourierRadii)]
+
+    rows = _mapSweep(_computeBatchItem, items, shared, numberOfWorkers)
+
+    return np.array(rows, dtype=np.float64).reshape(-1, 4)
+
+
+# --------------------------- Result file functions ----------------------------
+def saveResults(fileName, result=None, curve=None, labels=None, arrays=None, **metadata):
+    """ Writes the results of an analysis to a numpy .npz file: the result values and any other run metadata as a
+    JSON string, the sampling of the query directions, the optional (n,4) curve of [x, SCF, SCF*, fraction
+    unsampled] rows, the optional labels of the curve rows and any other named arrays. The file is replaced
+    atomically, so it can be read while it is being updated. """
+    arrays = dict(arrays or {})
+
+    if result is not None:
+        metadata.update(result.toMetadata())
+
+        if result.sampling is not None:
+            arrays['sampling'] = np.asarray(result.sampling, dtype=np.float64)
+            arrays['queryDirections'] = np.asarray(result.queryDirections, dtype=np.float64)
+
+    if curve is not None:
+        arrays['curve'] = np.asarray(curve, dtype=np.float64).reshape(-1, 4)
+
+    if labels is not None:
+        arrays['labels'] = np.array([str(label) for label in labels])
+
+    arrays['metadata'] = np.array(json.dumps(metadata))
+
+    tmpFile = fileName + '.tmp'
+
+    with open(tmpFile, 'wb') as f:
+        np.savez(f, **arrays)
+
+    os.replace(tmpFile, fileName)
+
+
+def loadResults(fileName):
+    """ Reads a results file written by saveResults. Returns the metadata dictionary and the dictionary with the
+    arrays stored in the file. """
+    with np.load(fileName, allow_pickle=False) as data:
+        arrays = {name: data[name] for name in data.files}
+
+    return json.loads(str(arrays.pop('metadata'))), arrays
+
+
+def loadResult(fileName):
+    """ Returns the ScfResult stored in a results file, or None if it only contains a curve. """
+    metadata, arrays = loadResults(fileName)
+
+    if 'scf' not in metadata:
+        return None
+
+    return ScfResult.fromMetadata(metadata, arrays.get('queryDirections'), arrays.get('sampling'))
+
+
+# --------------------------- Orientation density functions ----------------------------
+def getDensityEdges(numberOfProjections):
+    """ Returns the azimuth and polar angle bin edges (degrees) of an orientation density map. Bins get finer as the
+    number of projections grows, keeping a similar number of projections per bin. """
+    polarBins = int(np.clip(np.sqrt(numberOfProjections / SCF_DENSITY_PROJECTIONS_PER_BIN),
+                            SCF_DENSITY_MIN_BINS, SCF_DENSITY_MAX_BINS))
+
+    return np.linspace(-180, 180, 2 * polarBins + 1), np.linspace(0, 180, polarBins + 1)
+
+
+def _histogramDirections(directions, weights, edges):
+    """ Adds up the (weighted) directions falling in every azimuth and polar angle bin. """
+    angles = anglesFromDirections(directions)
+
+    return np.histogram2d(angles[:, 0], angles[:, 1], bins=edges, weights=weights)[0]
+
+
+def computeOrientationDensity(angles, weights=None, tiltAngle=0.0, maxProjections=None,
+                              chunkSize=TRANSFORM_CHUNK_SIZE):
+    """ Returns the density map of the projection directions of an (N,3) array of [psi, theta, rot] angles, with its
+    azimuth and polar angle edges. Angles and weights may be memory-mapped arrays: they are read in chunks, so the
+    memory used does not depend on the number of projections. Above maxProjections, an evenly strided subset is used
+    and its density scaled back to the whole set. With a tilt angle, every projection counts as its cone of
+    directions, as in the analysis. """
+    step = 1 if not maxProjections else max(1, -(-len(angles) // maxProjections))
+    angles = angles[::step]
+    weights = None if weights is None else weights[::step]
+
+    edges = getDensityEdges(len(angles))
+    density = np.zeros((len(edges[0]) - 1, len(edges[1]) - 1))
+
+    for start in range(0, len(angles), chunkSize):
+        end = start + chunkSize
+        chunkWeights = None if weights is None else np.asarray(weights[start:end], dtype=np.float64)
+        directions, chunkWeights, _ = prepareDirections(directionsFromAngles(angles[start:end]),
+                                                        tiltAngle=tiltAngle, weights=chunkWeights)
+        density += _histogramDirections(directions, chunkWeights, edges)
+
+    return density * step, edges
+
+
+# --------------------------- Plot functions ----------------------------
+def _newFigure():
+    """ Figure not attached to any GUI backend, so plots can be saved from the protocol process. """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figure = Figure(figsize=(8, 5))
+    FigureCanvasAgg(figure)
+
+    return figure
+
+
+def drawDensity(ax, density, edges, title='Projection directions'):
+    """ Draws an orientation density map, as computed by computeOrientationDensity, on the given axes. """
+    from matplotlib.colors import LogNorm
+
+    mesh = ax.pcolormesh(edges[0], edges[1], np.ma.masked_equal(density.T, 0), norm=LogNorm(), cmap='viridis')
+    ax.figure.colorbar(mesh, ax=ax, label='Number of projections')
+
+    ax.set_xlabel('Azimuth (degrees)')
+    ax.set_ylabel('Polar angle (degrees)')
+    ax.set_title(title)
+
+
+def drawSampling(ax, result):
+    """ Draws the sampling of the Fourier half-shell of a result as a map over its query directions. """
+    angles = anglesFromDirections(result.queryDirections)
+    scatter = ax.scatter(angles[:, 0], angles[:, 1], c=result.sampling, s=4, cmap='viridis')
+    ax.figure.colorbar(scatter, ax=ax, label='Sampling')
+
+    ax.set_xlabel('Azimuth (degrees)')
+    ax.set_ylabel('Polar angle (degrees)')
+    ax.set_title('Fourier space sampling (SCF = %0.3f, SCF* = %0.3f)' % (result.scf, result.scfStar))
+
+
+def drawSweep(ax, sweep, xLabel, title):
+    """ Draws the SCF and SCF* curves of a sweep as a function of its first column. """
+    ax.plot(sweep[:, 0], sweep[:, 1], 'o-', label='SCF')
+    ax.plot(sweep[:, 0], sweep[:, 2], 's--', label='SCF*')
+
+    ax.set_xlabel(xLabel)
+    ax.set_ylabel('SCF')
+    ax.set_title(title)
+    ax.legend()
+    ax.grid(True, alpha=0.3)
+
+
+def plotAngles(directions, fileName, weights=None):
+    """ Saves the distribution of (optionally weighted) projection directions as an azimuth vs polar angle density
+    plot. """
+    figure = _newFigure()
+
+    edges = getDensityEdges(len(directions))
+    drawDensity(figure.add_subplot(111), _histogramDirections(directions, weights, edges), edges)
+    figure.savefig(fileName)
+
+
+def plotSampling(result, fileName):
+    """ Saves the sampling of the Fourier half-shell as a map over the query directions. """
+    figure = _newFigure()
+    drawSampling(figure.add_subplot(111), result)
+    figure.savefig(fileName)
+
+
+def plotSweep(sweep, xLabel, title, fileName):
+    """ Saves the SCF and SCF* curves of a sweep as a function of its first column. """
+    figure = _newFigure()
+    drawSweep(figure.add_subplot(111), sweep, xLabel, title)
+    figure.savefig(fileName)
+
+
+def plotBatch(labels, rows, fileName):
+    """ Saves the SCF and SCF* of several sets as a bar plot. """
+    figure = _newFigure()
+    ax = figure.add_subplot(111)
+
+    x = np.arange(len(labels))
+    ax.bar(x - 0.2, rows[:, 1], width=0.4, label='SCF')
+    ax.bar(x + 0.2, rows[:, 2], width=0.4, label='SCF*')
+
+    ax.set_xticks(x)
+    ax.set_xticklabels(labels, rotation=45, ha='right')
+    ax.set_ylabel('SCF')
+    ax.set_title('SCF of the input sets')
+    ax.legend()
+    figure.tight_layout()
+    figure.savefig(fileName)
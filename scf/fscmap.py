@@ -0,0 +1,179 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Directional resolution from a 3D FSC map (Tan et al. 2017) and its correlation with the sampling of Fourier space.
+
+The 3D FSC map holds, for every Fourier space voxel, the FSC in a cone around its direction, with the zero frequency
+at the centre of the box. The map is read memory-mapped in slabs, so its whole volume is never in memory, and the FSC
+is averaged over every Fourier shell and every direction of a HEALPix grid. The directional resolution is given by the
+first shell where the FSC of each direction falls below the threshold, and it is correlated with the sampling of
+that direction by the particle projections.
+"""
+
+import numpy as np
+
+from scf import engine
+from scf import healpix
+from scf.constants import SCF_CHUNK_ELEMENTS, SCF_FSC_MAP_NSIDE, SCF_FSC_THRESHOLD
+
+
+class DirectionalResolution:
+    """ Directional resolution of a 3D FSC map and sampling of the same directions. """
+
+    def __init__(self, directions, resolution, sampling, correlation):
+        self.directions = directions
+        self.resolution = resolution
+        self.sampling = sampling
+        self.correlation = correlation
+
+    def toLines(self):
+        """ Returns the result as the lines of text shown in the protocol summary. """
+        return ["Directional resolution (3D FSC): %0.2f - %0.2f A (mean %0.2f A)"
+                % (self.resolution.min(), self.resolution.max(), self.resolution.mean()),
+                "Correlation of sampling and directional resolution (Spearman): %0.4f" % self.correlation]
+
+
+def openMap(fileName):
+    """ Opens an MRC map memory-mapped, read only. Its data is read from disk as it is accessed. """
+    import mrcfile
+
+    return mrcfile.mmap(fileName, mode='r', permissive=True)
+
+
+def accumulateShellFsc(data, nside=SCF_FSC_MAP_NSIDE):
+    """ Returns the sum of the FSC values and the number of voxels of every (shell, HEALPix pixel) of a centred (N,N,N)
+    3D FSC map, as two (N/2, pixels) arrays. Shell 0 is the origin. The map, which may be memory-mapped, is processed
+    in slabs of z planes bounded to SCF_CHUNK_ELEMENTS voxels. Directions are folded onto the upper hemisphere, as
+    the FSC of a direction equals that of the opposite one. """
+    size = data.shape[-1]
+    centre = size // 2
+    numberOfShells = size // 2
+    numberOfPixels = healpix.getNumberOfPixels(nside)
+
+    sums = np.zeros(numberOfShells * numberOfPixels)
+    counts = np.zeros(numberOfShells * numberOfPixels)
+
+    slabSize = max(1, SCF_CHUNK_ELEMENTS // (size * size))
+    y, x = np.mgrid[0:size, 0:size] - centre
+
+    for start in range(0, size, slabSize):
+        values = np.asarray(data[start:start + slabSize], dtype=np.float64)
+        z = np.arange(start, start + len(values))[:, None, None] - centre
+
+        k = np.stack(np.broadcast_arrays(x[None], y[None], z), axis=-1).reshape(-1, 3).astype(np.float64)
+        radius = np.linalg.norm(k, axis=1)
+        shells = np.rint(radius).astype(np.int64)
+        inside = (shells > 0) & (shells < numberOfShells)
+
+        directions = k[inside] / radius[inside, None]
+        directions[directions[:, 2] < 0] *= -1
+        bins = shells[inside] * numberOfPixels + healpix.vec2pix(nside, directions)
+
+        sums += np.bincount(bins, weights=values.reshape(-1)[inside], minlength=len(sums))
+        counts += np.bincount(bins, minlength=len(counts))
+
+    return sums.reshape(numberOfShells, numberOfPixels), counts.reshape(numberOfShells, numberOfPixels)
+
+
+def getDirectionalResolution(sums, counts, boxSize, samplingRate, threshold=SCF_FSC_THRESHOLD):
+    """ Returns the indices of the HEALPix pixels with FSC values and their resolution in A: that of the last shell
+    before the mean FSC falls below the threshold, or the Nyquist resolution if it never does. """
+    pixels = np.flatnonzero(counts[1:].sum(axis=0) > 0)
+    meanFsc = sums[1:, pixels] / np.maximum(counts[1:, pixels], 1)
+    below = (meanFsc < threshold) & (counts[1:, pixels] > 0)
+
+    # Shells are numbered from 1, the first one below the threshold limits the resolution
+    lastShell = np.where(below.any(axis=0), below.argmax(axis=0), len(meanFsc))
+    lastShell = np.maximum(lastShell, 1)
+
+    return pixels, boxSize * samplingRate / lastShell
+
+
+def averageRanks(values):
+    """ Ranks (starting at 0) of the values, tied values getting the average of the ranks they span, as
+    scipy.stats.rankdata(method='average') minus one. """
+    values = np.asarray(values)
+    order = np.argsort(values, kind='stable')
+    sortedValues = values[order]
+
+    starts = np.flatnonzero(np.r_[True, sortedValues[1:] != sortedValues[:-1]])
+    ends = np.r_[starts[1:], len(values)]
+
+    ranks = np.empty(len(values))
+    ranks[order] = np.repeat((starts + ends - 1) / 2.0, ends - starts)
+
+    return ranks
+
+
+def spearmanCorrelation(x, y):
+    """ Spearman rank correlation of two arrays. Tied values, frequent in the directional resolution that only takes
+    the values of the Fourier shells, get their average rank so that the result does not depend on their order. """
+    rankX = averageRanks(x)
+    rankY = averageRanks(y)
+
+    if rankX.std() == 0 or rankY.std() == 0:
+        return 0.0
+
+    return float(np.corrcoef(rankX, rankY)[0, 1])
+
+
+def analyseFscMap(data, samplingRate, projectionDirections, fourierRadius, sym='', tiltAngle=0.0, weights=None,
+                  nside=SCF_FSC_MAP_NSIDE, threshold=SCF_FSC_THRESHOLD):
+    """ Computes the directional resolution of a (memory-mapped) 3D FSC map, the sampling of the same directions by
+    the given (optionally weighted) projection directions at the given Fourier radius, and their correlation.
+    Returns a DirectionalResolution. """
+    sums, counts = accumulateShellFsc(data, nside)
+    pixels, resolution = getDirectionalResolution(sums, counts, data.shape[-1], samplingRate, threshold)
+    directions = healpix.pix2vec(nside, pixels)
+
+    samplingDirections, samplingWeights, _ = engine.prepareDirections(projectionDirections, sym, tiltAngle, weights)
+    sampling = engine.computeSampling(samplingDirections, directions, fourierRadius, samplingWeights)
+
+    return DirectionalResolution(directions, resolution, sampling, spearmanCorrelation(sampling, resolution))
+
+
+def plotDirectionalResolution(result, fileName):
+    """ Saves the directional resolution as a map over the directions and as a function of their sampling. """
+    figure = engine._newFigure()
+    angles = engine.anglesFromDirections(result.directions)
+
+    ax = figure.add_subplot(121)
+    scatter = ax.scatter(angles[:, 0], angles[:, 1], c=result.resolution, s=12, cmap='viridis_r')
+    figure.colorbar(scatter, ax=ax, label='Resolution (A)')
+    ax.set_xlabel('Azimuth (degrees)')
+    ax.set_ylabel('Polar angle (degrees)')
+    ax.set_title('Directional resolution')
+
+    ax = figure.add_subplot(122)
+    ax.scatter(result.sampling, result.resolution, s=8)
+    ax.set_xlabel('Sampling')
+    ax.set_ylabel('Resolution (A)')
+    ax.set_title('Spearman correlation: %0.3f' % result.correlation)
+    ax.grid(True, alpha=0.3)
+
+    figure.tight_layout()
+    figure.savefig(fileName)
@@ -0,0 +1,133 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Equal-area pixelization of the sphere following the HEALPix RING scheme (Gorski et al. 2005), used to histogram
+projection directions so that the cost of the SCF analysis does not depend on the number of particles.
+"""
+
+import numpy as np
+
+
+def getNumberOfPixels(nside):
+    return 12 * nside ** 2
+
+
+def getPixelSize(nside):
+    """ Approximate angular size of the pixels in degrees. """
+    return np.degrees(np.sqrt(4 * np.pi / getNumberOfPixels(nside)))
+
+
+def vec2pix(nside, vectors):
+    """ Returns the RING index of the pixel containing every (N,3) unit vector. """
+    z = np.clip(vectors[:, 2], -1, 1)
+    za = np.abs(z)
+    tt = np.mod(np.arctan2(vectors[:, 1], vectors[:, 0]), 2 * np.pi) / (np.pi / 2)  # in [0, 4)
+
+    pixels = np.empty(len(vectors), dtype=np.int64)
+
+    # Equatorial region
+    equatorial = za <= 2.0 / 3
+    t1 = nside * (0.5 + tt[equatorial])
+    t2 = nside * z[equatorial] * 0.75
+    jp = (t1 - t2).astype(np.int64)
+    jm = (t1 + t2).astype(np.int64)
+    ring = nside + 1 + jp - jm
+    shift = 1 - (ring & 1)
+    ip = np.mod((jp + jm - nside + shift + 1) // 2, 4 * nside)
+    pixels[equatorial] = 2 * nside * (nside - 1) + (ring - 1) * 4 * nside + ip
+
+    # Polar caps
+    polar = ~equatorial
+    tp = tt[polar] - np.floor(tt[polar])
+    tmp = nside * np.sqrt(3 * (1 - za[polar]))
+    jp = (tp * tmp).astype(np.int64)
+    jm = ((1 - tp) * tmp).astype(np.int64)
+    ring = jp + jm + 1
+    ip = np.mod((tt[polar] * ring).astype(np.int64), 4 * ring)
+    pixels[polar] = np.where(z[polar] > 0,
+                             2 * ring * (ring - 1) + ip,
+                             getNumberOfPixels(nside) - 2 * ring * (ring + 1) + ip)
+
+    return pixels
+
+
+def pix2vec(nside, pixels):
+    """ Returns the (N,3) unit vectors pointing to the centres of the given RING pixels. """
+    pixels = np.asarray(pixels, dtype=np.int64)
+    nPixels = getNumberOfPixels(nside)
+    nCap = 2 * nside * (nside - 1)
+
+    z = np.empty(len(pixels))
+    phi = np.empty(len(pixels))
+
+    north = pixels < nCap
+    ring = ((1 + np.sqrt(1 + 2 * pixels[north])) / 2).astype(np.int64)
+    iphi = pixels[north] + 1 - 2 * ring * (ring - 1)
+    z[north] = 1 - ring ** 2 / (3.0 * nside ** 2)
+    phi[north] = (iphi - 0.5) * np.pi / (2 * ring)
+
+    south = pixels >= nPixels - nCap
+    ip = nPixels - pixels[south]
+    ring = ((1 + np.sqrt(2 * ip - 1)) / 2).astype(np.int64)
+    iphi = 4 * ring + 1 - (ip - 2 * ring * (ring - 1))
+    z[south] = -1 + ring ** 2 / (3.0 * nside ** 2)
+    phi[south] = (iphi - 0.5) * np.pi / (2 * ring)
+
+    equatorial = ~(north | south)
+    ip = pixels[equatorial] - nCap
+    ring = ip // (4 * nside) + nside
+    iphi = np.mod(ip, 4 * nside) + 1
+    odd = 0.5 * (1 + np.mod(ring + nside, 2))
+    z[equatorial] = (2 * nside - ring) * 2.0 / (3 * nside)
+    phi[equatorial] = (iphi - odd) * np.pi / (2 * nside)
+
+    r = np.sqrt(1 - z ** 2)
+
+    return np.stack((r * np.cos(phi), r * np.sin(phi), z), axis=1)
+
+
+class OrientationHistogram:
+    """ Histogram of projection directions over a HEALPix grid of the given nside (a power of two). As the central
+    section of a direction equals that of the opposite one, directions are folded onto the upper hemisphere. """
+
+    def __init__(self, nside):
+        self.nside = nside
+        self.counts = np.zeros(getNumberOfPixels(nside))
+
+    def add(self, directions, weights=None):
+        """ Adds the given directions to the histogram. """
+        directions = np.where(directions[:, 2:3] < 0, -directions, directions)
+        self.counts += np.bincount(vec2pix(self.nside, directions), weights=weights, minlength=len(self.counts))
+
+    def getTotal(self):
+        return self.counts.sum()
+
+    def getWeightedCentres(self):
+        """ Returns the centres of the non-empty pixels and their counts. """
+        pixels = np.flatnonzero(self.counts)
+
+        return pix2vec(self.nside, pixels), self.counts[pixels]
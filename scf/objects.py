@@ -0,0 +1,231 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+from pyworkflow.object import Boolean, CsvList, Float, Integer, String
+from pwem.objects import EMObject
+
+from scf.engine import ScfResult
+
+
+class ScfCurve(EMObject):
+    """ SCF values as a function of a swept parameter, e.g. the analysis resolution or the tilt angle. """
+
+    def __init__(self, **kwargs):
+        EMObject.__init__(self, **kwargs)
+        self._xLabel = String(kwargs.get('xLabel', None))
+        self._x = CsvList(pType=float)
+        self._scf = CsvList(pType=float)
+        self._scfStar = CsvList(pType=float)
+        self._fractionUnsampled = CsvList(pType=float)
+
+    def getXLabel(self):
+        return self._xLabel.get()
+
+    def setXLabel(self, xLabel):
+        self._xLabel.set(xLabel)
+
+    def loadFromSweep(self, x, sweep):
+        """ Fills the curve from the [x, SCF, SCF*, fraction unsampled] rows computed by scf.engine. """
+        self._x.set(list(map(float, x)))
+        self._scf.set(list(map(float, sweep[:, 1])))
+        self._scfStar.set(list(map(float, sweep[:, 2])))
+        self._fractionUnsampled.set(list(map(float, sweep[:, 3])))
+
+    def getData(self):
+        """ Returns the x, SCF, SCF* and fraction unsampled lists. """
+        return list(self._x), list(self._scf), list(self._scfStar), list(self._fractionUnsampled)
+
+    def getSummaryLines(self):
+        """ Returns one line per point of the curve, as shown in the protocol summary. """
+        x, scf, scfStar, _ = self.getData()
+
+        return ["%s: %0.2f\tSCF: %0.4f\tSCF*: %0.4f" % (self.getXLabel(), *values) for values in zip(x, scf, scfStar)]
+
+
+class ScfAnalysis(EMObject):
+    """ Result of an SCF analysis: the SCF values and the parameters of the run. The sampling of every query direction
+    and any curve of the analysis are stored in the results file. """
+
+    def __init__(self, **kwargs):
+        EMObject.__init__(self, **kwargs)
+        self._mode = String()
+        self._fileName = String()
+        self._symmetry = String()
+        self._resolution = Float()
+        self._fourierRadius = Float()
+        self._tiltAngle = Float()
+        self._numberOfProjections = Integer()
+        self._scf = Float()
+        self._scfStar = Float()
+        self._fractionUnsampled = Float()
+        self._confidenceLow = Float()
+        self._confidenceHigh = Float()
+        self._binSize = Float()
+        self._binningError = Float()
+        self._converged = Boolean()
+        self._fscCorrelation = Float()
+        self._fscResolutionMin = Float()
+        self._fscResolutionMax = Float()
+        self._bestTiltAngle = Float()
+        self._untiltedScf = Float()
+        self._scfGain = Float()
+
+    def getMode(self):
+        return self._mode.get()
+
+    def getFileName(self):
+        """ Returns the .npz file written by scf.engine.saveResults. """
+        return self._fileName.get()
+
+    def setFileName(self, fileName):
+        self._fileName.set(fileName)
+
+    def getSymmetry(self):
+        return self._symmetry.get()
+
+    def getResolution(self):
+        return self._resolution.get()
+
+    def getFourierRadius(self):
+        return self._fourierRadius.get()
+
+    def getTiltAngle(self):
+        return self._tiltAngle.get()
+
+    def getNumberOfProjections(self):
+        return self._numberOfProjections.get()
+
+    def getScf(self):
+        return self._scf.get()
+
+    def getScfStar(self):
+        return self._scfStar.get()
+
+    def getFractionUnsampled(self):
+        return self._fractionUnsampled.get()
+
+    def getConfidenceInterval(self):
+        """ Returns the 95% confidence interval of SCF*, or None if it was not estimated. """
+        if not self._confidenceLow.hasValue():
+            return None
+
+        return self._confidenceLow.get(), self._confidenceHigh.get()
+
+    def getBinningError(self):
+        return self._binningError.get()
+
+    def isConverged(self):
+        return self._converged.get()
+
+    def getBestTiltAngle(self):
+        """ Returns the tilt angle maximizing the SCF, if it was searched or swept. """
+        return self._bestTiltAngle.get()
+
+    def getUntiltedScf(self):
+        return self._untiltedScf.get()
+
+    def getScfGain(self):
+        """ Returns the SCF gain of collecting at the best tilt angle over an untilted collection, if it was
+        searched. """
+        return self._scfGain.get()
+
+    def getFscCorrelation(self):
+        """ Returns the Spearman correlation of the sampling and the directional resolution of the 3D FSC map, if it
+        was given. """
+        return self._fscCorrelation.get()
+
+    def setFscResults(self, metadata):
+        """ Sets the values of the 3D FSC map analysis, from the metadata of its results file. """
+        self._fscCorrelation.set(metadata['correlation'])
+        self._fscResolutionMin.set(metadata['resolutionMin'])
+        self._fscResolutionMax.set(metadata['resolutionMax'])
+
+    def hasScf(self):
+        """ Whether the analysis produced a single SCF value, rather than only a curve. """
+        return self._scf.hasValue()
+
+    def setFromMetadata(self, metadata):
+        """ Fills the attributes from the metadata of a results file written by scf.engine.saveResults. """
+        self._mode.set(metadata.get('mode'))
+        self._symmetry.set(metadata.get('sym') or 'C1')
+        self._resolution.set(metadata.get('resolution'))
+        self._fourierRadius.set(metadata.get('fourierRadius'))
+        self._tiltAngle.set(metadata.get('tiltAngle'))
+        self._scf.set(metadata.get('scf'))
+        self._scfStar.set(metadata.get('scfStar'))
+        self._fractionUnsampled.set(metadata.get('fractionUnsampled'))
+        self._binSize.set(metadata.get('binSize'))
+        self._binningError.set(metadata.get('binningError'))
+        self._converged.set(metadata.get('converged'))
+        self._bestTiltAngle.set(metadata.get('bestTiltAngle'))
+        self._untiltedScf.set(metadata.get('untiltedScf'))
+        self._scfGain.set(metadata.get('scfGain'))
+
+        if metadata.get('numberOfProjections') is not None:
+            self._numberOfProjections.set(round(metadata['numberOfProjections']))
+
+        if metadata.get('confidenceInterval') is not None:
+            self._confidenceLow.set(metadata['confidenceInterval'][0])
+            self._confidenceHigh.set(metadata['confidenceInterval'][1])
+
+    def getResult(self):
+        """ Returns the values as a scf.engine.ScfResult, without the sampling arrays, or None if the analysis only
+        produced a curve. """
+        if not self.hasScf():
+            return None
+
+        return ScfResult(self.getScf(), self.getScfStar(), self.getFractionUnsampled(),
+                         self.getNumberOfProjections(), self.getFourierRadius(),
+                         tiltAngle=self.getTiltAngle() or 0.0,
+                         sym=self.getSymmetry(),
+                         confidenceInterval=self.getConfidenceInterval(),
+                         binSize=self._binSize.get(),
+                         binningError=self.getBinningError())
+
+    def getSummaryLines(self):
+        """ Returns the lines shown in the protocol summary. """
+        result = self.getResult()
+        lines = result.toLines() if result is not None else []
+
+        if self._converged.hasValue() and not self.isConverged():
+            lines.append("SCF* did not converge using all the particles.")
+
+        if self._bestTiltAngle.hasValue():
+            lines.append("Recommended tilt angle: %0.2f" % self.getBestTiltAngle())
+
+        # Only the tilt search compares the best tilt angle with an untilted collection
+        if self._scfGain.hasValue():
+            lines.append("Predicted SCF gain over an untilted collection: %+0.4f (%0.4f -> %0.4f)"
+                         % (self.getScfGain(), self.getUntiltedScf(), self.getScf()))
+
+        if self._fscCorrelation.hasValue():
+            lines.append("Directional resolution (3D FSC): %0.2f - %0.2f A" % (self._fscResolutionMin.get(),
+                                                                              self._fscResolutionMax.get()))
+            lines.append("Correlation of sampling and directional resolution (Spearman): %0.4f"
+                         % self.getFscCorrelation())
+
+        return lines
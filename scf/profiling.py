@@ -0,0 +1,165 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Instrumentation of the protocol steps: wall time, CPU time (including the child processes, e.g. the external SCF
+script), peak resident memory and particle throughput of every step, optionally with a cProfile dump.
+"""
+
+import cProfile
+import functools
+import json
+import os
+import resource
+import time
+
+
+def resetPeakMemory():
+    """ Resets the peak resident memory of the process, when supported by the kernel (Linux). """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def getPeakMemory():
+    """ Returns the peak resident memory of the process in MB, or None if not available. """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return None
+
+
+def _getCpuTimes():
+    """ Returns the CPU time used by the process and by its finished child processes, in seconds. """
+    times = os.times()
+
+    return times.user + times.system, times.children_user + times.children_system
+
+
+class StepMeter:
+    """ Context manager measuring the resources used by the code it runs. If profileFile is given, the code is also
+    profiled with cProfile and the statistics are dumped to that file. """
+
+    def __init__(self, profileFile=None):
+        self.profileFile = profileFile
+        self.profile = None
+        self.metrics = {}
+
+    def __enter__(self):
+        resetPeakMemory()
+        self._start = time.perf_counter()
+        self._cpu, self._childrenCpu = _getCpuTimes()
+
+        if self.profileFile:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+        return self
+
+    def __exit__(self, *exc):
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.profileFile)
+
+        cpu, childrenCpu = _getCpuTimes()
+
+        self.metrics = {'wallTime': time.perf_counter() - self._start,
+                        'cpuTime': cpu - self._cpu,
+                        'childrenCpuTime': childrenCpu - self._childrenCpu,
+                        'peakRss': getPeakMemory(),
+                        # Largest resident memory of any child process finished so far
+                        'childrenPeakRss': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+        return False
+
+
+def setStepParticles(protocol, count):
+    """ Records the number of particles processed by the running instrumented step, to compute its throughput. """
+    protocol._stepParticles = count
+
+
+def instrumentedStep(step):
+    """ Decorator of protocol steps recording their StepMeter metrics in the protocol _stepMetrics String attribute,
+    as JSON keyed by step name. The throughput is computed from the number of particles the step reports with
+    setStepParticles, steps that do not report it (e.g. those only registering outputs) have no throughput. When the
+    protocol profileSteps parameter is set, each step is profiled to profile_<step>.prof in the extra directory. """
+    @functools.wraps(step)
+    def wrapper(protocol, *args, **kwargs):
+        profile = getattr(protocol, 'profileSteps', None)
+        profileFile = protocol._getExtraPath('profile_%s.prof' % step.__name__) \
+            if profile is not None and profile.get() else None
+
+        protocol._stepParticles = None
+
+        with StepMeter(profileFile) as meter:
+            result = step(protocol, *args, **kwargs)
+
+        metrics = meter.metrics
+        particles = protocol._stepParticles
+
+        if particles:
+            metrics['particles'] = particles
+            metrics['throughput'] = particles / max(metrics['wallTime'], 1e-9)
+
+        allMetrics = json.loads(protocol._stepMetrics.get() or '{}')
+        allMetrics[step.__name__] = metrics
+        protocol._stepMetrics.set(json.dumps(allMetrics))
+        protocol._store(protocol._stepMetrics)
+
+        return result
+
+    return wrapper
+
+
+def getMetricsLines(stepMetrics):
+    """ Returns the summary lines of the metrics recorded by instrumentedStep, given the value of _stepMetrics. """
+    lines = []
+
+    for stepName, metrics in json.loads(stepMetrics or '{}').items():
+        line = "Step %s: wall %0.2f s, CPU %0.2f s" % (stepName, metrics['wallTime'], metrics['cpuTime'])
+
+        if metrics.get('childrenCpuTime'):
+            line += " (+%0.2f s in child processes)" % metrics['childrenCpuTime']
+
+        if metrics.get('peakRss') is not None:
+            line += ", peak RSS %0.0f MB" % metrics['peakRss']
+
+        if metrics.get('childrenCpuTime'):
+            line += " (%0.0f MB in child processes)" % metrics['childrenPeakRss']
+
+        if metrics.get('throughput'):
+            line += ", %0.0f particles/s" % metrics['throughput']
+
+        lines.append(line)
+
+    return lines
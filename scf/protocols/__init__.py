@@ -25,4 +25,6 @@
 # **************************************************************************
 
 from .protocol_scf import ScfProtAnalysis
+from .protocol_scf_streaming import ScfProtStreamingAnalysis
+from .protocol_scf_batch import ScfProtBatchAnalysis
 
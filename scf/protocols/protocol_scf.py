@@ -26,15 +26,69 @@
 # **************************************************************************
 
 
-import csv
 from math import degrees
 import os.path
 
+import numpy as np
+
 from pwem.convert.transformations import euler_from_matrix
-from pyworkflow.object import String
-from pyworkflow.protocol.params import FloatParam, IntParam, PointerParam, StringParam
+from pyworkflow.object import Integer, String
+from pyworkflow.protocol.params import BooleanParam, EnumParam, FloatParam, IntParam, PointerParam, StringParam, \
+    LEVEL_ADVANCED
 from pwem.protocols import ProtAnalysis3D
 from scf import Plugin
+from scf import engine
+from scf import fscmap
+from scf import symmetry
+from scf.constants import SCF_OUT_OF_CORE_MEMORY_LIMIT, SCF_TILT_SEARCH_TOLERANCE, TRANSFORM_CHUNK_SIZE, \
+    ANALYSIS_MODES, MODE_SINGLE, MODE_ADAPTIVE, MODE_BINNED, MODE_OUT_OF_CORE, MODE_GROUPED, MODE_RESOLUTION_SWEEP, \
+    MODE_TILT_SWEEP, MODE_TILT_SEARCH, MODE_EXTERNAL_SCRIPT, SUBSET_MODES, WEIGHTED_MODES
+from scf.convert import checkWhere, countTransforms, getNestedValue, iterTransforms, loadAngles, readTransforms, \
+    writeAngles
+from scf.healpix import OrientationHistogram
+from scf.objects import ScfAnalysis, ScfCurve
+from scf.profiling import getMetricsLines, instrumentedStep, setStepParticles
+
+# Summary lines read from the output files of finished runs, with the (modification time, size) of the file
+_summaryCache = {}
+
+
+def readSummaryLines(fileName, readLines, useCache=False):
+    """ Returns the summary lines obtained with readLines(fileName), or None if the file does not exist. If useCache,
+    the lines are kept in memory and the file is only read again when its modification time or size change, so that
+    redrawing the summary of finished runs does not read their files again. """
+    try:
+        stat = os.stat(fileName) if fileName else None
+    except OSError:
+        stat = None
+
+    if stat is None:
+        _summaryCache.pop(fileName, None)
+        return None
+
+    if not useCache:
+        return readLines(fileName)
+
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = _summaryCache.get(fileName)
+
+    if cached is None or cached[0] != stamp:
+        cached = stamp, readLines(fileName)
+        _summaryCache[fileName] = cached
+
+    return list(cached[1])
+
+
+def _readTextLines(fileName):
+    with open(fileName, 'r') as f:
+        return [line.rstrip('\n') for line in f]
+
+
+def _readResultLines(fileName):
+    analysis = ScfAnalysis()
+    analysis.setFromMetadata(engine.loadResults(fileName)[0])
+
+    return analysis.getSummaryLines()
 
 
 class ScfProtAnalysis(ProtAnalysis3D):
@@ -48,6 +102,9 @@ class ScfProtAnalysis(ProtAnalysis3D):
     def __init__(self, **args):
         ProtAnalysis3D.__init__(self, **args)
         self._outputInfoFileSCF = String("")
+        self._cacheKey = String("")
+        self._stepMetrics = String("")
+        self._numberOfParticles = Integer()
 
     # --------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -71,9 +128,93 @@ class ScfProtAnalysis(ProtAnalysis3D):
                       label='Symmetry',
                       help='Options Icos, Oct, Tet, Cn, or Dn. If tilt specified, then Sym =C1.')
 
+        form.addParam('analysisMode',
+                      EnumParam,
+                      choices=ANALYSIS_MODES,
+                      default=MODE_SINGLE,
+                      label='Analysis',
+                      help='Single SCF: SCF of a random subset of the particles of the given size.\n'
+                           'Adaptive number of projections: compute the SCF on growing random subsets of the '
+                           'particles until the SCF* estimate is stable within the given tolerance. Small sets finish '
+                           'early and large ones use as many projections as needed.\n'
+                           'Binned orientations: histogram the projection directions of all the particles over an '
+                           'equal-area (HEALPix) grid and compute the SCF from the weighted bin centres. The cost of '
+                           'the analysis then depends on the grid size instead of the number of particles, so whole '
+                           'sets can be analysed without subsampling. An estimate of the binning error is reported.\n'
+                           'Out-of-core: read all the particles in chunks sized to fit the memory limit, accumulating '
+                           'the sampling of Fourier space chunk by chunk, so that sets of any size are analysed '
+                           'without subsampling and without being held in memory. The accumulated sampling is '
+                           'checkpointed after every chunk, and a continued run resumes from the last completed '
+                           'chunk. The projection directions are kept as a histogram over the grid of the given '
+                           'order. The results cache is not used.\n'
+                           'Grouped by attribute: SCF of every group of particles sharing the value of an attribute.\n'
+                           'Resolution sweep: SCF at several resolutions in a single run, to see how the sampling '
+                           'attenuation changes across Fourier shells.\n'
+                           'Tilt sweep: SCF for a range of tilt angles, to choose the stage tilt of a data '
+                           'collection. As for any tilted collection, symmetry is not considered.\n'
+                           'Tilt search: search the tilt angle within the tilt range that maximizes the SCF, and '
+                           'report the gain over an untilted collection. Instead of evaluating every step of a sweep, '
+                           'the best tilt is bracketed in a coarse grid and refined with a golden-section search.\n'
+                           'External SCF script: run the original SCFJan2022.py script instead of the in-process '
+                           'implementation. The angles are then written to a text file and the script is launched '
+                           'in a new process. Useful to cross-validate both implementations.')
+
+        form.addParam('resolutionList',
+                      StringParam,
+                      default='3-10:1',
+                      condition='analysisMode == %d' % MODE_RESOLUTION_SWEEP,
+                      label='Resolutions (A)',
+                      help='Resolutions to analyse, as a list of values (e.g. "3 4 5 8") and/or ranges given as '
+                           'first-last:step (e.g. "3-10:0.5"). The step defaults to 1.')
+
+        form.addParam('convergenceTolerance',
+                      FloatParam,
+                      default=0.01,
+                      condition='analysisMode == %d' % MODE_ADAPTIVE,
+                      label='Convergence tolerance',
+                      help='Maximum change of SCF* between two consecutive subsets (each one doubling the size of the '
+                           'previous one) to consider the estimate converged.')
+
+        form.addParam('numberOfReplicates',
+                      IntParam,
+                      default=20,
+                      condition='analysisMode == %d' % MODE_ADAPTIVE,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Number of replicates',
+                      help='Number of random replicates of the final subset used to estimate the 95% confidence '
+                           'interval of SCF*. They are computed in parallel using the protocol threads. Set to 0 to '
+                           'skip the confidence interval.')
+
+        form.addParam('groupBy',
+                      StringParam,
+                      default='',
+                      condition='analysisMode == %d' % MODE_GROUPED,
+                      label='Group by attribute',
+                      help='Particle attribute whose value defines the groups, e.g. _classId for 3D classes, _micId '
+                           'for micrographs or _rlnOpticsGroup for optics groups. Nested attributes are given with '
+                           'dots, e.g. _coordinate._micName. The number of projections then applies to every group.')
+
+        form.addParam('memoryLimit',
+                      IntParam,
+                      default=SCF_OUT_OF_CORE_MEMORY_LIMIT,
+                      condition='analysisMode == %d' % MODE_OUT_OF_CORE,
+                      label='Memory limit (MB)',
+                      help='Approximate maximum memory used by the analysis, which sets the number of particles read '
+                           'in every chunk.')
+
+        form.addParam('healpixOrder',
+                      IntParam,
+                      default=6,
+                      condition='analysisMode in (%d, %d)' % (MODE_BINNED, MODE_OUT_OF_CORE),
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Grid order',
+                      help='The grid has 12*4^order bins. Order 5 gives bins of about 1.8 degrees and each increase '
+                           'of the order halves the bin size.')
+
         form.addParam('numberToUse',
                       IntParam,
                       default=1000,
+                      condition='analysisMode in %s' % (SUBSET_MODES,),
                       label='Number of projections',
                       help='The number of projections to use, if you do not want to use all of them. The default value '
                            'is the minimum of 10000 or the total number in the file. One can try to increase this '
@@ -82,53 +223,474 @@ class ScfProtAnalysis(ProtAnalysis3D):
         form.addParam('tiltAngle',
                       FloatParam,
                       default=0.0,
+                      condition='analysisMode not in (%d, %d)' % (MODE_TILT_SWEEP, MODE_TILT_SEARCH),
                       label='Tilt angle',
                       help='Tilting of the sample in silico.')
 
-        # Not implemented yet
-        # --3DFSCMap eventually we will look at correlations of the resolution and the sampling
+        line = form.addLine('Tilt range',
+                            condition='analysisMode in (%d, %d)' % (MODE_TILT_SWEEP, MODE_TILT_SEARCH),
+                            help='First, last and step of the tilt angles (degrees) to sweep. The search only uses the '
+                                 'first and last angles.')
+        line.addParam('tiltStart', FloatParam, default=0.0, label='Start')
+        line.addParam('tiltStop', FloatParam, default=50.0, label='Stop')
+        line.addParam('tiltStep', FloatParam, default=5.0, label='Step')
+
+        form.addParam('tiltTolerance',
+                      FloatParam,
+                      default=SCF_TILT_SEARCH_TOLERANCE,
+                      condition='analysisMode == %d' % MODE_TILT_SEARCH,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Tilt search tolerance (degrees)',
+                      help='The search stops when the best tilt is known within this number of degrees.')
+
+        form.addParam('particleFilter',
+                      StringParam,
+                      default='',
+                      label='Filter particles',
+                      help='Optional SQL condition over the particle attributes selecting the particles to analyse, '
+                           'e.g. _rlnMaxValueProbDistribution > 0.5 or _classId IN (1, 3). Nested attributes are '
+                           'given with dots. The condition is evaluated by the set database while the particles are '
+                           'read, so no filtered subset needs to be created.')
+
+        form.addParam('weightBy',
+                      StringParam,
+                      default='',
+                      condition='analysisMode in %s' % (WEIGHTED_MODES,),
+                      label='Weight by attribute',
+                      help='Optional particle attribute weighting the contribution of every particle to the sampling '
+                           'of Fourier space, e.g. _rlnMaxValueProbDistribution or _rlnLogLikeliContribution. Weights '
+                           'must not be negative. It is read together with the transforms.')
+
+        form.addParam('fscMap',
+                      PointerParam,
+                      pointerClass='Volume',
+                      allowsNull=True,
+                      condition='analysisMode != %d' % MODE_EXTERNAL_SCRIPT,
+                      label='3D FSC map (optional)',
+                      help='3D FSC map of the reconstruction (e.g. from the 3DFSC program), with the zero frequency at '
+                           'the centre of the box. Its directional resolution is correlated with the sampling of '
+                           'every direction by the particles. The map is read memory-mapped, one slab at a time, '
+                           'so large maps do not need to fit in memory. Requires the mrcfile package.')
+
+        form.addParam('useCache',
+                      BooleanParam,
+                      default=True,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Use results cache',
+                      help='Reuse the results of a previous analysis of the same particle orientations with the same '
+                           'parameters. The cache location (by default ~/.cache/scipion-em-scf) and maximum size are '
+                           'set with the SCF_CACHE_DIR and SCF_CACHE_MAX_SIZE (MB) variables. If the cache can not '
+                           'be read or written the analysis goes on without it.')
+
+        form.addParam('singlePrecisionAngles',
+                      BooleanParam,
+                      default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Single precision angles',
+                      help='Store the particle angles in single precision, halving the size of the angles file and '
+                           'the memory used to read it, at a precision of about 1e-5 degrees.')
+
+        form.addParam('profileSteps',
+                      BooleanParam,
+                      default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Profile steps',
+                      help='Profile every step with cProfile, writing the statistics to profile_<step>.prof in the '
+                           'extra directory. They can be inspected with pstats or tools such as snakeviz. The time, '
+                           'CPU and memory used by every step are always shown in the summary.')
+
+        form.addParallelSection(threads=4, mpi=0)
 
     # -------------------------- INSERT steps functions ---------------------
     def _insertAllSteps(self):
         self._insertFunctionStep(self.generateSideInfo)
         self._insertFunctionStep(self.runScfAnalysis)
 
+        if self._hasFscMap():
+            self._insertFunctionStep(self.analyseFscMapStep)
+
+        self._insertFunctionStep(self.createOutputStep)
+
     # --------------------------- STEPS functions ----------------------------
+    @instrumentedStep
     def generateSideInfo(self):
         """ Generates side information and input files to feed the SCF algorithm """
 
         # Generates the angle information file of the particles to feed the SCF algorithm
         self._outputInfoFileSCF = String(self._getExtraPath("outputInfoFileSCF.txt"))
 
-        particles = self.inParticles.get()
+        mode = self._getMode()
 
-        angles = []
+        if mode == MODE_BINNED:
+            # The histogram is built in a single pass over the particles, which are never all in memory
+            self._histograms = self._buildHistograms()
+            orientations = [self._histograms[0].counts]
+            self._numberOfParticles.set(countTransforms(self.inParticles.get(), self._getWhere()))
+            setStepParticles(self, self._numberOfParticles.get())
+        elif mode == MODE_OUT_OF_CORE:
+            # The particles are only read by the analysis, chunk by chunk
+            orientations = None
+            self._numberOfParticles.set(countTransforms(self.inParticles.get(), self._getWhere()))
+        else:
+            # The angles are written chunk by chunk and then memory-mapped, they are used by the analysis, the viewer
+            # and to resume the protocol without reading the particles again
+            attributes = [label for label in (self._getGroupBy(), self._getWeightBy()) if label]
+            ids = writeAngles(self._getAnglesFile(), self.inParticles.get(), where=self._getWhere(),
+                              attributes=attributes,
+                              dtype=np.float32 if self.singlePrecisionAngles.get() else np.float64,
+                              numberOfWorkers=self.numberOfThreads.get())
 
-        for p in particles:
-            matrix = p.getTransform().getMatrix()
+            self._angles = loadAngles(self._getAnglesFile())
+            orientations = [self._angles]
 
-            psi, theta, rot = self.getAnglesFromMatrix(matrix)
+            if self._getGroupBy():
+                self._groups = ids[1][0]
+                orientations.append(self._groups)
 
-            angles.append([psi, theta, rot])
+            if self._getWeightBy():
+                weights = engine.checkWeights(ids[1][-1], self._getWeightBy())
+                np.save(self._getAngleWeightsFile(), weights)
+                orientations.append(weights)
 
-        outputAnglesFile = self._getExtraPath("particleAngles.txt")
+            self._numberOfParticles.set(len(self._angles))
+            setStepParticles(self, len(self._angles))
 
-        with open(outputAnglesFile, 'w') as f:
-            csvW = csv.writer(f, delimiter='\t')
-            csvW.writerows(angles)
+        if self._useCache():
+            self._cacheKey.set(self._computeCacheKey(*orientations))
 
         # Converts the input resolution to fourier radius
-        self.fourierRadius = (self.inParticles.get().getSamplingRate() / self.resolutionAnalysis.get()) * 2 * self.inParticles.get().getFirstItem().getXDim()
+        self.fourierRadius = self._getFourierRadius()
 
         self._store()
 
+    @instrumentedStep
     def runScfAnalysis(self):
         """ Compute the SCF analysis """
+        cache = Plugin.getCache() if self._useCache() else None
+
+        if cache is not None:
+            try:
+                if cache.restore(self._cacheKey.get(), self._getExtraPath(), exclude=self._getCacheExcludedFiles()):
+                    print("SCF results restored from the cache entry %s" % self._cacheKey.get())
+                    return
+            except OSError as e:
+                print("Could not restore the SCF results from the cache, computing them: %s" % e)
+
+        runFunctions = {MODE_SINGLE: self._runNativeScf,
+                        MODE_ADAPTIVE: self._runAdaptiveScf,
+                        MODE_BINNED: self._runBinnedScf,
+                        MODE_OUT_OF_CORE: self._runOutOfCoreScf,
+                        MODE_GROUPED: self._runGroupedScf,
+                        MODE_RESOLUTION_SWEEP: self._runResolutionSweep,
+                        MODE_TILT_SWEEP: self._runTiltSweep,
+                        MODE_TILT_SEARCH: self._runTiltSearch,
+                        MODE_EXTERNAL_SCRIPT: self._runExternalScf}
+        # Every analysis returns the number of particles it used, which is not the number of input particles when
+        # they are subsampled or, in the out-of-core analysis, when it resumes from a checkpoint
+        setStepParticles(self, runFunctions[self._getMode()]())
+
+        if cache is not None:
+            try:
+                cache.store(self._cacheKey.get(), self._getExtraPath(), exclude=self._getCacheExcludedFiles())
+            except OSError as e:
+                print("Could not store the SCF results in the cache: %s" % e)
+
+    @instrumentedStep
+    def analyseFscMapStep(self):
+        """ Correlate the directional resolution of the 3D FSC map with the sampling of every direction """
+        volume = self.fscMap.get()
+        weights = self._getWeights()
+        # Binned orientations are always used whole, as in the analysis
+        numberToUse = -1 if self._isBinned() else self.numberToUse.get()
+
+        if weights is None:
+            angles = engine.subsampleAngles(self._getAngles(), numberToUse)
+        else:
+            angles, weights = engine.subsampleAngles(self._getAngles(), numberToUse, weights)
+
+        # The binned orientations stand for all the particles
+        setStepParticles(self, self._numberOfParticles.get() if self._isBinned() else len(angles))
+
+        with fscmap.openMap(volume.getFileName().split(':')[0]) as mrc:
+            result = fscmap.analyseFscMap(mrc.data,
+                                          volume.getSamplingRate(),
+                                          engine.directionsFromAngles(angles),
+                                          self._getFourierRadius(),
+                                          sym=self.sym.get(),
+                                          tiltAngle=self._getAnalysisTiltAngle(),
+                                          weights=weights)
+
+        fscmap.plotDirectionalResolution(result, self._getExtraPath("scfFscMap.jpg"))
+        engine.saveResults(self._getFscMapResultsFile(),
+                           arrays={'directions': result.directions,
+                                   'resolution': result.resolution,
+                                   'sampling': result.sampling},
+                           correlation=result.correlation,
+                           resolutionMin=float(result.resolution.min()),
+                           resolutionMax=float(result.resolution.max()))
+
+        self._printInfo(result.toLines())
+
+    @instrumentedStep
+    def createOutputStep(self):
+        """ Registers the SCF values and any curve of the analysis, read from the results file, as protocol outputs """
+        # The external script only writes its text output
+        if not os.path.exists(self._getResultsFile()):
+            return
+
+        metadata, arrays = engine.loadResults(self._getResultsFile())
+
+        analysis = ScfAnalysis()
+        analysis.setFromMetadata(metadata)
+        analysis.setFileName(self._getResultsFile())
+
+        if os.path.exists(self._getFscMapResultsFile()):
+            analysis.setFscResults(engine.loadResults(self._getFscMapResultsFile())[0])
+
+        outputs = {'outputScf': analysis}
+
+        if 'curve' in arrays:
+            curve = ScfCurve(xLabel=metadata['xLabel'])
+            curve.loadFromSweep(arrays['curve'][:, 0], arrays['curve'])
+            outputs[metadata['curveName']] = curve
+
+        self._defineOutputs(**outputs)
+
+        for output in outputs.values():
+            self._defineSourceRelation(self.inParticles, output)
+
+    def _runNativeScf(self):
+        """ Compute the SCF analysis in-process from the particle angles """
+        result = engine.runScf(self._getAngles(),
+                               self._getFourierRadius(),
+                               numberToUse=self.numberToUse.get(),
+                               sym=self.sym.get(),
+                               tiltAngle=self.tiltAngle.get(),
+                               rootOutputName=self._getExtraPath("particleAngles"),
+                               weights=self._getWeights())
+
+        self._saveResults('native', result)
+        self._printInfo(result.toLines())
+
+        return self._getNumberToAnalyse()
+
+    def _runAdaptiveScf(self):
+        """ Compute the SCF analysis on growing subsets of particles until convergence """
+        result, history = engine.runAdaptiveScf(self._getAngles(),
+                                                self._getFourierRadius(),
+                                                sym=self.sym.get(),
+                                                tiltAngle=self.tiltAngle.get(),
+                                                tolerance=self.convergenceTolerance.get(),
+                                                replicates=self.numberOfReplicates.get(),
+                                                numberOfWorkers=self.numberOfThreads.get())
+
+        engine.plotSweep(history, 'Number of particles', 'SCF convergence', self._getExtraPath("scfConvergence.jpg"))
+        engine.plotSampling(result, self._getExtraPath("particleAnglesSamplingTilt%d.jpg" % self.tiltAngle.get()))
+
+        converged = len(history) > 1 and abs(history[-1][2] - history[-2][2]) <= self.convergenceTolerance.get()
+
+        self._saveResults('adaptive', result, curve=history, curveName='outputScfConvergenceCurve',
+                          xLabel='Number of particles', converged=bool(converged))
+
+        lines = result.toLines()
+
+        if not converged:
+            lines.append("SCF* did not converge within %0.4f using all the particles."
+                         % self.convergenceTolerance.get())
+
+        self._printInfo(lines)
+
+        return int(history[-1][0])
+
+    def _runBinnedScf(self):
+        """ Compute the SCF analysis from the histogram of projection directions """
+        histograms = getattr(self, '_histograms', None) or self._buildHistograms()
+
+        result = engine.runBinnedScf(*histograms,
+                                     self._getFourierRadius(),
+                                     sym=self.sym.get(),
+                                     tiltAngle=self.tiltAngle.get())
+
+        centres, counts = histograms[0].getWeightedCentres()
+        np.save(self._getAnglesFile(), engine.eulerFromDirections(centres))
+        np.save(self._getAngleWeightsFile(), counts)
+
+        engine.plotAngles(centres, self._getExtraPath("particleAnglesTilt%d.jpg" % self.tiltAngle.get()),
+                          weights=counts)
+        engine.plotSampling(result, self._getExtraPath("particleAnglesSamplingTilt%d.jpg" % self.tiltAngle.get()))
+
+        self._saveResults('binned', result)
+        self._printInfo(result.toLines())
+
+        return self._numberOfParticles.get()
+
+    def _runOutOfCoreScf(self):
+        """ Compute the SCF analysis reading the particles in chunks that fit the memory limit. The accumulated
+        sampling and histogram of projection directions are checkpointed after every chunk, together with the id of
+        its last particle, so that the analysis resumes from the last completed chunk """
+        fourierRadius = self._getFourierRadius()
+        parameters = self._getCheckpointParameters()
+        histogram = OrientationHistogram(2 ** self.healpixOrder.get())
+        checkpointFile = self._getCheckpointFile()
+        accumulator, lastId = None, None
+        numberOfParticles = 0
+
+        if os.path.exists(checkpointFile):
+            checkpoint, metadata, arrays = engine.SamplingAccumulator.loadCheckpoint(checkpointFile)
+
+            if metadata['parameters'] == parameters:
+                accumulator, lastId = checkpoint, metadata['lastId']
+                histogram.counts = arrays['histogram']
+                print("Resuming the analysis after particle %d, %d particles already analysed"
+                      % (lastId, accumulator.numberOfProjections))
+            else:
+                print("Ignoring the checkpoint of an analysis with different parameters or input particles")
+
+        if accumulator is None:
+            accumulator = engine.SamplingAccumulator(fourierRadius, sym=self.sym.get(),
+                                                     tiltAngle=self.tiltAngle.get())
+
+        chunkSize = engine.getChunkSize(self.memoryLimit.get() * 1024 ** 2, fourierRadius, sym=self.sym.get(),
+                                        tiltAngle=self.tiltAngle.get())
+        print("Reading the particles in chunks of %d" % chunkSize)
+
+        # Chunks are read one at a time, parallel readers would hold several of them in memory
+        for chunk in iterTransforms(self.inParticles.get(), where=self._getWhere(lastId), chunkSize=chunkSize,
+                                    attributes=self._getWeightAttributes()):
+            ids, directions, weights = chunk[0], engine.directionsFromMatrices(chunk[1]), self._getChunkWeights(chunk)
+            accumulator.add(directions, weights)
+            histogram.add(directions, weights)
+            numberOfParticles += len(ids)
+
+            accumulator.saveCheckpoint(checkpointFile, arrays={'histogram': histogram.counts},
+                                       parameters=parameters, lastId=int(ids[-1]))
+            print("%d particles analysed" % accumulator.numberOfProjections, flush=True)
+
+        result = accumulator.getResult()
+
+        centres, counts = histogram.getWeightedCentres()
+        np.save(self._getAnglesFile(), engine.eulerFromDirections(centres))
+        np.save(self._getAngleWeightsFile(), counts)
+
+        engine.plotAngles(centres, self._getExtraPath("particleAnglesTilt%d.jpg" % self.tiltAngle.get()),
+                          weights=counts)
+        engine.plotSampling(result, self._getExtraPath("particleAnglesSamplingTilt%d.jpg" % self.tiltAngle.get()))
+
+        self._saveResults('outOfCore', result, chunkSize=chunkSize)
+        self._printInfo(result.toLines())
+
+        return numberOfParticles
+
+    def _runGroupedScf(self):
+        """ Compute the SCF analysis of every group of particles in a single pass """
+        groups = getattr(self, '_groups', None)
+
+        if groups is None:
+            _, _, (groups,) = readTransforms(self.inParticles.get(), where=self._getWhere(),
+                                             attributes=[self.groupBy.get()],
+                                             numberOfWorkers=self.numberOfThreads.get())
+
+        groupValues, rows = engine.runGroupedScf(self._getAngles(),
+                                                 groups,
+                                                 self._getFourierRadius(),
+                                                 numberToUse=self.numberToUse.get(),
+                                                 sym=self.sym.get(),
+                                                 tiltAngle=self.tiltAngle.get())
+
+        engine.plotBatch([str(value) for value in groupValues], rows, self._getExtraPath("scfGroups.jpg"))
+
+        # Numeric group values are used as x, otherwise the group number
+        try:
+            x = np.asarray(groupValues, dtype=np.float64)
+        except ValueError:
+            x = np.arange(1, len(groupValues) + 1)
+
+        curve = np.column_stack((x, rows[:, 1:]))
+        self._saveResults('grouped', curve=curve, labels=groupValues, counts=rows[:, 0].tolist(),
+                          curveName='outputScfGroupCurve', xLabel=self.groupBy.get())
+
+        self._printInfo(["%s %s: %d particles\tSCF: %0.4f\tSCF*: %0.4f" % (self.groupBy.get(), value, *row[:3])
+                         for value, row in zip(groupValues, rows)])
+
+        return int(rows[:, 0].sum())
+
+    def _runTiltSweep(self):
+        """ Compute the SCF analysis for every tilt angle of the sweep """
+        sweep = engine.runTiltSweep(self._getAngles(),
+                                    self._getFourierRadius(),
+                                    self._getTiltAngles(),
+                                    numberToUse=self.numberToUse.get(),
+                                    numberOfWorkers=self.numberOfThreads.get())
+
+        engine.plotSweep(sweep, 'Tilt angle (degrees)', 'SCF vs tilt angle', self._getExtraPath("scfTiltSweep.jpg"))
+
+        best = sweep[sweep[:, 1].argmax()]
+        self._saveResults('tiltSweep', curve=sweep, curveName='outputScfTiltCurve', xLabel='Tilt angle (degrees)',
+                          bestTiltAngle=float(best[0]))
+
+        lines = ["Tilt angle: %0.2f\tSCF: %0.4f\tSCF*: %0.4f" % tuple(row[:3]) for row in sweep]
+        lines.append("Best tilt angle: %0.2f (SCF: %0.4f)" % (best[0], best[1]))
+
+        self._printInfo(lines)
+
+        return self._getNumberToAnalyse()
+
+    def _runTiltSearch(self):
+        """ Search the tilt angle maximizing the SCF """
+        result, untilted, evaluations = engine.runTiltSearch(self._getAngles(),
+                                                             self._getFourierRadius(),
+                                                             tiltStart=self.tiltStart.get(),
+                                                             tiltStop=self.tiltStop.get(),
+                                                             numberToUse=self.numberToUse.get(),
+                                                             tolerance=self.tiltTolerance.get(),
+                                                             numberOfWorkers=self.numberOfThreads.get())
+
+        engine.plotSampling(result, self._getExtraPath("particleAnglesSamplingTilt%d.jpg" % round(result.tiltAngle)))
+
+        self._saveResults('tiltSearch', result, curve=evaluations, curveName='outputScfTiltCurve',
+                          xLabel='Tilt angle (degrees)', bestTiltAngle=result.tiltAngle, untiltedScf=untilted.scf,
+                          scfGain=result.scf - untilted.scf)
+
+        self._printInfo(_readResultLines(self._getResultsFile()))
+
+        return self._getNumberToAnalyse()
+
+    def _runResolutionSweep(self):
+        """ Compute the SCF analysis for every resolution of the sweep in a single pass """
+        resolutions = self._getResolutions()
+
+        sweep = engine.runResolutionSweep(self._getAngles(),
+                                          [self._getFourierRadius(resolution) for resolution in resolutions],
+                                          numberToUse=self.numberToUse.get(),
+                                          sym=self.sym.get(),
+                                          tiltAngle=self.tiltAngle.get())
+
+        # Report the sweep as a function of the resolution instead of the fourier radius
+        sweep[:, 0] = resolutions
+
+        engine.plotSweep(sweep, 'Resolution (A)', 'SCF vs resolution', self._getExtraPath("scfResolutionSweep.jpg"))
+
+        self._saveResults('resolutionSweep', curve=sweep, curveName='outputScfResolutionCurve',
+                          xLabel='Resolution (A)')
+
+        self._printInfo(["Resolution: %0.2f\tSCF: %0.4f\tSCF*: %0.4f" % tuple(row[:3]) for row in sweep])
+
+        return self._getNumberToAnalyse()
+
+    def _runExternalScf(self):
+        """ Compute the SCF analysis running the SCFJan2022.py script """
+        # The script reads the angles from a text file
+        angles = self._getAngles()
+
+        with open(self._getExtraPath("particleAngles.txt"), 'w') as f:
+            for start in range(0, len(angles), TRANSFORM_CHUNK_SIZE):
+                np.savetxt(f, angles[start:start + TRANSFORM_CHUNK_SIZE], fmt='%.10g', delimiter='\t')
+
         paramsScf = {
             'FileName': self._getExtraPath("particleAngles.txt"),
             # '3DFSCMap': , # Not implemented yet
             'RootOutputName': self._getExtraPath(),
-            'FourierRadius': self.fourierRadius,
+            'FourierRadius': self._getFourierRadius(),
             'TiltAngle': self.tiltAngle.get(),
             'outputInfoFileSCF': self._outputInfoFileSCF,
         }
@@ -157,7 +719,191 @@ class ScfProtAnalysis(ProtAnalysis3D):
 
         Plugin.runSCF(self, 'SCFJan2022.py', argsScf % paramsScf)
 
+        return self._getNumberToAnalyse()
+
     # --------------------------- UTILS functions ----------------------------
+    def _getAngles(self):
+        """ Returns the memory-mapped (N,3) array with the [psi, theta, rot] angles of the input particles, written by
+        the previous step """
+        angles = getattr(self, '_angles', None)
+
+        if angles is None:
+            angles = loadAngles(self._getAnglesFile())
+
+        return angles
+
+    def _getNumberToAnalyse(self):
+        """ Number of particles used by the analyses subsampling numberToUse of them """
+        numberOfParticles = len(self._getAngles())
+        numberToUse = self.numberToUse.get()
+
+        return numberToUse if 0 < numberToUse < numberOfParticles else numberOfParticles
+
+    def _getAnalysisTiltAngle(self):
+        """ Tilt angle of the analysis: the one found by the tilt search, read from the results file, or the given
+        one """
+        if self._getMode() == MODE_TILT_SEARCH:
+            return engine.loadResults(self._getResultsFile())[0]['bestTiltAngle']
+
+        return self.tiltAngle.get()
+
+    def _getFourierRadius(self, resolution=None):
+        """ Converts the analysis resolution (or the given one) to fourier radius """
+        particles = self.inParticles.get()
+
+        if resolution is None:
+            resolution = self.resolutionAnalysis.get()
+
+        return (particles.getSamplingRate() / resolution) * 2 * particles.getFirstItem().getXDim()
+
+    def _getResolutions(self):
+        """ Parses the list of resolutions of the sweep, expanding first-last:step ranges """
+        resolutions = []
+
+        for token in self.resolutionList.get().replace(',', ' ').split():
+            if '-' in token:
+                limits, _, step = token.partition(':')
+                first, last = map(float, limits.split('-'))
+                step = float(step) if step else 1.0
+                resolutions.extend(float(r) for r in np.arange(first, last + step / 2, step))
+            else:
+                resolutions.append(float(token))
+
+        return sorted(set(resolutions))
+
+    def _buildHistograms(self):
+        """ Histograms of the projection directions at the grid order and at the next coarser one, used to estimate
+        the binning error """
+        nside = 2 ** self.healpixOrder.get()
+        histograms = (OrientationHistogram(nside), OrientationHistogram(max(1, nside // 2)))
+
+        for chunk in iterTransforms(self.inParticles.get(), where=self._getWhere(),
+                                    attributes=self._getWeightAttributes(),
+                                    numberOfWorkers=self.numberOfThreads.get()):
+            directions = engine.directionsFromMatrices(chunk[1])
+            weights = self._getChunkWeights(chunk)
+
+            for histogram in histograms:
+                histogram.add(directions, weights)
+
+        return histograms
+
+    def _getWhere(self, lastId=None):
+        """ SQL condition over the particle attributes selecting the particles that pass the filter, only those after
+        lastId if given, or None to select all of them """
+        conditions = [self.particleFilter.get(), None if lastId is None else 'id > %d' % lastId]
+
+        return ' AND '.join('(%s)' % condition for condition in conditions if condition) or None
+
+    def _getMode(self):
+        return self.analysisMode.get()
+
+    def _isBinned(self):
+        """ Whether the stored angles are the centres of the orientation bins, weighted by their number of particles """
+        return self._getMode() in (MODE_BINNED, MODE_OUT_OF_CORE)
+
+    def _getGroupBy(self):
+        """ Attribute defining the groups of the grouped analysis, empty in the other modes """
+        return self.groupBy.get() if self._getMode() == MODE_GROUPED else ''
+
+    def _getWeightBy(self):
+        """ Attribute weighting the particles, empty if they are not weighted or the mode does not support it """
+        return (self.weightBy.get() or '') if self._getMode() in WEIGHTED_MODES else ''
+
+    def _hasFscMap(self):
+        return self.fscMap.get() is not None and self._getMode() != MODE_EXTERNAL_SCRIPT
+
+    def _getWeightAttributes(self):
+        """ Attributes read together with the transforms when the particles are read in chunks """
+        return [self._getWeightBy()] if self._getWeightBy() else []
+
+    def _getChunkWeights(self, chunk):
+        """ Weights of the particles of a chunk read with _getWeightAttributes, or None if they are not weighted """
+        return engine.checkWeights(chunk[2][0], self._getWeightBy()) if self._getWeightBy() else None
+
+    def _getWeights(self):
+        """ Weights of the stored angles: the particle weights, or the number of particles of every direction with
+        binned orientations. None if the angles are not weighted """
+        weightsFile = self._getAngleWeightsFile()
+
+        return np.load(weightsFile) if os.path.exists(weightsFile) else None
+
+    def _useCache(self):
+        """ The out-of-core analysis never reads all the particles at once, so there is no key to look them up """
+        return self.useCache.get() and self._getMode() != MODE_OUT_OF_CORE
+
+    def _getCacheExcludedFiles(self):
+        """ Patterns of the files of the extra directory that are not results of the analysis: the profiles and the
+        inputs of this run, and the outputs of the later steps """
+        # The particle angles and weights are always written by the previous step, which also computes the cache key
+        # from them. With binned orientations, the angles and counts of the bins are a result of the analysis
+        exclude = ['profile_*', 'particleAngles.txt', os.path.basename(self._getCheckpointFile()), 'scfFscMap.*']
+
+        if self._getMode() != MODE_BINNED:
+            exclude += [os.path.basename(self._getAnglesFile()), os.path.basename(self._getAngleWeightsFile())]
+
+        return exclude
+
+    def _computeCacheKey(self, *orientations):
+        """ Hash of the particle orientations (rotation matrices or orientation histogram, plus any other particle
+        data used) and every parameter affecting the analysis results """
+        params = {name: self.getAttributeValue(name) for name in
+                  ['analysisMode', 'resolutionAnalysis', 'sym', 'numberToUse', 'tiltAngle',
+                   'tiltStart', 'tiltStop', 'tiltStep', 'tiltTolerance', 'resolutionList',
+                   'convergenceTolerance', 'numberOfReplicates', 'healpixOrder', 'groupBy', 'particleFilter',
+                   'weightBy', 'singlePrecisionAngles']}
+        params['fourierRadius'] = self._getFourierRadius()
+
+        return Plugin.getCache().computeKey(*orientations, **params)
+
+    def _getTiltAngles(self):
+        """ Returns the list of tilt angles of the sweep, including its last value """
+        step = self.tiltStep.get()
+
+        return list(np.arange(self.tiltStart.get(), self.tiltStop.get() + step / 2, step))
+
+    def _getResultsFile(self):
+        return self._getExtraPath("scfResults.npz")
+
+    def _getFscMapResultsFile(self):
+        return self._getExtraPath("scfFscMap.npz")
+
+    def _getAnglesFile(self):
+        return self._getExtraPath("particleAngles.npy")
+
+    def _getAngleWeightsFile(self):
+        """ Weight of every particle, or number of particles of every direction with binned orientations """
+        return self._getExtraPath("particleAngleWeights.npy")
+
+    def _getCheckpointFile(self):
+        return self._getExtraPath("scfCheckpoint.npz")
+
+    def _getCheckpointParameters(self):
+        """ Parameters of the out-of-core analysis and identity of its input set (file, number of particles and
+        modification time), which must match those of a checkpoint to resume from it """
+        inputFile = self.inParticles.get().getFileName()
+
+        return {'fourierRadius': self._getFourierRadius(), 'sym': self.sym.get(), 'tiltAngle': self.tiltAngle.get(),
+                'healpixOrder': self.healpixOrder.get(), 'particleFilter': self.particleFilter.get(),
+                'weightBy': self._getWeightBy(), 'inputFile': os.path.abspath(inputFile),
+                'inputSize': self.inParticles.get().getSize(), 'inputModified': os.path.getmtime(inputFile)}
+
+    def _saveResults(self, mode, result=None, curve=None, labels=None, **metadata):
+        """ Writes the results of the analysis, together with the parameters of the run, to the results file """
+        metadata.update(mode=mode,
+                        resolution=self.resolutionAnalysis.get(),
+                        fourierRadius=self._getFourierRadius(),
+                        sym=self.sym.get(),
+                        tiltAngle=self.tiltAngle.get())
+
+        engine.saveResults(self._getResultsFile(), result=result, curve=curve, labels=labels, **metadata)
+
+    @staticmethod
+    def _printInfo(lines):
+        """ Prints the result lines to the protocol log """
+        for line in lines:
+            print(line)
+
     @staticmethod
     def getAnglesFromMatrix(matrix):
         angles = euler_from_matrix(matrix, axes='szyz')
@@ -165,31 +911,163 @@ class ScfProtAnalysis(ProtAnalysis3D):
         return degrees(angles[0]), degrees(angles[1]), degrees(angles[2])
 
     # --------------------------- INFO functions ----------------------------
+    def _validate(self):
+        errors = []
+        mode = self._getMode()
+
+        try:
+            symmetry.getGroupOrder(self.sym.get())
+        except ValueError as e:
+            errors.append(str(e))
+
+        if mode == MODE_ADAPTIVE:
+            if self.convergenceTolerance.get() <= 0:
+                errors.append("The convergence tolerance must be greater than zero.")
+
+        elif mode in (MODE_BINNED, MODE_OUT_OF_CORE):
+            if not 0 <= self.healpixOrder.get() <= 10:
+                errors.append("The grid order must be between 0 and 10.")
+
+            if mode == MODE_OUT_OF_CORE and self.inParticles.get() is not None:
+                try:
+                    engine.getChunkSize(self.memoryLimit.get() * 1024 ** 2, self._getFourierRadius(),
+                                        sym=self.sym.get(), tiltAngle=self.tiltAngle.get())
+                except ValueError as e:
+                    errors.append(str(e))
+
+        elif mode == MODE_GROUPED:
+            if not self.groupBy.get():
+                errors.append("The attribute to group the particles by is required.")
+
+        elif mode == MODE_RESOLUTION_SWEEP:
+            try:
+                resolutions = self._getResolutions()
+            except ValueError:
+                errors.append("Invalid list of resolutions: %s" % self.resolutionList.get())
+            else:
+                if not resolutions or min(resolutions) <= 0:
+                    errors.append("The list of resolutions must contain positive values.")
+
+        elif mode == MODE_TILT_SWEEP:
+            if self.tiltStep.get() <= 0:
+                errors.append("The tilt step must be greater than zero.")
+
+            if self.tiltStop.get() < self.tiltStart.get():
+                errors.append("The last tilt angle must not be smaller than the first one.")
+
+        elif mode == MODE_TILT_SEARCH:
+            if self.tiltStop.get() <= self.tiltStart.get():
+                errors.append("The last tilt angle must be greater than the first one.")
+
+            if self.tiltTolerance.get() <= 0:
+                errors.append("The tilt search tolerance must be greater than zero.")
+
+        if self.particleFilter.get() and self.inParticles.get() is not None:
+            try:
+                checkWhere(self.inParticles.get(), self.particleFilter.get())
+            except ValueError as e:
+                errors.append("Invalid particle filter %s: %s" % (self.particleFilter.get(), e))
+
+        errors.extend(self._validateAttributes())
+
+        if self._hasFscMap():
+            try:
+                import mrcfile
+            except ImportError:
+                errors.append("The mrcfile package is required to read the 3D FSC map.")
+
+        return errors
+
+    def _validateAttributes(self):
+        """ Checks that the attributes used to group and to weight the particles exist, on the first particle, and
+        that the weights are numbers """
+        inputSet = self.inParticles.get()
+        particle = None if inputSet is None else inputSet.getFirstItem()
+        errors = []
+
+        # Empty sets, e.g. streaming ones that have not received particles yet, are checked when read
+        if particle is None:
+            return errors
+
+        for label, use in ((self._getGroupBy(), 'group'), (self._getWeightBy(), 'weight')):
+            if not label:
+                continue
+
+            try:
+                value = getNestedValue(particle, label)
+            except AttributeError:
+                errors.append("The particles have no attribute %s to %s them by." % (label, use))
+                continue
+
+            if use == 'weight':
+                try:
+                    float(value)
+                except (TypeError, ValueError):
+                    errors.append("The attribute %s to weight the particles by must be a number, but it is %r in the "
+                                  "first particle." % (label, value))
+
+        return errors
+
     def _summary(self):
         summary = []
 
-        if os.path.exists(self._outputInfoFileSCF.get()):
+        if hasattr(self, 'outputScf'):
             summary.append("SCF analysis output summary:")
+            summary.extend(self.outputScf.getSummaryLines())
 
-            with open(self._outputInfoFileSCF.get(), 'r') as f:
-                lines = f.readlines()
-
-            for line in lines:
-                summary.append(line[:-1])
+            for curve in self._iterOutputCurves():
+                summary.extend(curve.getSummaryLines())
 
         else:
-            summary.append("SCF analysis not finished yet.")
+            # Finished runs without outputs come from the external script, which only writes its text output. Their
+            # lines are cached, files of running analyses are read again to show their progress
+            finished = self.isFinished()
+            lines = None if finished else readSummaryLines(self._getResultsFile(), _readResultLines)
+
+            if lines is not None:
+                summary.append("SCF analysis in progress:")
+            else:
+                lines = readSummaryLines(self._outputInfoFileSCF.get(), _readTextLines, useCache=finished)
+
+                if lines is not None:
+                    summary.append("SCF analysis output summary:")
+
+            if lines is not None:
+                summary.extend(lines)
+            else:
+                summary.append("SCF analysis not finished yet.")
+
+        summary.extend(getMetricsLines(self._stepMetrics.get()))
 
         return summary
 
     def _methods(self):
         methods = []
 
-        if os.path.exists(self._outputInfoFileSCF.get()):
+        if hasattr(self, 'outputScf') or (self.isFinished() and
+                                          readSummaryLines(self._outputInfoFileSCF.get(), _readTextLines,
+                                                           useCache=True) is not None):
             methods.append('SCF analysis completed using the Baldwin and Lyumkis method. Out information contained in '
                            'summary and plot image under "Analyze results".')
 
+            if hasattr(self, 'outputScf') and self.outputScf.hasScf():
+                methods.append('The SCF of %d projections at a Fourier radius of %0.2f (%0.2f A) with %s symmetry '
+                               'was %0.4f (SCF* %0.4f).'
+                               % (self.outputScf.getNumberOfProjections(), self.outputScf.getFourierRadius(),
+                                  self.outputScf.getResolution(), self.outputScf.getSymmetry(),
+                                  self.outputScf.getScf(), self.outputScf.getScfStar()))
+
+            if hasattr(self, 'outputScf') and self.outputScf.getScfGain() is not None:
+                methods.append('Collecting at a tilt of %0.2f degrees, found by searching between %0.1f and %0.1f '
+                               'degrees, was predicted to change the SCF by %+0.4f over an untilted collection.'
+                               % (self.outputScf.getBestTiltAngle(), self.tiltStart.get(), self.tiltStop.get(),
+                                  self.outputScf.getScfGain()))
+
         else:
             methods.append("SCF analysis not finished yet.")
 
         return methods
+
+    def _iterOutputCurves(self):
+        for _, output in self.iterOutputAttributes(ScfCurve):
+            yield output
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro-Gomez (fp.deisidro@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import numpy as np
+
+from pyworkflow.object import Integer, String
+from pyworkflow.protocol.params import BooleanParam, FloatParam, IntParam, MultiPointerParam, StringParam, \
+    LEVEL_ADVANCED
+from pwem.protocols import ProtAnalysis3D
+from scf import engine
+from scf import symmetry
+from scf.convert import getAnglesFromMatrices, readTransformMatrices
+from scf.objects import ScfCurve
+from scf.profiling import getMetricsLines, instrumentedStep, setStepParticles
+from scf.protocols.protocol_scf import readSummaryLines
+
+
+class ScfProtBatchAnalysis(ProtAnalysis3D):
+    """
+    Calculate SCF parameter of several sets of particles, e.g. the classes of a 3D classification, and compare them.
+    All the sets are analysed in parallel with the same parameters.
+    """
+
+    _label = 'SCF Analysis (batch)'
+
+    def __init__(self, **args):
+        ProtAnalysis3D.__init__(self, **args)
+        self._stepMetrics = String("")
+        self._numberOfParticles = Integer()
+
+    # --------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+
+        form.addParam('inputSets',
+                      MultiPointerParam,
+                      pointerClass='SetOfParticles',
+                      label='Input particle sets',
+                      help='Input sets of particles containing angle information.')
+
+        form.addParam('resolutionAnalysis',
+                      FloatParam,
+                      default=5,
+                      label='Resolution analysis',
+                      help='Resolution at which the SCF analysis will be performed.')
+
+        form.addParam('sym',
+                      StringParam,
+                      default='',
+                      label='Symmetry',
+                      help='Options Icos, Oct, Tet, Cn, or Dn. If tilt specified, then Sym =C1.')
+
+        form.addParam('numberToUse',
+                      IntParam,
+                      default=1000,
+                      label='Number of projections',
+                      help='The number of projections to use from each set. To select all the particles set to -1.')
+
+        form.addParam('tiltAngle',
+                      FloatParam,
+                      default=0.0,
+                      label='Tilt angle',
+                      help='Tilting of the sample in silico.')
+
+        form.addParam('profileSteps',
+                      BooleanParam,
+                      default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Profile steps',
+                      help='Profile every step with cProfile, writing the statistics to profile_<step>.prof in the '
+                           'extra directory. The time, CPU and memory used by every step are always shown in the '
+                           'summary.')
+
+        form.addParallelSection(threads=4, mpi=0)
+
+    # -------------------------- INSERT steps functions ---------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep(self.runBatchAnalysis)
+        self._insertFunctionStep(self.createOutputStep)
+
+    # --------------------------- STEPS functions ----------------------------
+    @instrumentedStep
+    def runBatchAnalysis(self):
+        """ Compute the SCF analysis of all the input sets """
+        anglesList = []
+        fourierRadii = []
+
+        for particles in self._iterInputSets():
+            anglesList.append(getAnglesFromMatrices(readTransformMatrices(particles,
+                                                                          numberOfWorkers=self.numberOfThreads.get())))
+            fourierRadii.append(self._getFourierRadius(particles))
+
+        self._numberOfParticles.set(sum(len(angles) for angles in anglesList))
+        setStepParticles(self, self._numberOfParticles.get())
+
+        rows = engine.runBatchScf(anglesList,
+                                  fourierRadii,
+                                  numberToUse=self.numberToUse.get(),
+                                  sym=self.sym.get(),
+                                  tiltAngle=self.tiltAngle.get(),
+                                  numberOfWorkers=self.numberOfThreads.get())
+
+        labels = self._getInputLabels()
+
+        engine.plotBatch(labels, rows, self._getExtraPath("scfBatch.jpg"))
+
+        curve = np.column_stack((np.arange(1, len(rows) + 1), rows[:, 1:]))
+        engine.saveResults(self._getResultsFile(), curve=curve, labels=labels, counts=rows[:, 0].tolist(),
+                           mode='batch', resolution=self.resolutionAnalysis.get(), sym=self.sym.get(),
+                           tiltAngle=self.tiltAngle.get())
+
+        for line in self._readResultLines(self._getResultsFile()):
+            print(line)
+
+    @instrumentedStep
+    def createOutputStep(self):
+        """ Registers the SCF of every input set, read from the results file, as protocol output """
+        _, arrays = engine.loadResults(self._getResultsFile())
+
+        curve = ScfCurve(xLabel='Input set')
+        curve.loadFromSweep(arrays['curve'][:, 0], arrays['curve'])
+        self._defineOutputs(outputScfBatchCurve=curve)
+
+        for pointer in self.inputSets:
+            self._defineSourceRelation(pointer, curve)
+
+    # --------------------------- UTILS functions ----------------------------
+    def _iterInputSets(self):
+        for pointer in self.inputSets:
+            yield pointer.get()
+
+    def _getInputLabels(self):
+        """ Unique labels of the input sets, used in the table and the plot """
+        return ["%d: %s" % (i, pointer.get().getObjLabel() or pointer.getUniqueId())
+                for i, pointer in enumerate(self.inputSets, start=1)]
+
+    def _getResultsFile(self):
+        return self._getExtraPath("scfResults.npz")
+
+    @staticmethod
+    def _readResultLines(fileName):
+        """ One line per input set with its SCF values, read from the results file """
+        metadata, arrays = engine.loadResults(fileName)
+
+        return ["%s: %d particles\tSCF: %0.4f\tSCF*: %0.4f" % (label, count, *row[1:3])
+                for label, count, row in zip(arrays['labels'], metadata['counts'], arrays['curve'])]
+
+    def _getFourierRadius(self, particles):
+        """ Converts the analysis resolution to fourier radius for the given set """
+        return (particles.getSamplingRate() / self.resolutionAnalysis.get()) * 2 * particles.getFirstItem().getXDim()
+
+    # --------------------------- INFO functions ----------------------------
+    def _validate(self):
+        errors = []
+
+        if len(self.inputSets) == 0:
+            errors.append("At least one input set of particles is required.")
+
+        try:
+            symmetry.getGroupOrder(self.sym.get())
+        except ValueError as e:
+            errors.append(str(e))
+
+        return errors
+
+    def _summary(self):
+        summary = []
+
+        lines = readSummaryLines(self._getResultsFile(), self._readResultLines, useCache=self.isFinished())
+
+        if lines is not None:
+            summary.append("SCF analysis output summary:")
+            summary.extend(lines)
+
+        else:
+            summary.append("SCF analysis not finished yet.")
+
+        summary.extend(getMetricsLines(self._stepMetrics.get()))
+
+        return summary
+
+    def _methods(self):
+        methods = []
+
+        if hasattr(self, 'outputScfBatchCurve'):
+            methods.append('SCF analysis of %d sets of particles completed using the Baldwin and Lyumkis method.'
+                           % len(self.inputSets))
+
+        else:
+            methods.append("SCF analysis not finished yet.")
+
+        return methods
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro-Gomez (fp.deisidro@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import time
+
+import numpy as np
+
+from pyworkflow.protocol import STATUS_NEW
+from pyworkflow.protocol.params import IntParam
+from scf import engine
+from scf.constants import MODE_SINGLE
+from scf.convert import getAnglesFromMatrices, getLastId, readTransforms
+from scf.profiling import instrumentedStep, setStepParticles
+from scf.protocols.protocol_scf import ScfProtAnalysis
+
+# Parameters of the batch analysis that do not apply to streaming: all the new particles are always used, in a single
+# SCF analysis that is never cached, and their orientations are never written to disk
+STREAMING_HIDDEN_PARAMS = ['analysisMode', 'numberToUse', 'fscMap', 'useCache', 'singlePrecisionAngles']
+
+
+class ScfProtStreamingAnalysis(ScfProtAnalysis):
+    """
+    Calculate SCF parameter of a set of particles that is still growing during the data acquisition.
+    Every time new particles are added to the input set only their orientations are processed, and the SCF estimate
+    is refreshed from the accumulated sampling. All the particles are used, whatever the number of projections.
+    """
+
+    _label = 'SCF Analysis (streaming)'
+
+    # --------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        ScfProtAnalysis._defineParams(self, form)
+
+        for paramName in STREAMING_HIDDEN_PARAMS:
+            form.getParam(paramName).condition.set('False')
+
+        form.addSection(label='Streaming')
+
+        form.addParam('pollingInterval',
+                      IntParam,
+                      default=60,
+                      label='Polling interval (s)',
+                      help='Time to wait before checking again the input set for new particles.')
+
+    # -------------------------- INSERT steps functions ---------------------
+    def _insertAllSteps(self):
+        self._lastInsertedId = 0
+        self._lastCheck = time.time()
+        self._streamClosed = False
+        self._analysisStepId = None
+
+        particles = self._loadInputParticles()
+        self._insertNewParticlesSteps(particles)
+
+        prerequisites = [] if self._analysisStepId is None else [self._analysisStepId]
+        self._insertFunctionStep(self.createOutputStep, prerequisites=prerequisites, wait=True)
+
+    def _insertNewParticlesSteps(self, particles):
+        """ Inserts a step analysing the particles of the input set added after the last inserted step, if any. Every
+        step depends on the previous one, as it adds its particles to the sampling they accumulated. Returns whether a
+        step was inserted. """
+        self._streamClosed = particles.isStreamClosed()
+        lastId = getLastId(particles, self._getWhere())
+        particles.close()
+
+        if lastId <= self._lastInsertedId:
+            return False
+
+        prerequisites = [] if self._analysisStepId is None else [self._analysisStepId]
+        self._analysisStepId = self._insertFunctionStep(self.analyseParticlesStep, self._lastInsertedId, lastId,
+                                                        prerequisites=prerequisites)
+        self._lastInsertedId = lastId
+
+        return True
+
+    # --------------------------- STEPS functions ----------------------------
+    @instrumentedStep
+    def analyseParticlesStep(self, firstId, lastId):
+        """ Updates the SCF estimate with the particles after firstId up to lastId. The accumulated sampling and the
+        SCF history are checkpointed after every step, together with the id of the last particle analysed, so that
+        the particles of a step that is run again are not added twice """
+        checkpointFile = self._getCheckpointFile()
+
+        if os.path.exists(checkpointFile):
+            accumulator, metadata, arrays = engine.SamplingAccumulator.loadCheckpoint(checkpointFile)
+            firstId = max(firstId, metadata['lastId'])
+            numberOfParticles = metadata['numberOfParticles']
+            history = [tuple(row) for row in arrays['history']]
+        else:
+            accumulator = engine.SamplingAccumulator(self._getFourierRadius(), sym=self.sym.get(),
+                                                     tiltAngle=self.tiltAngle.get())
+            numberOfParticles = 0
+            history = []
+
+        particles = self._loadInputParticles()
+        chunk = readTransforms(particles, where='(%s) AND id <= %d' % (self._getWhere(firstId), lastId),
+                               attributes=self._getWeightAttributes())
+        ids, matrices = chunk[:2]
+        particles.close()
+        setStepParticles(self, len(ids))
+
+        if len(ids) == 0:
+            return
+
+        accumulator.add(engine.directionsFromAngles(getAnglesFromMatrices(matrices)), self._getChunkWeights(chunk))
+        numberOfParticles += len(ids)
+        result = accumulator.getResult()
+        history.append((result.numberOfProjections, result.scf, result.scfStar, result.fractionUnsampled))
+
+        accumulator.saveCheckpoint(checkpointFile, arrays={'history': np.array(history)}, lastId=lastId,
+                                   numberOfParticles=numberOfParticles)
+        self._numberOfParticles.set(numberOfParticles)
+        self._store(self._numberOfParticles)
+
+        self._saveResults('streaming', result, curve=history, curveName='outputScfStreamingCurve',
+                          xLabel='Number of particles')
+        self._printInfo(result.toLines())
+
+    @instrumentedStep
+    def createOutputStep(self):
+        """ Plots the sampling of all the particles and the SCF during the acquisition, once the input set is closed,
+        and registers the outputs """
+        if os.path.exists(self._getCheckpointFile()):
+            accumulator, _, arrays = engine.SamplingAccumulator.loadCheckpoint(self._getCheckpointFile())
+            engine.plotSampling(accumulator.getResult(), self._getExtraPath("particleAnglesSamplingTilt%d.jpg"
+                                                                            % self.tiltAngle.get()))
+            engine.plotSweep(arrays['history'], 'Number of particles', 'SCF during the acquisition',
+                             self._getExtraPath("scfStreaming.jpg"))
+
+        ScfProtAnalysis.createOutputStep(self)
+
+    # --------------------------- STREAMING functions ----------------------------
+    def _stepsCheck(self):
+        self._checkNewInput()
+        self._checkNewOutput()
+
+    def _checkNewInput(self):
+        """ Inserts a step for the particles added to the input set since the last check, at most every polling
+        interval while the input set is open """
+        if self._streamClosed or time.time() - self._lastCheck < self.pollingInterval.get():
+            return
+
+        self._lastCheck = time.time()
+        outputStep = self._getOutputStep()
+
+        if self._insertNewParticlesSteps(self._loadInputParticles()):
+            if outputStep is not None:
+                outputStep.addPrerequisites(self._analysisStepId)
+
+            self.updateSteps()
+
+    def _checkNewOutput(self):
+        """ Releases the output step once the input set is closed and all its particles have an analysis step, the
+        output step then waits for them to finish """
+        outputStep = self._getOutputStep()
+
+        if self._streamClosed and outputStep is not None and outputStep.isWaiting():
+            outputStep.setStatus(STATUS_NEW)
+
+    # --------------------------- UTILS functions ----------------------------
+    def _loadInputParticles(self):
+        """ Loads the input set from its file, to get the particles added since the last check """
+        inputSet = self.inParticles.get()
+        particles = inputSet.getClass()(filename=inputSet.getFileName())
+        particles.loadAllProperties()
+
+        return particles
+
+    def _getOutputStep(self):
+        for step in self._steps:
+            if step.funcName == 'createOutputStep':
+                return step
+
+        return None
+
+    # --------------------------- INFO functions ----------------------------
+    def _validate(self):
+        errors = ScfProtAnalysis._validate(self)
+
+        # The hidden parameters may still be set when the protocol is created from a script or a workflow file
+        if self._getMode() != MODE_SINGLE:
+            errors.append("Only the single SCF analysis is available when analysing particles in streaming, which "
+                          "already reads the new particles chunk by chunk.")
+
+        if self.fscMap.get() is not None:
+            errors.append("The 3D FSC map can not be analysed in streaming.")
+
+        return errors
@@ -0,0 +1,148 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Point group symmetry operators. The operator stack of every group is built once and cached, and it is applied to
+all the directions at once with a single batched product.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+
+
+def _rotationMatrix(axis, angle):
+    """ Rotation of angle radians around axis. """
+    x, y, z = np.asarray(axis, dtype=np.float64) / np.linalg.norm(axis)
+    c, s = np.cos(angle), np.sin(angle)
+    C = 1 - c
+
+    return np.array([[c + x * x * C, x * y * C - z * s, x * z * C + y * s],
+                     [y * x * C + z * s, c + y * y * C, y * z * C - x * s],
+                     [z * x * C - y * s, z * y * C + x * s, c + z * z * C]])
+
+
+def _alignToZ(axis):
+    """ Rotation taking axis onto the z axis. """
+    axis = np.asarray(axis, dtype=np.float64) / np.linalg.norm(axis)
+    rotationAxis = np.cross(axis, [0, 0, 1])
+
+    if np.linalg.norm(rotationAxis) < 1e-12:
+        return np.eye(3)
+
+    return _rotationMatrix(rotationAxis, np.arccos(np.clip(axis[2], -1, 1)))
+
+
+def _closeGroup(generators):
+    """ Generates the whole group of rotations spanned by the given generators. """
+    group = [np.eye(3)]
+    keys = {tuple(np.round(np.eye(3), 6).ravel())}
+    pending = [np.eye(3)]
+
+    while pending:
+        element = pending.pop()
+
+        for generator in generators:
+            product = generator @ element
+            key = tuple(np.round(product, 6).ravel())
+
+            if key not in keys:
+                keys.add(key)
+                group.append(product)
+                pending.append(product)
+
+    return np.array(group)
+
+
+def _normalizeSymmetry(sym):
+    """ Canonical name of a symmetry: cN, dN, tet, oct or ico. An empty string stands for C1. """
+    name = (sym or '').strip().lower()
+
+    if name in ('', 'c1'):
+        return 'c1'
+
+    for prefix in ('tet', 'oct', 'ico'):
+        if name.startswith(prefix):
+            return prefix
+
+    if name[0] in 'cd' and name[1:].isdigit() and int(name[1:]) > 0:
+        return name
+
+    raise ValueError("Unknown symmetry %s. Options are Icos, Oct, Tet, Cn or Dn." % sym)
+
+
+@lru_cache(maxsize=None)
+def _buildSymmetryMatrices(name):
+    goldenRatio = (1 + np.sqrt(5)) / 2
+
+    if name == 'c1':
+        matrices = np.eye(3)[None]
+
+    elif name[0] == 'c':
+        matrices = _closeGroup([_rotationMatrix([0, 0, 1], 2 * np.pi / int(name[1:]))])
+
+    elif name[0] == 'd':
+        matrices = _closeGroup([_rotationMatrix([0, 0, 1], 2 * np.pi / int(name[1:])),
+                                _rotationMatrix([1, 0, 0], np.pi)])
+
+    elif name == 'tet':
+        alignment = _alignToZ([1, 1, 1])
+        matrices = _closeGroup([alignment @ g @ alignment.T
+                                for g in (_rotationMatrix([0, 0, 1], np.pi),
+                                          _rotationMatrix([1, 1, 1], 2 * np.pi / 3))])
+
+    elif name == 'oct':
+        matrices = _closeGroup([_rotationMatrix([0, 0, 1], np.pi / 2), _rotationMatrix([1, 1, 1], 2 * np.pi / 3)])
+
+    else:
+        alignment = _alignToZ([0, 1, goldenRatio])
+        matrices = _closeGroup([alignment @ g @ alignment.T
+                                for g in (_rotationMatrix([0, 1, goldenRatio], 2 * np.pi / 5),
+                                          _rotationMatrix([0, 0, 1], np.pi))])
+
+    # The cached stack is shared by all callers
+    matrices.setflags(write=False)
+
+    return matrices
+
+
+def getSymmetryMatrices(sym):
+    """ Returns the (G,3,3) rotations of the point group given as Cn, Dn, Tet, Oct or Icos. Following the EMAN
+    conventions the main axis (n-fold, 3-fold, 4-fold and 5-fold respectively) lies along z, and the dihedral
+    2-fold along x. An empty string stands for C1. """
+    return _buildSymmetryMatrices(_normalizeSymmetry(sym))
+
+
+def getGroupOrder(sym):
+    """ Number of operators of the point group. """
+    return len(getSymmetryMatrices(sym))
+
+
+def expandSymmetry(directions, sym):
+    """ Returns the (G*N,3) symmetry-equivalent copies of the given (N,3) directions, grouped by operator. """
+    matrices = getSymmetryMatrices(sym)
+
+    return np.matmul(directions[None, :, :], matrices.transpose(0, 2, 1)).reshape(-1, 3)
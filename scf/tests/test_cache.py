@@ -0,0 +1,104 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from scf.cache import ScfCache
+
+
+class TestScfCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpDir, 'source')
+        self.destination = os.path.join(self.tmpDir, 'destination')
+        os.makedirs(self.source)
+        os.makedirs(self.destination)
+
+        for fileName in ['a.npz', 'b.txt']:
+            with open(os.path.join(self.source, fileName), 'w') as f:
+                f.write(fileName)
+
+        self.cache = ScfCache(os.path.join(self.tmpDir, 'cache'), 1024 ** 2)
+        self.key = ScfCache.computeKey(np.arange(10), sym='C1')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def testStoreAndRestore(self):
+        self.assertFalse(self.cache.restore(self.key, self.destination))
+
+        self.cache.store(self.key, self.source)
+
+        self.assertTrue(self.cache.restore(self.key, self.destination))
+        self.assertEqual(sorted(os.listdir(self.destination)), ['a.npz', 'b.txt'])
+
+    def testExcludedFiles(self):
+        with open(os.path.join(self.source, 'profile_runScfAnalysis.prof'), 'w') as f:
+            f.write('profile')
+
+        self.cache.store(self.key, self.source, exclude=['profile_*'])
+        self.assertEqual(sorted(os.listdir(self.cache._getEntryPath(self.key))), ['a.npz', 'b.txt'])
+
+        self.assertTrue(self.cache.restore(self.key, self.destination, exclude=['*.txt']))
+        self.assertEqual(os.listdir(self.destination), ['a.npz'])
+
+    def testFailedRestoreLeavesNoFiles(self):
+        self.cache.store(self.key, self.source)
+        # An entry losing its files while it is restored, as when it is evicted by another run
+        os.symlink(os.path.join(self.tmpDir, 'missing'), os.path.join(self.cache._getEntryPath(self.key), 'c.npz'))
+
+        with self.assertRaises(OSError):
+            self.cache.restore(self.key, self.destination)
+
+        self.assertEqual(os.listdir(self.destination), [])
+
+    def testFailedStoreLeavesNoFiles(self):
+        # A copy failing halfway, as when the disk of the cache gets full
+        with mock.patch('shutil.copy2', side_effect=[None, OSError("No space left on device")]):
+            with self.assertRaises(OSError):
+                self.cache.store(self.key, self.source)
+
+        self.assertFalse(self.cache.contains(self.key))
+        self.assertEqual(os.listdir(self.cache.cacheDir), [])
+
+    @unittest.skipIf(os.geteuid() == 0, "Permissions are not enforced for root")
+    def testReadOnlyCacheRaisesOSError(self):
+        os.makedirs(self.cache.cacheDir)
+        os.chmod(self.cache.cacheDir, stat.S_IRUSR | stat.S_IXUSR)
+
+        try:
+            with self.assertRaises(OSError):
+                self.cache.store(self.key, self.source)
+        finally:
+            os.chmod(self.cache.cacheDir, stat.S_IRWXU)
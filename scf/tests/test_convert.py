@@ -0,0 +1,233 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import math
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
+
+import numpy as np
+
+from scf import engine
+from scf.benchmark import SyntheticSet, generateDirections, matricesFromDirections, writeSyntheticSet
+from scf.convert import checkWhere, countTransforms, eulerFromMatrices, getAnglesFromMatrices, getLastId, \
+    readTransforms, translateWhere
+
+try:
+    from pwem.convert.transformations import euler_from_matrix
+except ImportError:
+    def euler_from_matrix(matrix, axes='szyz'):
+        """ Per-matrix szyz branch of pwem.convert.transformations.euler_from_matrix, used as reference when Scipion
+        is not installed """
+        M = np.asarray(matrix, dtype=np.float64)[:3, :3]
+        sy = math.sqrt(M[2, 1] * M[2, 1] + M[2, 0] * M[2, 0])
+
+        if sy > np.finfo(float).eps * 4.0:
+            ax = math.atan2(M[2, 1], M[2, 0])
+            ay = math.atan2(sy, M[2, 2])
+            az = math.atan2(M[1, 2], -M[0, 2])
+        else:
+            ax = math.atan2(-M[1, 0], M[1, 1])
+            ay = math.atan2(sy, M[2, 2])
+            az = 0.0
+
+        return -ax, -ay, -az
+
+
+def _rotationZ(angle):
+    c, s = np.cos(angle), np.sin(angle)
+
+    return np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
+
+
+def _rotationY(angle):
+    c, s = np.cos(angle), np.sin(angle)
+
+    return np.array([[c, 0, s], [0, 1, 0], [-s, 0, c]])
+
+
+def _homogeneous(rotations):
+    matrices = np.tile(np.eye(4), (len(rotations), 1, 1))
+    matrices[:, :3, :3] = rotations
+
+    return matrices
+
+
+class TestEulerFromMatrices(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # Random rotations, with the sign of the QR factors fixed so that they are proper rotations
+        q, r = np.linalg.qr(rng.normal(size=(500, 3, 3)))
+        q *= np.sign(np.diagonal(r, axis1=1, axis2=2))[:, None, :]
+        q[np.linalg.det(q) < 0] *= -1
+        self.rotations = q
+
+    def assertMatchesReference(self, matrices):
+        expected = np.array([euler_from_matrix(matrix, axes='szyz') for matrix in matrices])
+
+        np.testing.assert_allclose(eulerFromMatrices(matrices), expected, atol=1e-12)
+
+    def testRandomRotations(self):
+        self.assertMatchesReference(_homogeneous(self.rotations))
+
+    def testRotationOnly(self):
+        np.testing.assert_allclose(eulerFromMatrices(self.rotations), eulerFromMatrices(_homogeneous(self.rotations)))
+
+    def testGimbalLock(self):
+        # Rotations around z leave the projection direction along +z (theta 0) or, flipped by a half turn around y,
+        # along -z (theta 180), where only the sum or difference of psi and rot is defined
+        angles = np.linspace(-np.pi, np.pi, 13)
+        rotations = [_rotationZ(a) for a in angles] + [_rotationZ(a) @ _rotationY(np.pi) for a in angles] + \
+                    [_rotationY(1e-17) @ _rotationZ(a) for a in angles]
+
+        self.assertMatchesReference(_homogeneous(np.array(rotations)))
+
+    def testDirections(self):
+        matrices = _homogeneous(self.rotations)
+
+        np.testing.assert_allclose(engine.directionsFromAngles(getAnglesFromMatrices(matrices)),
+                                   engine.directionsFromMatrices(matrices), atol=1e-12)
+
+
+class _BrokenExecutor:
+    """ Stand-in for ProcessPoolExecutor reading the first ranges in-process and then failing as a pool whose worker
+    died. With failAfter None, the pool can not even be started. """
+
+    def __init__(self, max_workers=None, failAfter=None):
+        if failAfter is None:
+            raise OSError("Can not start the worker processes")
+
+        self.failAfter = failAfter
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def map(self, function, arguments):
+        for i, args in enumerate(arguments):
+            if i == self.failAfter:
+                raise BrokenProcessPool("A worker process terminated abruptly")
+
+            yield function(args)
+
+
+class TestIterTransforms(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.matrices = matricesFromDirections(generateDirections('uniform', 1000))
+        self.particles = SyntheticSet(os.path.join(self.tmpDir, 'particles.sqlite'))
+        writeSyntheticSet(self.particles.getFileName(), self.matrices)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def assertReadsAll(self, numberOfWorkers, where=None, expectedIds=np.arange(1, 1001)):
+        ids, matrices = readTransforms(self.particles, where=where, chunkSize=100, numberOfWorkers=numberOfWorkers)
+
+        np.testing.assert_array_equal(ids, expectedIds)
+        np.testing.assert_allclose(matrices, self.matrices[expectedIds - 1])
+
+    def testParallelRead(self):
+        self.assertReadsAll(1)
+        self.assertReadsAll(3)
+
+    def testBrokenPoolFallsBack(self):
+        for failAfter in (0, 4):
+            with mock.patch('concurrent.futures.ProcessPoolExecutor',
+                            lambda max_workers: _BrokenExecutor(max_workers, failAfter)):
+                self.assertReadsAll(3)
+                self.assertReadsAll(3, where='id > 250', expectedIds=np.arange(251, 1001))
+
+    def testPoolStartFailureFallsBack(self):
+        with mock.patch('concurrent.futures.ProcessPoolExecutor', _BrokenExecutor):
+            self.assertReadsAll(3)
+
+    def testLastId(self):
+        self.assertEqual(getLastId(self.particles), 1000)
+        self.assertEqual(getLastId(self.particles, where='id < 300'), 299)
+        self.assertEqual(getLastId(self.particles, where='id > 1000'), 0)
+
+
+class TestFilterAndWeight(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.matrices = matricesFromDirections(generateDirections('uniform', 1000))
+        self.classIds = rng.integers(1, 4, len(self.matrices))
+        self.scores = rng.uniform(0, 1, len(self.matrices))
+        self.particles = SyntheticSet(os.path.join(self.tmpDir, 'particles.sqlite'))
+        writeSyntheticSet(self.particles.getFileName(), self.matrices,
+                          attributes={'_classId': self.classIds, '_rlnMaxValueProbDistribution': self.scores})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def testTranslateWhere(self):
+        dbFile = self.particles.getFileName()
+
+        self.assertEqual(translateWhere(dbFile, "_classId = 3 AND _rlnMaxValueProbDistribution > 0.5"),
+                         "c03 = 3 AND c04 > 0.5")
+        # Quoted strings are left as they are
+        self.assertEqual(translateWhere(dbFile, "_classId = '_classId'"), "c03 = '_classId'")
+        self.assertIsNone(translateWhere(dbFile, None))
+
+        with self.assertRaises(ValueError):
+            translateWhere(dbFile, "_nope > 1")
+
+    def testCheckWhere(self):
+        checkWhere(self.particles, "_classId IN (1, 3)")
+
+        for where in ("_nope > 1", "nope > 1", "_classId ="):
+            with self.assertRaises(ValueError):
+                checkWhere(self.particles, where)
+
+    def testFilter(self):
+        where = "_classId IN (1, 3) AND _rlnMaxValueProbDistribution > 0.5"
+        selected = np.isin(self.classIds, [1, 3]) & (self.scores > 0.5)
+        ids, matrices = readTransforms(self.particles, where=where, chunkSize=100)
+
+        self.assertEqual(countTransforms(self.particles, where), selected.sum())
+        np.testing.assert_array_equal(ids, np.flatnonzero(selected) + 1)
+        np.testing.assert_allclose(matrices, self.matrices[selected])
+
+    def testWeightedProjections(self):
+        where = "_classId = 2"
+        selected = self.classIds == 2
+        ids, matrices, (scores,) = readTransforms(self.particles, where=where, chunkSize=100,
+                                                  attributes=['_rlnMaxValueProbDistribution'])
+        weights = engine.checkWeights(scores, '_rlnMaxValueProbDistribution')
+        result = engine.computeScf(engine.directionsFromMatrices(matrices), 15.0, weights=weights)
+
+        np.testing.assert_allclose(weights, self.scores[selected])
+        self.assertAlmostEqual(result.numberOfProjections, self.scores[selected].sum())
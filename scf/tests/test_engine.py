@@ -0,0 +1,119 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from scf import engine
+
+
+def _uniformDirections(n, seed=0):
+    directions = np.random.default_rng(seed).normal(size=(n, 3))
+
+    return directions / np.linalg.norm(directions, axis=1)[:, None]
+
+
+class TestSampling(unittest.TestCase):
+
+    def setUp(self):
+        self.directions = _uniformDirections(3000)
+        self.weights = np.random.default_rng(1).uniform(0, 2, len(self.directions))
+        self.queryDirections = engine.getQueryDirections(15)
+
+    def testSamplings(self):
+        fourierRadii = [20, 5, 12.5, 15]
+
+        for weights in (None, self.weights):
+            samplings = engine.computeSamplings(self.directions, self.queryDirections, fourierRadii, weights)
+
+            for fourierRadius, sampling in zip(fourierRadii, samplings):
+                np.testing.assert_allclose(sampling, engine.computeSampling(self.directions, self.queryDirections,
+                                                                            fourierRadius, weights))
+
+    def testGroupSamplings(self):
+        groupIndices = np.random.default_rng(2).integers(0, 4, len(self.directions))
+
+        for weights in (None, self.weights):
+            samplings = engine.computeGroupSamplings(self.directions, groupIndices, 5, self.queryDirections, 15,
+                                                     weights)
+
+            for group, sampling in enumerate(samplings):
+                selected = groupIndices == group
+                np.testing.assert_allclose(sampling, engine.computeSampling(
+                    self.directions[selected], self.queryDirections, 15,
+                    None if weights is None else weights[selected]))
+
+    def testUniformScfStar(self):
+        for sym in ('', 'C4', 'D2'):
+            result = engine.computeScf(_uniformDirections(20000), 20.0, sym=sym)
+
+            self.assertAlmostEqual(result.scfStar, 1.0, delta=0.01)
+            self.assertEqual(result.fractionUnsampled, 0.0)
+
+    def testUnevenScf(self):
+        # Projections within 30 degrees of the z axis leave the equator of Fourier space poorly sampled
+        directions = _uniformDirections(20000)
+        topView = directions[np.abs(directions[:, 2]) > np.cos(np.radians(30))]
+
+        self.assertLess(engine.computeScf(topView, 20.0).scfStar, 0.9)
+
+
+class TestSamplingAccumulator(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def testCheckpointResume(self):
+        directions = _uniformDirections(4000)
+        weights = np.random.default_rng(1).uniform(0, 2, len(directions))
+        checkpointFile = os.path.join(self.tmpDir, 'checkpoint.npz')
+
+        for sym, tiltAngle in (('', 0.0), ('C4', 0.0), ('', 30.0)):
+            full = engine.SamplingAccumulator(15, sym=sym, tiltAngle=tiltAngle)
+            full.add(directions, weights)
+
+            partial = engine.SamplingAccumulator(15, sym=sym, tiltAngle=tiltAngle)
+            partial.add(directions[:1500], weights[:1500])
+            partial.saveCheckpoint(checkpointFile, arrays={'histogram': np.arange(3)}, lastId=1500)
+
+            resumed, metadata, arrays = engine.SamplingAccumulator.loadCheckpoint(checkpointFile)
+            resumed.add(directions[1500:], weights[1500:])
+
+            self.assertEqual(metadata['lastId'], 1500)
+            np.testing.assert_array_equal(arrays['histogram'], np.arange(3))
+            np.testing.assert_allclose(resumed.sampling, full.sampling)
+
+            expected, result = full.getResult(), resumed.getResult()
+            self.assertAlmostEqual(result.scf, expected.scf)
+            self.assertAlmostEqual(result.scfStar, expected.scfStar)
+            self.assertAlmostEqual(result.numberOfProjections, expected.numberOfProjections)
@@ -0,0 +1,72 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import unittest
+
+import numpy as np
+
+from scf import fscmap
+
+
+class TestSpearmanCorrelation(unittest.TestCase):
+
+    def testAverageRanks(self):
+        np.testing.assert_allclose(fscmap.averageRanks([3.0, 1.0, 3.0, 2.0, 3.0]), [3.0, 0.0, 3.0, 1.0, 3.0])
+        np.testing.assert_allclose(fscmap.averageRanks([2.0, 2.0, 1.0, 1.0]), [2.5, 2.5, 0.5, 0.5])
+
+    def testHeavyTies(self):
+        """ Directional resolutions only take a few distinct values, the correlation must not depend on the order of
+        the tied values """
+        rng = np.random.default_rng(0)
+        resolution = rng.choice([3.2, 3.6, 4.1], 500)
+        sampling = rng.normal(size=500) - resolution
+
+        expected = self._referenceSpearman(resolution, sampling)
+        self.assertAlmostEqual(fscmap.spearmanCorrelation(resolution, sampling), expected)
+
+        for _ in range(5):
+            permutation = rng.permutation(500)
+            self.assertAlmostEqual(fscmap.spearmanCorrelation(resolution[permutation], sampling[permutation]),
+                                   expected)
+
+    def testTiesOrderedLikeTheOtherArray(self):
+        """ With ties broken by order of appearance, an uncorrelated pair sorted along the tied array looked
+        perfectly correlated """
+        x = np.repeat([1.0, 2.0], 50)
+        y = np.tile(np.arange(50.0), 2)
+
+        self.assertAlmostEqual(fscmap.spearmanCorrelation(x, y), 0.0)
+
+    def testConstantArray(self):
+        self.assertEqual(fscmap.spearmanCorrelation(np.ones(10), np.arange(10.0)), 0.0)
+
+    @staticmethod
+    def _referenceSpearman(x, y):
+        """ Pearson correlation of the average ranks, computed by brute force """
+        def ranks(values):
+            return np.array([(values < v).sum() + ((values == v).sum() - 1) / 2.0 for v in values])
+
+        return float(np.corrcoef(ranks(x), ranks(y))[0, 1])
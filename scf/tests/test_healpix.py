@@ -0,0 +1,76 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import unittest
+
+import numpy as np
+
+from scf.healpix import OrientationHistogram, getNumberOfPixels, getPixelSize, pix2vec, vec2pix
+
+
+class TestHealpix(unittest.TestCase):
+
+    NSIDES = (1, 2, 4, 16)
+
+    def testPixelRoundTrip(self):
+        for nside in self.NSIDES:
+            pixels = np.arange(getNumberOfPixels(nside))
+            np.testing.assert_array_equal(vec2pix(nside, pix2vec(nside, pixels)), pixels)
+
+    def testCentres(self):
+        for nside in self.NSIDES:
+            centres = pix2vec(nside, np.arange(getNumberOfPixels(nside)))
+
+            np.testing.assert_allclose(np.linalg.norm(centres, axis=1), 1.0)
+            # Equal-area pixels of a symmetric grid
+            np.testing.assert_allclose(centres.mean(axis=0), 0.0, atol=1e-12)
+
+    def testVectorRoundTrip(self):
+        vectors = np.random.default_rng(0).normal(size=(10000, 3))
+        vectors /= np.linalg.norm(vectors, axis=1)[:, None]
+
+        for nside in self.NSIDES:
+            centres = pix2vec(nside, vec2pix(nside, vectors))
+            distances = np.degrees(np.arccos(np.clip((vectors * centres).sum(axis=1), -1, 1)))
+
+            self.assertLess(distances.max(), 2 * getPixelSize(nside))
+
+    def testEqualArea(self):
+        vectors = np.random.default_rng(1).normal(size=(240000, 3))
+        vectors /= np.linalg.norm(vectors, axis=1)[:, None]
+        counts = np.bincount(vec2pix(4, vectors), minlength=getNumberOfPixels(4))
+
+        np.testing.assert_allclose(counts / counts.mean(), 1.0, atol=0.1)
+
+    def testHistogramFoldsOppositeDirections(self):
+        directions = np.array([[0.0, 0.6, 0.8], [0.0, -0.6, -0.8], [1.0, 0.0, 0.0]])
+        histogram = OrientationHistogram(4)
+        histogram.add(directions, weights=np.array([1.0, 2.0, 0.5]))
+
+        centres, counts = histogram.getWeightedCentres()
+
+        self.assertEqual(histogram.getTotal(), 3.5)
+        self.assertEqual(sorted(counts), [0.5, 3.0])
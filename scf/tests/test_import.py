@@ -0,0 +1,48 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import subprocess
+import sys
+import unittest
+
+from scf.benchmark import DEFAULT_IMPORT_MODULES, checkImportTime
+
+# Fixed budget of the import of every plugin module, in milliseconds, as measured by python -X importtime once
+# pyworkflow and pwem are imported
+IMPORT_BUDGET = 500
+
+
+def _canImport(module):
+    """ Whether the module can be imported by a new interpreter """
+    return subprocess.run([sys.executable, '-c', 'import %s' % module], capture_output=True).returncode == 0
+
+
+# Only Scipion itself is required, a plugin that can not be imported within Scipion is a failure
+@unittest.skipUnless(_canImport('pwem'), "The plugin can not be imported outside a Scipion environment")
+class TestImportTime(unittest.TestCase):
+
+    def testImportBudget(self):
+        self.assertEqual(checkImportTime(DEFAULT_IMPORT_MODULES, IMPORT_BUDGET), [])
@@ -0,0 +1,219 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import time
+
+import numpy as np
+
+from pyworkflow.tests import BaseTest, setupTestProject
+from pwem.objects import Particle, SetOfParticles, Transform
+from pwem.protocols import ProtImportParticles, ProtImportVolumes
+
+from scf.benchmark import generateDirections, matricesFromDirections
+from scf import engine
+from scf.constants import MODE_OUT_OF_CORE, MODE_SINGLE, MODE_TILT_SEARCH, MODE_TILT_SWEEP
+from scf.protocols import ScfProtAnalysis, ScfProtStreamingAnalysis
+
+PARTICLE_SIZE = 64
+SAMPLING_RATE = 2.0
+
+
+def writeParticles(path, matrices, name='particles'):
+    """ Writes a set of particles with the given transforms, all of them pointing to a single blank image """
+    import mrcfile
+
+    stackFile = os.path.join(path, 'particles.mrcs')
+
+    with mrcfile.new(stackFile, overwrite=True) as mrc:
+        mrc.set_data(np.zeros((1, PARTICLE_SIZE, PARTICLE_SIZE), dtype=np.float32))
+
+    fileName = os.path.join(path, '%s.sqlite' % name)
+
+    # Sets are appended to existing files, e.g. from a previous run of the tests
+    if os.path.exists(fileName):
+        os.remove(fileName)
+
+    particles = SetOfParticles(filename=fileName)
+    particles.setSamplingRate(SAMPLING_RATE)
+
+    for matrix in matrices:
+        particle = Particle(location=(1, stackFile))
+        particle.setTransform(Transform(matrix))
+        particles.append(particle)
+
+    particles.write()
+    particles.close()
+
+    return fileName
+
+
+def appendParticles(particles, matrices, streamState):
+    """ Appends particles with the given transforms to the file of a set, leaving it in the given stream state """
+    particles = SetOfParticles(filename=particles.getFileName())
+    particles.loadAllProperties()
+    particles.enableAppend()
+    stackFile = particles.getFirstItem().getFileName()
+
+    for matrix in matrices:
+        particle = Particle(location=(1, stackFile))
+        particle.setTransform(Transform(matrix))
+        particles.append(particle)
+
+    particles.setStreamState(streamState)
+    particles.write()
+    particles.close()
+
+
+def writeFscMap(path):
+    """ Writes a 3D FSC map whose directional resolution is better along z """
+    import mrcfile
+
+    fileName = os.path.join(path, 'fscMap.mrc')
+    coordinates = np.fft.fftshift(np.fft.fftfreq(PARTICLE_SIZE))
+    z, y, x = np.meshgrid(coordinates, coordinates, coordinates, indexing='ij')
+    radius = np.sqrt(x ** 2 + y ** 2 + z ** 2)
+    cutoff = 0.25 + 0.15 * np.abs(z) / np.maximum(radius, 1e-6)
+
+    with mrcfile.new(fileName, overwrite=True) as mrc:
+        mrc.set_data((1 / (1 + np.exp((radius - cutoff) / 0.01))).astype(np.float32))
+        mrc.voxel_size = SAMPLING_RATE
+
+    return fileName
+
+
+class TestScfAnalysis(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        dataPath = cls.getOutputPath('data')
+        os.makedirs(dataPath, exist_ok=True)
+
+        matrices = matricesFromDirections(generateDirections('topView', 2000))
+        cls.importParticles = cls.newProtocol(ProtImportParticles,
+                                              importFrom=ProtImportParticles.IMPORT_FROM_SCIPION,
+                                              sqliteFile=writeParticles(dataPath, matrices),
+                                              samplingRate=SAMPLING_RATE)
+        cls.launchProtocol(cls.importParticles)
+
+        cls.importFscMap = cls.newProtocol(ProtImportVolumes,
+                                           filesPath=writeFscMap(dataPath),
+                                           samplingRate=SAMPLING_RATE)
+        cls.launchProtocol(cls.importFscMap)
+
+    def runAnalysis(self, fscMap=None, **kwargs):
+        protocol = self.newProtocol(ScfProtAnalysis, resolutionAnalysis=10, numberToUse=-1, useCache=False, **kwargs)
+        protocol.inParticles.set(self.importParticles.outputParticles)
+        protocol.fscMap.set(fscMap)
+
+        return self.launchProtocol(protocol)
+
+    def testFscMap(self):
+        for kwargs in ({'analysisMode': MODE_SINGLE},
+                       {'analysisMode': MODE_TILT_SEARCH, 'tiltStart': 0, 'tiltStop': 50}):
+            protocol = self.runAnalysis(fscMap=self.importFscMap.outputVolume, **kwargs)
+
+            self.assertIsNotNone(protocol.outputScf.getFscCorrelation())
+            self.assertTrue(os.path.exists(protocol._getExtraPath('scfFscMap.jpg')))
+
+    def testTiltSweepSummary(self):
+        protocol = self.runAnalysis(analysisMode=MODE_TILT_SWEEP, tiltStart=0, tiltStop=40, tiltStep=20)
+        summary = '\n'.join(protocol.summary())
+
+        # The sweep recommends a tilt angle, but it does not predict the gain over an untilted collection
+        self.assertIn("Recommended tilt angle", summary)
+        self.assertNotIn("Predicted SCF gain", summary)
+        self.assertIsNone(protocol.outputScf.getScfGain())
+        self.assertTrue(protocol.methods())
+
+    def testTiltSearchSummary(self):
+        protocol = self.runAnalysis(analysisMode=MODE_TILT_SEARCH, tiltStart=0, tiltStop=50)
+        summary = '\n'.join(protocol.summary())
+
+        self.assertIn("Recommended tilt angle", summary)
+        self.assertIn("Predicted SCF gain", summary)
+
+    def testInvalidParticleFilter(self):
+        protocol = self.newProtocol(ScfProtAnalysis, particleFilter='_nope > 1')
+        protocol.inParticles.set(self.importParticles.outputParticles)
+
+        self.assertTrue(any('Invalid particle filter' in error for error in protocol.validate()))
+
+        protocol.particleFilter.set('id > 1000')
+        self.assertEqual(protocol.validate(), [])
+
+    def testOutOfCoreCheckpointInput(self):
+        protocol = self.runAnalysis(analysisMode=MODE_OUT_OF_CORE)
+        metadata = engine.loadResults(protocol._getCheckpointFile())[0]
+
+        self.assertEqual(metadata['parameters'], protocol._getCheckpointParameters())
+
+        # A checkpoint of an input set that has changed since is not resumed
+        inputFile = protocol.inParticles.get().getFileName()
+        modified = os.path.getmtime(inputFile)
+        os.utime(inputFile, (modified, modified + 1))
+
+        try:
+            self.assertNotEqual(metadata['parameters'], protocol._getCheckpointParameters())
+        finally:
+            os.utime(inputFile, (modified, modified))
+
+
+class TestScfStreamingAnalysis(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        cls.dataPath = cls.getOutputPath('data')
+        os.makedirs(cls.dataPath, exist_ok=True)
+        cls.matrices = matricesFromDirections(generateDirections('uniform', 1000))
+
+    def testStreaming(self):
+        self.assertTrue(ScfProtStreamingAnalysis.worksInStreaming())
+
+        importParticles = self.newProtocol(ProtImportParticles,
+                                           importFrom=ProtImportParticles.IMPORT_FROM_SCIPION,
+                                           sqliteFile=writeParticles(self.dataPath, self.matrices[:500], 'stream'),
+                                           samplingRate=SAMPLING_RATE)
+        self.launchProtocol(importParticles)
+        inputParticles = importParticles.outputParticles
+        appendParticles(inputParticles, [], SetOfParticles.STREAM_OPEN)
+
+        protocol = self.newProtocol(ScfProtStreamingAnalysis, resolutionAnalysis=10, pollingInterval=1)
+        protocol.inParticles.set(inputParticles)
+        self.proj.launchProtocol(protocol, wait=False)
+
+        # Particles arriving while the analysis runs are analysed in a new step
+        time.sleep(10)
+        appendParticles(inputParticles, self.matrices[500:], SetOfParticles.STREAM_CLOSED)
+        self._waitOutput(protocol, 'outputScf', sleepTime=5, timeOut=300)
+
+        steps = [step for step in protocol.loadSteps() if step.funcName.get() == 'analyseParticlesStep']
+        self.assertGreaterEqual(len(steps), 2)
+        self.assertEqual(protocol._numberOfParticles.get(), 1000)
+        self.assertEqual(protocol.outputScf.getNumberOfProjections(), 1000)
+        self.assertTrue(os.path.exists(protocol._getExtraPath('scfStreaming.jpg')))
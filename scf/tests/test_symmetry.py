@@ -0,0 +1,69 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import unittest
+
+import numpy as np
+
+from scf.symmetry import expandSymmetry, getGroupOrder, getSymmetryMatrices
+
+
+class TestSymmetry(unittest.TestCase):
+
+    ORDERS = {'': 1, 'C1': 1, 'c3': 3, 'C7': 7, 'D2': 4, 'D5': 10, 'Tet': 12, 'Oct': 24, 'Icos': 60}
+
+    def testGroupOrders(self):
+        for sym, order in self.ORDERS.items():
+            self.assertEqual(getGroupOrder(sym), order, sym)
+
+    def testRotations(self):
+        for sym in self.ORDERS:
+            matrices = getSymmetryMatrices(sym)
+
+            identities = np.broadcast_to(np.eye(3), matrices.shape)
+
+            np.testing.assert_allclose(matrices @ matrices.transpose(0, 2, 1), identities, atol=1e-12)
+            np.testing.assert_allclose(np.linalg.det(matrices), 1.0)
+
+    def testClosed(self):
+        for sym in self.ORDERS:
+            matrices = getSymmetryMatrices(sym)
+            keys = {tuple(np.round(matrix, 6).ravel()) for matrix in matrices}
+            products = {tuple(np.round(a @ b, 6).ravel()) for a in matrices for b in matrices}
+
+            self.assertEqual(products, keys, sym)
+
+    def testMainAxis(self):
+        z = np.array([[0.0, 0.0, 1.0]])
+
+        for sym, fold in (('C6', 6), ('D4', 4), ('Tet', 3), ('Oct', 4), ('Icos', 5)):
+            images = np.round(expandSymmetry(z, sym), 6)
+            self.assertEqual(sum(np.allclose(image, z[0]) for image in images), fold, sym)
+
+    def testUnknownSymmetry(self):
+        for sym in ('X2', 'C0', 'Dx'):
+            with self.assertRaises(ValueError):
+                getGroupOrder(sym)
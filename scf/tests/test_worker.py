@@ -0,0 +1,96 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from scf.worker import WorkerClient, bindWorker
+
+
+class TestWorkerStartup(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.socketPath = os.path.join(self.tmpDir, 'worker.sock')
+        self.threads = []
+
+    def tearDown(self):
+        for thread in self.threads:
+            thread.join()
+
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def serve(self, server):
+        """ Serves requests in a thread until the server has been idle for a second """
+        server.timeout = 0.1
+        thread = threading.Thread(target=server.serveUntilIdle)
+        thread.start()
+        self.threads.append(thread)
+
+    def testLiveSocketIsKept(self):
+        server = bindWorker(self.socketPath, idleTimeout=1)
+        self.serve(server)
+
+        self.assertIsNone(bindWorker(self.socketPath, idleTimeout=1))
+        self.assertEqual(WorkerClient(self.socketPath).ping()['status'], 'ok')
+
+    def testStaleSocketIsReplaced(self):
+        # Socket file left by a worker that died without removing it
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.socketPath)
+        stale.close()
+        self.assertIsNone(WorkerClient(self.socketPath).ping())
+
+        server = bindWorker(self.socketPath, idleTimeout=1)
+        self.assertIsNotNone(server)
+        self.serve(server)
+
+        self.assertEqual(WorkerClient(self.socketPath).ping()['status'], 'ok')
+
+    def testExitKeepsReplacedSocket(self):
+        server = bindWorker(self.socketPath, idleTimeout=0)
+        # Another worker took over the socket path
+        os.unlink(self.socketPath)
+        other = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        other.bind(self.socketPath)
+
+        try:
+            server.timeout = 0.1
+            server.serveUntilIdle()
+            self.assertTrue(os.path.exists(self.socketPath))
+        finally:
+            other.close()
+
+    def testExitRemovesOwnSocket(self):
+        server = bindWorker(self.socketPath, idleTimeout=0)
+        server.timeout = 0.1
+        server.serveUntilIdle()
+
+        self.assertFalse(os.path.exists(self.socketPath))
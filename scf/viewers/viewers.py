@@ -23,26 +23,176 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
-import scf
-import tempfile
+
 import os
-from PIL import Image
+
+import numpy as np
 
 import pyworkflow.viewer as pwviewer
 import pyworkflow.protocol.params as params
 
 from scf import Plugin
+from scf import engine
+from scf.constants import SCF_DENSITY_MAX_PROJECTIONS, SCF_PREVIEW_PROJECTIONS
+from scf.convert import loadAngles
+from scf.objects import ScfCurve
 from scf.protocols import ScfProtAnalysis
 
 
-class ScfViewer(pwviewer.Viewer):
-    """ Wrapper to visualize the output graphs obtained by the SCF analysis
+class ScfViewer(pwviewer.ProtocolViewer):
+    """ Interactive visualization of the SCF analysis: density of the projection directions, sampling of Fourier
+    space and SCF curves. The tilt angle and the resolution can be changed to preview other data collections without
+    running the protocol again.
     """
+    _label = 'viewer SCF'
     _environments = [pwviewer.DESKTOP_TKINTER, Plugin.getEnviron()]
     _targets = [
         ScfProtAnalysis
     ]
 
-    def _visualize(self, obj, **kwargs):
-        img = Image.open(self.protocol._getExtraPath("particleAnglesTilt0.jpg"))
-        img.show()
+    def _defineParams(self, form):
+        form.addSection(label='Visualization')
+
+        form.addParam('tiltAngle',
+                      params.FloatParam,
+                      default=self.protocol.tiltAngle.get(),
+                      label='Tilt angle',
+                      help='Tilting of the sample in silico used to show the projection directions and the sampling. '
+                           'Other values than the one used by the protocol are previewed with a subset of the '
+                           'particles.')
+
+        form.addParam('resolution',
+                      params.FloatParam,
+                      default=self.protocol.resolutionAnalysis.get(),
+                      label='Resolution (A)',
+                      help='Resolution at which the sampling is shown. Other values than the one used by the protocol '
+                           'are previewed with a subset of the particles.')
+
+        form.addParam('maxProjections',
+                      params.IntParam,
+                      default=SCF_DENSITY_MAX_PROJECTIONS,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Maximum number of projections',
+                      help='Larger sets are downsampled to show their projection directions.')
+
+        form.addParam('displayDensity',
+                      params.LabelParam,
+                      label='Projection directions',
+                      help='Density of the projection directions of the particles.')
+
+        form.addParam('displaySampling',
+                      params.LabelParam,
+                      label='Fourier space sampling',
+                      help='Sampling of the Fourier space shell at the given resolution and tilt angle.')
+
+        curves = self._getCurveNames()
+
+        if curves:
+            form.addParam('curve',
+                          params.EnumParam,
+                          choices=curves,
+                          default=0,
+                          label='SCF curve',
+                          help='Curve computed by the protocol (tilt or resolution sweep, convergence...).')
+
+            form.addParam('displayCurve',
+                          params.LabelParam,
+                          label='Show SCF curve')
+
+    def _getVisualizeDict(self):
+        return {'displayDensity': self._showDensity,
+                'displaySampling': self._showSampling,
+                'displayCurve': self._showCurve}
+
+    # --------------------------- SHOW functions ----------------------------
+    def _showDensity(self, paramName=None):
+        angles, weights = self._loadAngles()
+
+        if angles is None:
+            return [self.errorMessage("The particle orientations of this analysis are not stored.",
+                                      title="Missing orientations")]
+
+        density, edges = engine.computeOrientationDensity(angles,
+                                                          weights=weights,
+                                                          tiltAngle=self.tiltAngle.get(),
+                                                          maxProjections=self.maxProjections.get())
+
+        plotter = self._createPlotter('SCF projection directions')
+        ax = plotter.createSubPlot('', '', '')
+        engine.drawDensity(ax, density, edges, title='Projection directions (tilt %0.1f degrees)'
+                                                     % self.tiltAngle.get())
+
+        return [plotter]
+
+    def _showSampling(self, paramName=None):
+        result = self._getSamplingResult()
+
+        if result is None:
+            return [self.errorMessage("There is no sampling to show for this analysis.", title="Missing sampling")]
+
+        plotter = self._createPlotter('SCF Fourier space sampling')
+        engine.drawSampling(plotter.createSubPlot('', '', ''), result)
+
+        return [plotter]
+
+    def _showCurve(self, paramName=None):
+        curve = dict(self._iterCurves())[self._getCurveNames()[self.curve.get()]]
+        x, scf, scfStar, fractionUnsampled = curve.getData()
+
+        plotter = self._createPlotter('SCF curve')
+        engine.drawSweep(plotter.createSubPlot('', '', ''), np.column_stack((x, scf, scfStar, fractionUnsampled)),
+                         curve.getXLabel(), 'SCF vs %s' % curve.getXLabel().lower())
+
+        return [plotter]
+
+    # --------------------------- UTILS functions ----------------------------
+    @staticmethod
+    def _createPlotter(windowTitle):
+        """ Imports the plotter, and with it matplotlib, only when a plot is shown """
+        from pwem.viewers.plotter import EmPlotter
+
+        return EmPlotter(windowTitle=windowTitle)
+
+    def _iterCurves(self):
+        for name, output in self.protocol.iterOutputAttributes(ScfCurve):
+            yield name, output
+
+    def _getCurveNames(self):
+        return [name for name, _ in self._iterCurves()]
+
+    def _loadAngles(self):
+        """ Memory-maps the stored angles (and their weights, if any) so that they are never loaded whole """
+        anglesFile = self.protocol._getAnglesFile()
+
+        if not os.path.exists(anglesFile):
+            return None, None
+
+        weightsFile = self.protocol._getAngleWeightsFile()
+        weights = np.load(weightsFile, mmap_mode='r') if os.path.exists(weightsFile) else None
+
+        return loadAngles(anglesFile), weights
+
+    def _getSamplingResult(self):
+        """ Returns the sampling computed by the protocol if it matches the requested tilt and resolution, otherwise a
+        preview computed from a subset of the particles """
+        tiltAngle = self.tiltAngle.get()
+        fourierRadius = self.protocol._getFourierRadius(self.resolution.get())
+        resultsFile = self.protocol._getResultsFile()
+        result = engine.loadResult(resultsFile) if os.path.exists(resultsFile) else None
+
+        if result is not None and result.sampling is not None and np.isclose(result.tiltAngle, tiltAngle) and \
+                np.isclose(result.fourierRadius, fourierRadius):
+            return result
+
+        angles, weights = self._loadAngles()
+
+        if angles is None:
+            return None
+
+        # Binned orientations are few and all of them are needed, weighted particles are subsampled as the others
+        if self.protocol._isBinned():
+            return engine.computeScf(engine.directionsFromAngles(angles), fourierRadius, sym=self.protocol.sym.get(),
+                                     tiltAngle=tiltAngle, weights=np.asarray(weights, dtype=np.float64))
+
+        return engine.runScf(angles, fourierRadius, numberToUse=SCF_PREVIEW_PROJECTIONS, sym=self.protocol.sym.get(),
+                             tiltAngle=tiltAngle, weights=weights)
@@ -0,0 +1,279 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Persistent worker running the SCF command line scripts without paying the start up of a new interpreter and the
+import of NumPy and matplotlib on every run.
+
+The worker listens on a Unix socket and forks a process for every request, which inherits the already imported
+modules and runs the script with runpy as if it had been launched from the command line. Requests and replies are
+single JSON lines:
+
+    {"command": "run", "program": ..., "args": [...], "cwd": ..., "outputFile": ...}  ->  {"returncode": 0}
+    {"command": "ping"}  ->  {"status": "ok", "pid": ..., "uptime": ..., "requests": ..., "running": ...}
+
+The worker is started on demand by ensureWorker and exits after being idle for a while. Workers starting or exiting
+on the same socket are serialized with a lock file next to it, so that a worker only replaces a socket that no other
+worker answers on, and only removes its own socket when it exits.
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import runpy
+import socket
+import socketserver
+import subprocess
+import sys
+import time
+
+from scf.constants import SCF_WORKER_IDLE_TIMEOUT, SCF_WORKER_START_TIMEOUT
+
+# Modules imported before serving, so that every job finds them already loaded
+PRELOADED_MODULES = ['numpy', 'matplotlib', 'matplotlib.pyplot']
+
+
+class WorkerServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """ Unix socket server forking a process for every request. """
+
+    def __init__(self, socketPath, idleTimeout=SCF_WORKER_IDLE_TIMEOUT):
+        socketserver.UnixStreamServer.__init__(self, socketPath, WorkerHandler)
+        os.chmod(socketPath, 0o600)
+
+        self.socketPath = socketPath
+        # Identifies the socket file, which is only removed on exit if it has not been replaced meanwhile
+        self.socketInode = os.stat(socketPath).st_ino
+        self.idleTimeout = idleTimeout
+        self.startTime = time.time()
+        self.lastRequestTime = time.time()
+        self.requests = 0
+        self.timeout = 10
+
+    def process_request(self, request, client_address):
+        self.lastRequestTime = time.time()
+        self.requests += 1
+        socketserver.ForkingMixIn.process_request(self, request, client_address)
+
+    def getHealth(self):
+        return {'status': 'ok',
+                'pid': os.getppid(),
+                'python': sys.executable,
+                'uptime': time.time() - self.startTime,
+                'requests': self.requests,
+                'running': len(self.active_children or ()),
+                'preloaded': [name for name in PRELOADED_MODULES if name in sys.modules]}
+
+    def serveUntilIdle(self):
+        """ Serves requests until no request has been received for idleTimeout seconds and no job is running. """
+        try:
+            while self.active_children or time.time() - self.lastRequestTime < self.idleTimeout:
+                self.handle_request()
+                self.collect_children()
+        finally:
+            lock = lockSocket(self.socketPath)
+
+            try:
+                self.server_close()
+
+                if _getInode(self.socketPath) == self.socketInode:
+                    os.unlink(self.socketPath)
+            finally:
+                lock.close()
+
+
+def _getInode(path):
+    try:
+        return os.stat(path).st_ino
+    except OSError:
+        return None
+
+
+def lockSocket(socketPath):
+    """ Takes the exclusive lock serializing the workers starting or exiting on socketPath, waiting for it. Returns
+    the lock file, which releases the lock when closed. """
+    lock = open(socketPath + '.lock', 'a')
+
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+    except OSError:
+        lock.close()
+        raise
+
+    return lock
+
+
+def bindWorker(socketPath, idleTimeout=SCF_WORKER_IDLE_TIMEOUT):
+    """ Returns a WorkerServer listening on socketPath, or None if another worker already answers on it. The socket
+    file left by a worker that died is replaced. """
+    lock = lockSocket(socketPath)
+
+    try:
+        if os.path.exists(socketPath):
+            if WorkerClient(socketPath).ping() is not None:
+                return None
+
+            os.unlink(socketPath)
+
+        return WorkerServer(socketPath, idleTimeout)
+    finally:
+        lock.close()
+
+
+class WorkerHandler(socketserver.StreamRequestHandler):
+    """ Handles a request in the process forked for it. """
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+
+        if request.get('command') == 'ping':
+            reply = self.server.getHealth()
+        elif request.get('command') == 'run':
+            reply = {'returncode': runScript(request['program'], request.get('args', []), request.get('cwd'),
+                                             request['outputFile'])}
+        else:
+            reply = {'error': 'Unknown command %s' % request.get('command')}
+
+        self.wfile.write((json.dumps(reply) + '\n').encode())
+
+
+def runScript(program, args, cwd, outputFile):
+    """ Runs a script as __main__ with the given command line arguments, writing its standard output and error to
+    outputFile. Returns its exit code. """
+    sys.argv = [program] + list(args)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(program)))
+
+    if cwd:
+        os.chdir(cwd)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    with open(outputFile, 'w') as output:
+        os.dup2(output.fileno(), 1)
+        os.dup2(output.fileno(), 2)
+
+        try:
+            runpy.run_path(program, run_name='__main__')
+            returncode = 0
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            returncode = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+    return returncode
+
+
+# --------------------------- Client functions ----------------------------
+class WorkerClient:
+    """ Client of the worker listening on socketPath. """
+
+    def __init__(self, socketPath):
+        self.socketPath = socketPath
+
+    def _request(self, request, timeout=None):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(timeout)
+            connection.connect(self.socketPath)
+            connection.sendall((json.dumps(request) + '\n').encode())
+
+            with connection.makefile('rb') as reply:
+                return json.loads(reply.readline())
+
+    def ping(self, timeout=1.0):
+        """ Returns the health report of the worker, or None if it does not answer. """
+        try:
+            return self._request({'command': 'ping'}, timeout)
+        except (OSError, ValueError):
+            return None
+
+    def run(self, program, args, cwd, outputFile):
+        """ Runs the script in the worker, waiting for it to finish. Returns its exit code. """
+        return self._request({'command': 'run', 'program': program, 'args': list(args), 'cwd': cwd,
+                              'outputFile': outputFile})['returncode']
+
+
+def ensureWorker(python, socketPath, timeout=SCF_WORKER_START_TIMEOUT):
+    """ Returns a client of the worker listening on socketPath, starting it with the given python command if it is
+    not running or does not answer. Returns None if the worker could not be started. If several calls start a worker
+    at once, only one of them binds the socket and serves all the clients, the others exit. """
+    client = WorkerClient(socketPath)
+
+    if client.ping() is not None:
+        return client
+
+    try:
+        subprocess.Popen(python.split() + ['-m', 'scf.worker', '--socket', socketPath],
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+    except OSError as e:
+        print("Could not start the SCF worker: %s" % e)
+        return None
+
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        if client.ping() is not None:
+            return client
+
+        time.sleep(0.1)
+
+    print("The SCF worker did not start within %d seconds" % timeout)
+
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m scf.worker', description='Persistent SCF script worker.')
+    parser.add_argument('--socket', required=True, help='Unix socket to listen on.')
+    parser.add_argument('--idle-timeout', type=float, default=SCF_WORKER_IDLE_TIMEOUT,
+                        help='Seconds without requests after which the worker exits.')
+    args = parser.parse_args(argv)
+
+    import importlib
+
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+
+    for name in PRELOADED_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+    server = bindWorker(args.socket, args.idle_timeout)
+
+    # Several workers may be started at once, e.g. by protocols running in parallel, the first one serves them all
+    if server is not None:
+        server.serveUntilIdle()
+
+
+if __name__ == '__main__':
+    main()